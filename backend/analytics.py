@@ -0,0 +1,446 @@
+# League-wide advanced metrics computed with NumPy
+#
+# The stat lines and finished games of a season are loaded once into NumPy
+# arrays, and every metric is computed for all players (teams) at once:
+# per player sums with np.bincount, then rates, z-scores and percentiles as
+# whole-array operations. The schema records neither minutes nor
+# possessions, so rates are per game and pace is the number of points both
+# teams score per game.
+#
+# A write does not reload the season. The write listener records which
+# teams' stat lines or games changed, and the next request reads only the
+# rows of those teams again. Each worker process keeps its own arrays and
+# only hears about its own writes, so a season is also reloaded in full
+# once it is ANALYTICS_MAX_AGE seconds old.
+#
+# numpy is optional (pip install numpy). Without it the /report/advanced
+# routes answer 501.
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import database as db
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Seconds after which a season's arrays are reloaded in full
+max_age = float(os.getenv("ANALYTICS_MAX_AGE", "300"))
+# Number of seasons kept in memory
+max_seasons = int(os.getenv("ANALYTICS_SEASONS", "4"))
+
+# Exponent of the Pythagorean expectation for basketball scores
+pythagorean_exponent = 13.91
+
+
+#######################
+## Loading           ##
+#######################
+
+players_query = """
+SELECT p.player_id, COALESCE(p.team_id, -1), CONCAT(p.first_name, ' ', p.last_name)
+FROM player p
+ORDER BY p.player_id
+"""
+
+teams_query = """
+SELECT t.team_id, t.name
+FROM team t
+ORDER BY t.team_id
+"""
+
+# (player_id, team_id, *stat_columns) of every stat line of a season
+stat_lines_query = """
+SELECT s.player_id, COALESCE(p.team_id, -1), COALESCE(s.points, 0),
+    COALESCE(s.assists, 0), COALESCE(s.rebounds, 0), COALESCE(s.blocks, 0),
+    COALESCE(s.steals, 0)
+FROM stats s
+    JOIN player p ON p.player_id = s.player_id
+WHERE s.season = %s
+"""
+
+# (home_team_id, away_team_id, home_score, away_score) of every
+# game of a season that has both teams and a final score. The columns
+# are nullable, and a NULL cannot go into an integer array.
+games_query = """
+SELECT g.home_team_id, g.away_team_id, g.home_score, g.away_score
+FROM game g
+WHERE g.season = %s AND g.home_team_id IS NOT NULL AND g.away_team_id IS NOT NULL
+    AND g.home_score IS NOT NULL AND g.away_score IS NOT NULL
+"""
+
+
+def fetch_array(cursor, query, params, width):
+    '''
+    Run a query of integer columns and return its rows as a
+    (rows, width) array
+    '''
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    return np.array(rows, dtype=np.int64).reshape(len(rows), width)
+
+
+def fetch_players(cursor):
+    '''
+    (player_ids, team_ids, names) of every player, ordered by player_id.
+    Players without a team have team_id -1.
+    '''
+    cursor.execute(players_query)
+    rows = cursor.fetchall()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    teams = np.array([row[1] for row in rows], dtype=np.int64)
+    return (ids, teams, [row[2] for row in rows])
+
+
+def fetch_teams(cursor):
+    '''
+    (team_ids, names) of every team, ordered by team_id
+    '''
+    cursor.execute(teams_query)
+    rows = cursor.fetchall()
+    return (np.array([row[0] for row in rows], dtype=np.int64), [row[1] for row in rows])
+
+
+class SeasonArrays:
+    '''
+    Stat lines and finished games of one season as arrays, with the
+    teams whose rows were written since they were loaded
+    '''
+    def __init__(self, season):
+        self.season = season
+        self.loaded_at = None
+        self.lines = np.zeros((0, 7), dtype=np.int64)
+        self.games = np.zeros((0, 4), dtype=np.int64)
+        # Teams written per table, and tables to reload in full
+        self.stale = {"stats": set(), "game": set()}
+        self.stale_all = {"stats", "game"}
+
+    def mark_stale(self, table, team_ids):
+        if table not in self.stale:
+            return
+        if team_ids is None:
+            self.stale_all.add(table)
+        else:
+            self.stale[table].update(team_ids)
+
+    def take_stale(self):
+        '''
+        (tables to reload in full, {table: teams to reload}) written
+        since the last call, or None if nothing was
+        '''
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > max_age:
+            self.stale_all = {"stats", "game"}
+        if not (self.stale_all or self.stale["stats"] or self.stale["game"]):
+            return None
+        taken = (self.stale_all, self.stale)
+        self.stale = {"stats": set(), "game": set()}
+        self.stale_all = set()
+        return taken
+
+    def restore_stale(self, stale_all, stale):
+        '''
+        Put back notes taken by take_stale whose refresh failed, so the
+        next call reads those rows again
+        '''
+        self.stale_all |= stale_all
+        for (table, teams) in stale.items():
+            self.stale[table] |= teams
+
+    def refresh(self, cursor, players, stale_all, stale):
+        '''
+        Read again what was written: whole tables after a write that may
+        touch any team, otherwise the rows of the written teams only.
+        Returns the number of rows read.
+        '''
+        (player_ids, player_teams, names) = players
+        rows = 0
+        if "stats" in stale_all:
+            self.lines = fetch_array(cursor, stat_lines_query, (self.season,), 7)
+            rows += len(self.lines)
+        elif stale["stats"]:
+            teams = sorted(stale["stats"])
+            fresh = fetch_array(cursor, stat_lines_query + " AND p.team_id = ANY(%s)",
+                                (self.season, teams), 7)
+            # Lines loaded under one of the teams, or of a player who
+            # has since moved to one of them, are replaced
+            moved = player_ids[np.isin(player_teams, teams)]
+            keep = ~(np.isin(self.lines[:, 1], teams) | np.isin(self.lines[:, 0], moved))
+            self.lines = np.concatenate([self.lines[keep], fresh])
+            rows += len(fresh)
+
+        if "game" in stale_all:
+            self.games = fetch_array(cursor, games_query, (self.season,), 4)
+            rows += len(self.games)
+        elif stale["game"]:
+            teams = sorted(stale["game"])
+            fresh = fetch_array(cursor, games_query + " AND (g.home_team_id = ANY(%s)"
+                                " OR g.away_team_id = ANY(%s))",
+                                (self.season, teams, teams), 4)
+            keep = ~(np.isin(self.games[:, 0], teams) | np.isin(self.games[:, 1], teams))
+            self.games = np.concatenate([self.games[keep], fresh])
+            rows += len(fresh)
+
+        if stale_all == {"stats", "game"}:
+            self.loaded_at = time.monotonic()
+        return rows
+
+
+#######################
+## Metrics           ##
+#######################
+
+def ratio(numerator, denominator):
+    '''
+    Element-wise numerator / denominator, NaN where the denominator is 0
+    '''
+    out = np.full(np.broadcast(numerator, denominator).shape, np.nan)
+    return np.divide(numerator, denominator, out=out, where=denominator != 0)
+
+
+def z_scores(values, population):
+    '''
+    Z-scores of the rows of values (one column per metric) against the
+    mean and standard deviation of the population rows
+    '''
+    if len(population) == 0:
+        return np.zeros(values.shape)
+    spread = population.std(axis=0)
+    return np.divide(values - population.mean(axis=0), spread,
+                     out=np.zeros(values.shape), where=spread > 0)
+
+
+def percentiles(values, population):
+    '''
+    Percentage of the population at or below each value, per column
+    '''
+    if len(population) == 0:
+        return np.full(values.shape, np.nan)
+    ranked = np.sort(population, axis=0)
+    return np.column_stack([
+        np.searchsorted(ranked[:, k], values[:, k], side="right")
+        for k in range(values.shape[1])
+    ]) * (100.0 / len(population))
+
+
+def column(values, digits=3):
+    '''
+    Rounded values of an array for a JSON payload, with NaN as None
+    '''
+    return [None if math.isnan(value) else value
+            for value in np.round(values, digits).tolist()]
+
+
+def player_metrics(players, lines, team_id=None, min_games=None):
+    '''
+    Advanced metrics of every player who played in the season (or only
+    of one team's players). Z-scores and percentiles compare each player
+    with the qualified players of the whole league: those who played at
+    least min_games games, by default half as many as the most any
+    player played. Qualified players come first, by efficiency.
+    '''
+    (player_ids, player_teams, names) = players
+    count = len(player_ids)
+    index = np.searchsorted(player_ids, lines[:, 0])
+    games = np.bincount(index, minlength=count)
+    totals = np.column_stack([np.bincount(index, weights=lines[:, k], minlength=count)
+                              for k in range(2, 7)])
+    per_game = ratio(totals, games[:, None])
+    efficiency = per_game.sum(axis=1)
+
+    # Share of the points scored by the players of the same team
+    (team_values, team_index) = np.unique(player_teams, return_inverse=True)
+    team_points = np.bincount(team_index, weights=totals[:, 0], minlength=len(team_values))
+    scoring_share = ratio(totals[:, 0], team_points[team_index])
+    scoring_share[player_teams < 0] = np.nan
+
+    if min_games is None:
+        min_games = max(1, math.ceil(games.max() / 2)) if count else 1
+    qualified = games >= max(min_games, 1)
+    measures = np.column_stack([per_game, efficiency])
+    z = z_scores(measures, measures[qualified])
+    ranks = percentiles(measures, measures[qualified])
+    composite = z[:, :5].sum(axis=1)
+
+    selected = games > 0
+    if team_id is not None:
+        selected &= player_teams == team_id
+    rows = np.flatnonzero(selected)
+    rows = rows[np.lexsort((player_ids[rows], -efficiency[rows], ~qualified[rows]))]
+
+    stats = db.stat_columns
+    per_game_columns = [column(per_game[rows, k]) for k in range(5)]
+    z_columns = [column(z[rows, k]) for k in range(5)]
+    rank_columns = [column(ranks[rows, k], 1) for k in range(6)]
+    fields = zip(player_ids[rows].tolist(), player_teams[rows].tolist(),
+                 games[rows].tolist(), qualified[rows].tolist(),
+                 column(efficiency[rows]), column(scoring_share[rows]),
+                 column(composite[rows]), zip(*per_game_columns),
+                 zip(*z_columns), zip(*rank_columns))
+    return [{
+        "player_id": player_id,
+        "player_name": names[row],
+        "team_id": team if team >= 0 else None,
+        "games": played,
+        "qualified": is_qualified,
+        "per_game": dict(zip(stats, averages)),
+        "efficiency": player_efficiency,
+        "scoring_share": share,
+        "z_scores": dict(zip(stats, scores)),
+        "composite_z": composite_z,
+        "percentiles": dict(zip(stats + ("efficiency",), player_ranks))
+    } for (row, (player_id, team, played, is_qualified, player_efficiency, share,
+                   composite_z, averages, scores, player_ranks))
+        in zip(rows.tolist(), fields)]
+
+
+def team_metrics(teams, games):
+    '''
+    Per game scoring, pace, ratings relative to the league average and
+    Pythagorean expectation of every team, best record first
+    '''
+    (team_ids, names) = teams
+    count = len(team_ids)
+    home = np.searchsorted(team_ids, games[:, 0])
+    away = np.searchsorted(team_ids, games[:, 1])
+    home_scores = games[:, 2].astype(np.float64)
+    away_scores = games[:, 3].astype(np.float64)
+
+    def by_team(home_weights, away_weights):
+        return (np.bincount(home, weights=home_weights, minlength=count)
+                + np.bincount(away, weights=away_weights, minlength=count))
+
+    played = by_team(np.ones(len(games)), np.ones(len(games)))
+    wins = by_team(home_scores > away_scores, away_scores > home_scores)
+    points_for = by_team(home_scores, away_scores)
+    points_against = by_team(away_scores, home_scores)
+
+    win_pct = ratio(wins, played)
+    scored = ratio(points_for, played)
+    allowed = ratio(points_against, played)
+    differential = scored - allowed
+    league_average = ratio(points_for.sum(), played.sum())
+    pythagorean = ratio(scored ** pythagorean_exponent,
+                        scored ** pythagorean_exponent + allowed ** pythagorean_exponent)
+    differential_z = z_scores(np.nan_to_num(differential)[:, None],
+                              differential[played > 0][:, None])[:, 0]
+    differential_z[played == 0] = np.nan
+
+    order = np.lexsort((team_ids, -np.nan_to_num(differential), -np.nan_to_num(win_pct)))
+    fields = zip(team_ids[order].tolist(), played[order].astype(int).tolist(),
+                 wins[order].astype(int).tolist(), column(win_pct[order]),
+                 column(scored[order]), column(allowed[order]),
+                 column(differential[order]), column((scored + allowed)[order]),
+                 column((scored / league_average * 100)[order], 1),
+                 column((allowed / league_average * 100)[order], 1),
+                 column(pythagorean[order]), column((pythagorean * played)[order], 1),
+                 column(differential_z[order]))
+    return [{
+        "team_id": team_id,
+        "name": names[row],
+        "games": team_played,
+        "wins": team_wins,
+        "losses": team_played - team_wins,
+        "win_pct": team_win_pct,
+        "points_for": team_scored,
+        "points_against": team_allowed,
+        "differential": team_differential,
+        "pace": pace,
+        "offensive_rating": offensive_rating,
+        "defensive_rating": defensive_rating,
+        "pythagorean_win_pct": expected_pct,
+        "expected_wins": expected_wins,
+        "differential_z": team_differential_z
+    } for (row, (team_id, team_played, team_wins, team_win_pct, team_scored,
+                   team_allowed, team_differential, pace, offensive_rating,
+                   defensive_rating, expected_pct, expected_wins, team_differential_z))
+        in zip(order.tolist(), fields)]
+
+
+#######################
+## Engine            ##
+#######################
+
+class AdvancedMetrics:
+    '''
+    Arrays of the most recently used seasons, refreshed from the write
+    listener's notes before each computation
+    '''
+    def __init__(self):
+        # Held while loading and computing. Writes only take notes_lock,
+        # so they never wait for a refresh.
+        self.lock = threading.Lock()
+        self.notes_lock = threading.Lock()
+        self.seasons = OrderedDict()
+        self.players = None
+        self.teams = None
+        self.full_loads = 0
+        self.partial_loads = 0
+        self.rows_loaded = 0
+
+    def mark_stale(self, table, team_ids=None):
+        '''
+        Note a write to table for the given teams (None means any team).
+        Used as a database write listener.
+        '''
+        with self.notes_lock:
+            for arrays in self.seasons.values():
+                arrays.mark_stale(table, team_ids)
+
+    def season_arrays(self, season):
+        '''
+        Refreshed arrays of a season (None for the current season).
+        Called with the lock held.
+        '''
+        if season is None:
+            with db.pooled_cursor() as cursor:
+                cursor.execute("SELECT current_season()")
+                (season,) = cursor.fetchone()
+        with self.notes_lock:
+            arrays = self.seasons.get(season)
+            if arrays is None:
+                arrays = self.seasons[season] = SeasonArrays(season)
+                while len(self.seasons) > max_seasons:
+                    self.seasons.popitem(last=False)
+            self.seasons.move_to_end(season)
+            stale = arrays.take_stale()
+
+        if stale is not None:
+            try:
+                with db.pooled_cursor() as cursor:
+                    self.players = fetch_players(cursor)
+                    self.teams = fetch_teams(cursor)
+                    self.rows_loaded += arrays.refresh(cursor, self.players, *stale)
+            except Exception:
+                # Without the notes the season would be served stale
+                # until max_age
+                with self.notes_lock:
+                    arrays.restore_stale(*stale)
+                raise
+            if stale[0]:
+                self.full_loads += 1
+            else:
+                self.partial_loads += 1
+        return arrays
+
+    def player_report(self, season=None, team_id=None, min_games=None):
+        with self.lock:
+            arrays = self.season_arrays(season)
+            return player_metrics(self.players, arrays.lines, team_id, min_games)
+
+    def team_report(self, season=None):
+        with self.lock:
+            arrays = self.season_arrays(season)
+            return team_metrics(self.teams, arrays.games)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "seasons": len(self.seasons),
+                "full_loads": self.full_loads,
+                "partial_loads": self.partial_loads,
+                "rows_loaded": self.rows_loaded
+            }
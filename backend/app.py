@@ -1,188 +1,951 @@
+import base64
+import click
+import functools
+import psycopg2
 import database as db
-from flask import Flask, request, jsonify
+import os
+import cache
+import versions
+import metrics
+import migrations
+import analytics
+import events
+import write_behind
+from flask import (Flask, Blueprint, Response, request, jsonify, url_for,
+                   stream_with_context, g, current_app)
 from datetime import time, datetime
 
-app = Flask(__name__)
+# Routes, request hooks and CLI commands, registered on the app by create_app
+api = Blueprint('api', __name__, cli_group=None)
+
+# Largest top-N list the leaders report will return per category
+MAX_LEADERS = 25
+# Default and largest page size for /stats/get_stats
+STATS_PAGE_SIZE = 1000
+MAX_STATS_PAGE_SIZE = 5000
+# Default and largest page size for the game logs
+GAME_LOG_PAGE_SIZE = 20
+MAX_GAME_LOG_PAGE_SIZE = 100
+
+
+def encode_cursor(player_id, game_id):
+    '''
+    Encode a Stats primary key as an opaque pagination cursor
+    '''
+    key = "%d:%d" % (player_id, game_id)
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''
+    Decode a pagination cursor back into a (player_id, game_id) key
+    '''
+    key = base64.urlsafe_b64decode(cursor.encode()).decode()
+    (player_id, game_id) = key.split(":")
+    return (int(player_id), int(game_id))
+
+
+def encode_game_cursor(day, game_id):
+    '''
+    Encode the (date, game_id) of a game log entry as a pagination cursor
+    '''
+    key = "%s:%d" % (day.isoformat(), game_id)
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_game_cursor(cursor):
+    '''
+    Decode a game log cursor back into a (date, game_id) key
+    '''
+    key = base64.urlsafe_b64decode(cursor.encode()).decode()
+    (day, game_id) = key.split(":")
+    return (datetime.strptime(day, "%Y-%m-%d").date(), int(game_id))
+
+
+def stream_response(rows):
+    '''
+    Stream rows (dicts) as NDJSON (?format=ndjson) or as one JSON array
+    sent in chunks (?format=stream), serializing a batch of rows per chunk
+    '''
+    ndjson = request.args.get('format') == 'ndjson'
+
+    def chunk(batch, first):
+        if ndjson:
+            return "\n".join(batch) + "\n"
+        return ("" if first else ",") + ",".join(batch)
+
+    def generate():
+        if not ndjson:
+            yield "["
+        batch = []
+        first = True
+        for row in rows:
+            batch.append(current_app.json.dumps(row))
+            if len(batch) >= db.stream_batch_size:
+                yield chunk(batch, first)
+                batch = []
+                first = False
+        if batch:
+            yield chunk(batch, first)
+        if not ndjson:
+            yield "]"
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+def is_stream_request():
+    '''
+    Check whether the client asked for a streamed export
+    '''
+    return request.args.get('format') in ('ndjson', 'stream')
+
+
+def parse_date(value):
+    '''
+    Parse an optional YYYY-MM-DD query parameter
+    '''
+    if value is None:
+        return None
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+# Integer query parameters. One that does not parse is answered with
+# 400: ignoring it would drop its filter and widen the result.
+int_args = ('player_id', 'game_id', 'team_id', 'season', 'top', 'min_games')
+
+def int_arg(name):
+    '''
+    Optional integer query parameter, or None if not given. Unlike
+    request.args.get(type=int), raises ValueError when it is not an integer.
+    '''
+    value = request.args.get(name)
+    return int(value) if value is not None else None
+
+def invalid_int_arg():
+    '''
+    400 response naming the first integer query parameter (of int_args)
+    that is not an integer, or None if they all are
+    '''
+    for name in int_args:
+        for value in request.args.getlist(name):
+            if name == 'season' and value == db.all_seasons:
+                continue
+            try:
+                int(value)
+            except ValueError:
+                return jsonify({"message": "%s must be an integer" % name}), 400
+    return None
+
+def season_arg():
+    '''
+    season of a request as an int, db.all_seasons for season=all, or
+    None if not given. Raises ValueError when it is neither.
+    '''
+    if request.args.get('season') == db.all_seasons:
+        return db.all_seasons
+    return int_arg('season')
+
+def team_id_arg():
+    '''
+    team_id of a report request as an int, or None if not given. Data
+    versions are kept per int team id, so "01" and "1" share cache
+    entries and ETags. Raises ValueError when it is not an integer.
+    '''
+    return int_arg('team_id')
+
+def invalid_team_id():
+    return jsonify({"message": "team_id must be an integer"}), 400
+
+def cached_report(*tables, per_team=True):
+    '''
+    Serve a report view through the report cache. The view returns the
+    payload to jsonify, which is cached per request and dropped when one
+    of the given tables is written for the requested team (for any team
+    if not per_team).
+    '''
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper():
+            try:
+                team_id = team_id_arg() if per_team else None
+            except ValueError:
+                return invalid_team_id()
+            payload = report_cache.get_or_compute(request.full_path, team_id,
+                                                  tables, view)
+            return jsonify(payload)
+        return wrapper
+    return decorator
+
+def conditional(*tables, per_team=False):
+    '''
+    Give a GET view a strong ETag derived from the data versions of the
+    tables it reads (for the requested team if per_team) and answer
+    304 Not Modified, without calling the view, when If-None-Match
+    still matches. Answers 400 when an integer query parameter is not
+    an integer.
+    '''
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper():
+            invalid = invalid_int_arg()
+            if invalid is not None:
+                return invalid
+            team_id = team_id_arg() if per_team else None
+            etag = data_versions.etag(request.full_path, tables, team_id)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = current_app.make_response(view())
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # Let browsers keep the response but revalidate it every time
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+# Writes bump the data versions, which moves report cache keys and ETags
+data_versions = versions.create_data_versions()
+db.write_listeners.append(data_versions.bump)
+# Report responses are cached until a write changes them
+report_cache = cache.create_report_cache(data_versions)
+# Advanced metrics arrays, refreshed for the teams each write touches
+advanced_metrics = analytics.AdvancedMetrics()
+db.write_listeners.append(advanced_metrics.mark_stale)
+# Changed stat lines and scores are pushed to /events/stream
+event_broker = events.Broker()
+event_bus = events.create_event_bus(event_broker)
+db.change_listeners.append(event_bus.publish_changes)
+# Queue of /stats/* writes flushed in batches (None unless WRITE_BEHIND=1)
+write_queue = write_behind.create_write_queue()
+
+# Per-endpoint request metrics, served at /metrics
+request_metrics = metrics.RequestMetrics()
+# Send each request's profile in a Server-Timing header
+profile_headers = os.getenv("PROFILE_HEADERS", "0") == "1"
+
+
+
+#######################
+## Profiling         ##
+#######################
+
+@api.before_app_request
+def start_profile():
+    g.profile_snapshot = metrics.start_request()
+    # Lines a previous run left queued are flushed without waiting for a write
+    if write_queue is not None:
+        write_queue.start()
+
+def record_request(snapshot, status):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    method = request.method
+
+    def record():
+        request_metrics.observe(method, endpoint, status,
+                                metrics.finish_request(snapshot))
+    return record
+
+@api.after_app_request
+def add_profile_headers(response):
+    g.status = response.status_code
+    if response.is_streamed:
+        # Streamed bodies are produced after the request is torn down,
+        # so their profile is recorded once the response is closed
+        snapshot = g.pop('profile_snapshot', None)
+        if snapshot is not None:
+            response.call_on_close(record_request(snapshot, response.status_code))
+    elif profile_headers:
+        profile = metrics.finish_request(g.profile_snapshot)
+        response.headers['Server-Timing'] = metrics.server_timing(profile)
+        response.headers['X-Query-Count'] = str(profile['queries'])
+    return response
+
+@api.teardown_app_request
+def record_profile(error):
+    snapshot = g.pop('profile_snapshot', None)
+    if snapshot is not None:
+        status = 500 if error is not None else g.get('status', 500)
+        record_request(snapshot, status)()
+
+
+#######################
+## CLI commands      ##
+#######################
+
+@api.cli.command('rebuild-standings')
+def rebuild_standings():
+    '''
+    Recompute the team standings table from all games
+    (flask --app app rebuild-standings)
+    '''
+    db.rebuild_team_standings()
+    print("Team standings rebuilt")
+
+@api.cli.command('rebuild-player-totals')
+def rebuild_player_totals():
+    '''
+    Recompute the player season totals table from all stat lines
+    (flask --app app rebuild-player-totals)
+    '''
+    db.rebuild_player_totals()
+    print("Player season totals rebuilt")
+
+@api.cli.command('rebuild-form')
+def rebuild_form():
+    '''
+    Recompute the team_form and player_form tables from all games and stat lines
+    (flask --app app rebuild-form)
+    '''
+    db.rebuild_form()
+    print("Recent form rebuilt")
+
+@api.cli.command('migrate')
+@click.option('--status', is_flag=True, help='List migrations without applying them')
+def migrate(status):
+    '''
+    Create missing tables and apply pending schema migrations
+    (flask --app app migrate)
+    '''
+    if status:
+        for (version, name, applied_at) in migrations.migration_status():
+            print("%3d  %-24s %s" % (version, name, applied_at or "pending"))
+        return
+    applied = migrations.migrate()
+    for (version, name) in applied:
+        print("Applied migration %d: %s" % (version, name))
+    if not applied:
+        print("No pending migrations")
+
+@api.cli.command('seed')
+def seed():
+    '''
+    Load the sample league into an empty database
+    (flask --app app seed)
+    '''
+    if db.initialize_tables():
+        print("Sample data loaded")
+    else:
+        print("The database already holds teams, sample data not loaded")
+
+@api.cli.command('flush-stats')
+def flush_stats():
+    '''
+    Write every stat line waiting in the write-behind queue to the database
+    (flask --app app flush-stats)
+    '''
+    if write_queue is None:
+        print("WRITE_BEHIND is off, stat writes are not queued")
+        return
+    print("Flushed %d stat lines" % write_queue.flush())
+
+@api.cli.command('create-season')
+@click.argument('season', type=int)
+def create_season(season):
+    '''
+    Create the game and stats partitions of a season before its games
+    are loaded (flask --app app create-season 2024)
+    '''
+    with db.pooled_cursor() as cursor:
+        db.create_season_partitions(cursor, [season])
+    print("Partitions of season %d ready" % season)
+
+
+@api.cli.command('check-indexes')
+def check_indexes():
+    '''
+    EXPLAIN ANALYZE the report queries and check they use their indexes
+    and read only the partitions of their season (flask --app app check-indexes)
+    '''
+    failed = False
+    for (query, expected, scans, missing) in migrations.check_report_indexes():
+        print("%-4s %-18s %s" % ("FAIL" if missing else "ok", query, ", ".join(
+            "%s on %s (%s)" % (node, index, relation) if index and relation else
+            "%s on %s" % (node, index or relation)
+            for (node, index, relation) in scans)))
+        if missing:
+            failed = True
+            print("     missing: %s" % ", ".join(missing))
+    if failed:
+        raise SystemExit(1)
+
+#######################
+## Serializers       ##
+#######################
+
+# The list routes get their rows from database.py as ready-made dicts.
+
+# Report payloads, built from the rows of the report queries. Shared
+# by the Flask report routes and the async ones in asgi.py.
+
+def leaders_top_n(top, default):
+    '''
+    Clamp the optional top query parameter of the leaders reports
+    '''
+    return min(max(top, 1), MAX_LEADERS) if top else default
+
+def record_to_dict(record):
+    (wins, losses) = record
+    return {
+        'wins': wins,
+        'losses': losses
+    }
+
+def past_games_to_list(past_games):
+    return [
+        {
+            'date': (date).strftime("%m/%d/%y"),
+            'opponent': opponent,
+            'score': score,
+            'wl': wl
+        } for (date, opponent, score, wl) in past_games
+    ]
+
+def roster_to_list(players):
+    return [
+        {
+            'player_name': player_name,
+            'ppg': ppg,
+            'apg': apg,
+            'rpg': rpg,
+            'bpg': bpg,
+            'spg': spg
+        } for (player_name, ppg, apg, rpg, bpg, spg) in players
+    ]
+
+def leaders_to_list(leaders, top):
+    leaders_list = [
+        {
+            'stat_category': stat_category,
+            'player_name': player_name
+        } for (stat_category, rank, player_name, average) in leaders
+        if rank == 1
+    ]
+    # Optional top-N list per category
+    if top:
+        for category in leaders_list:
+            category['leaders'] = [
+                {
+                    'rank': rank,
+                    'player_name': player_name,
+                    'average': average
+                } for (stat_category, rank, player_name, average) in leaders
+                if stat_category == category['stat_category']
+            ]
+    return leaders_list
+
+def standings_to_list(standings):
+    return [
+        {
+            'team_id': team_id,
+            'name': name,
+            'wins': wins,
+            'losses': losses,
+            'win_pct': win_pct,
+            'games_behind': games_behind,
+            'point_differential': point_differential
+        } for (team_id, name, wins, losses, win_pct, games_behind,
+               point_differential) in standings
+    ]
+
+def league_leaders_to_list(leaders):
+    categories = {}
+    for (stat_category, rank, player_name, team_name, average) in leaders:
+        categories.setdefault(stat_category, []).append({
+            'rank': rank,
+            'player_name': player_name,
+            'team_name': team_name,
+            'average': average
+        })
+    return [
+        {
+            'stat_category': stat_category,
+            'leaders': category_leaders
+        } for (stat_category, category_leaders) in categories.items()
+    ]
+
+
+def game_result(scored, allowed):
+    return 'W' if scored > allowed else 'L'
+
+def team_game_log_entry(game):
+    (game_id, date, is_home, opponent_id, opponent, scored, allowed) = game
+    return {
+        'game_id': game_id,
+        'date': date.strftime("%m/%d/%y"),
+        'home': is_home,
+        'opponent_id': opponent_id,
+        'opponent': opponent,
+        'score': "%d - %d" % (scored, allowed),
+        'wl': game_result(scored, allowed)
+    }
+
+def player_game_log_entry(game):
+    (game_id, date, is_home, opponent_id, opponent, scored, allowed,
+     points, assists, rebounds, blocks, steals) = game
+    return {
+        'game_id': game_id,
+        'date': date.strftime("%m/%d/%y"),
+        'home': is_home,
+        'opponent_id': opponent_id,
+        'opponent': opponent,
+        # Games without a final score yet have no result
+        'wl': game_result(scored, allowed) if None not in (scored, allowed) else None,
+        'points': points,
+        'assists': assists,
+        'rebounds': rebounds,
+        'blocks': blocks,
+        'steals': steals
+    }
+
+def per_game(total, games):
+    return round(total / games, 1) if games else None
+
+def team_form_to_dict(form):
+    (games, wins, points_for, points_against, streak) = form or (0, 0, 0, 0, 0)
+    return {
+        'games': games,
+        'wins': wins,
+        'losses': games - wins,
+        'points_for': per_game(points_for, games),
+        'points_against': per_game(points_against, games),
+        # W3 after three wins in a row, L2 after two losses
+        'streak': ('W%d' % streak if streak > 0 else 'L%d' % -streak) if streak else None
+    }
+
+def player_form_to_dict(form):
+    form = form or (0,) * 12
+
+    def averages(totals):
+        return {key: per_game(total, totals[0])
+                for (key, total) in zip(('ppg', 'apg', 'rpg', 'bpg', 'spg'), totals[1:])}
+
+    recent = averages(form[:6])
+    season = averages(form[6:])
+    return {
+        'games': form[0],
+        'averages': recent,
+        'season_averages': season,
+        # Last games compared with the whole season
+        'trend': {key: round(recent[key] - season[key], 1)
+                  if None not in (recent[key], season[key]) else None
+                  for key in recent}
+    }
+
+def game_log_to_dict(games, form, limit, game_to_dict, form_to_dict):
+    '''
+    Payload of a game log page. games holds up to limit + 1 rows,
+    the extra one telling whether there is a next page.
+    '''
+    next_cursor = None
+    if len(games) > limit:
+        games = games[:limit]
+        (game_id, date) = games[-1][:2]
+        next_cursor = encode_game_cursor(date, game_id)
+    return {
+        'form': form_to_dict(form),
+        'games': [game_to_dict(game) for game in games],
+        'next_cursor': next_cursor
+    }
 
-# Connect to database
-db.connect_sqlalchemy()
-# Create indexes
-db.create_indexes()
 
 #######################
 ## Stats routes      ##
 #######################
 
-@app.route('/stats/get_stats', methods=['GET'])
+@api.route('/stats/get_stats', methods=['GET'])
+@conditional('stats')
 def stats_data():
-    stats = db.get_stats_table()
-    stats_list = [
-        {
-            "player_id": stat.player_id,
-            "game_id": stat.game_id,
-            "points": stat.points,
-            "assists": stat.assists,
-            "rebounds": stat.rebounds,
-            "blocks": stat.blocks,
-            "steals": stat.steals
+    args = request.args
+    try:
+        limit = int(args.get('limit', STATS_PAGE_SIZE))
+        after = decode_cursor(args['cursor']) if 'cursor' in args else None
+        season = season_arg()
+        filters = {
+            'player_id': int_arg('player_id'),
+            'game_id': int_arg('game_id'),
+            'team_id': int_arg('team_id'),
+            'date_from': parse_date(args.get('date_from')),
+            'date_to': parse_date(args.get('date_to')),
+            # Every season when none is given, as for season=all
+            'season': season if season != db.all_seasons else None
         }
-        for stat in stats
-    ]
-    return jsonify(stats_list)
+    except ValueError:
+        return jsonify({"message": "Invalid filter or cursor"}), 400
+    sort = args.get('sort', 'asc')
+    if sort not in ('asc', 'desc'):
+        return jsonify({"message": "sort must be 'asc' or 'desc'"}), 400
+    limit = min(max(limit, 1), MAX_STATS_PAGE_SIZE)
+
+    # Full export of every matching row, without pagination
+    if is_stream_request():
+        return stream_response(db.stream_stats_table(**filters))
+
+    # Fetch one extra row to know whether there is a next page
+    stats = db.get_stats_table(descending=(sort == 'desc'), after=after,
+                               limit=limit + 1, **filters)
+    has_more = len(stats) > limit
+    stats = stats[:limit]
+    response = jsonify(stats)
+    if has_more:
+        last = stats[-1]
+        next_cursor = encode_cursor(last['player_id'], last['game_id'])
+        next_args = args.to_dict()
+        next_args['cursor'] = next_cursor
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = '<%s>; rel="next"' % url_for(
+            'api.stats_data', **next_args)
+    return response
 
-@app.route('/stats/add_stats', methods=['POST'])
+def queue_stats(data, deleted=False):
+    '''
+    Answer a stat write in write-behind mode: 202 once the line
+    is in the queue, 400 if it is invalid, 503 if the queue is full
+    '''
+    if deleted:
+        line = dict.fromkeys(db.stat_columns, 0)
+        line.update(data if isinstance(data, dict) else {})
+        data = line
+    (row, error) = db.validate_stat_line(data)
+    if error is not None:
+        return jsonify({"message": error}), 400
+    try:
+        write_queue.enqueue(row, deleted)
+    except write_behind.QueueFull:
+        response = jsonify({"message": "Too many stat writes waiting, retry later"})
+        response.headers['Retry-After'] = str(max(1, round(write_queue.flush_interval)))
+        return response, 503
+    message = "Stats delete queued" if deleted else "Stats queued"
+    return jsonify({"message": message, "result": "queued"}), 202
+
+@api.route('/stats/add_stats', methods=['POST'])
 def add_stats():
     data = request.get_json()
-    db.add_player_stats(
-        data['player_id'],
-        data['game_id'],
-        data['points'],
-        data['assists'],
-        data['rebounds'],
-        data['blocks'],
-        data['steals']
-    )
-    return jsonify({"message": "Stats added successfully"}), 200
+    if write_queue is not None:
+        return queue_stats(data)
+    try:
+        result = db.add_player_stats(
+            data['player_id'],
+            data['game_id'],
+            data['points'],
+            data['assists'],
+            data['rebounds'],
+            data['blocks'],
+            data['steals']
+        )
+    except psycopg2.IntegrityError:
+        return jsonify({"message": "Player or game does not exist"}), 400
+    return jsonify({"message": "Stats added successfully", "result": result}), 200
 
-@app.route('/stats/edit_stats', methods=['PUT'])
+@api.route('/stats/edit_stats', methods=['PUT'])
 def edit_stats():
     data = request.get_json()
-    db.edit_player_stats(
-        data['player_id'],
-        data['game_id'],
-        data['points'],
-        data['assists'],
-        data['rebounds'],
-        data['blocks'],
-        data['steals']
-    )
-    return jsonify({"message": "Stats edited successfully"}), 200
+    if write_queue is not None:
+        return queue_stats(data)
+    try:
+        result = db.edit_player_stats(
+            data['player_id'],
+            data['game_id'],
+            data['points'],
+            data['assists'],
+            data['rebounds'],
+            data['blocks'],
+            data['steals']
+        )
+    except psycopg2.IntegrityError:
+        return jsonify({"message": "Player or game does not exist"}), 400
+    if result is None:
+        return jsonify({"message": "No stats recorded for this player and game"}), 404
+    return jsonify({"message": "Stats edited successfully", "result": result}), 200
 
-@app.route('/stats/delete_stats', methods=['DELETE'])
+@api.route('/stats/delete_stats', methods=['DELETE'])
 def delete_stats():
     data = request.get_json()
+    if write_queue is not None:
+        return queue_stats(data, deleted=True)
     db.delete_player_stats(
         data['player_id'],
         data['game_id']
     )
     return jsonify({"message": "Stats deleted successfully"}), 200
 
+@api.route('/stats/bulk_add', methods=['POST'])
+def bulk_add_stats():
+    # Either a list of stat lines or
+    # {"stats": [...], "game": {...}, "upsert": true/false}
+    data = request.get_json()
+    if isinstance(data, list):
+        data = {'stats': data}
+    if not isinstance(data, dict) or not isinstance(data.get('stats'), list):
+        return jsonify({"message": "Expected a list of stat lines"}), 400
+    result = db.bulk_add_player_stats(data['stats'], data.get('game'),
+                                      upsert=bool(data.get('upsert')))
+    written = result['inserted'] + result.get('updated', 0)
+    status = 200 if written or not result['errors'] else 400
+    return jsonify(result), status
+
 
 #######################
 ## Player routes     ##
 #######################
 
-@app.route('/player/get_players', methods=['GET'])
+@api.route('/player/get_players', methods=['GET'])
+@conditional('player')
 def player_data():
-    players = db.get_player_table()
-    players_list = [
-        {
-            "player_id": player.player_id,
-            "team_id": player.team_id,
-            "first_name": player.first_name,
-            "last_name": player.last_name,
-            "position": player.position,
-            "jersey_number": player.jersey_number
-        }
-        for player in players
-    ]
-    return jsonify(players_list)
+    if is_stream_request():
+        return stream_response(db.stream_player_table())
+    return jsonify(db.get_player_table())
 
 
 #######################
 ## Game routes       ##
 #######################
 
-@app.route('/game/get_games', methods=['GET'])
+@api.route('/game/get_games', methods=['GET'])
+@conditional('game')
 def game_data():
-    games = db.get_game_table()
-    games_list = [
-        {
-            "game_id": game.game_id,
-            "date": (game.date).strftime("%m/%d/%y"),
-            "time": (game.time).strftime("%H:%M:%S"),
-            "location": game.location,
-            "home_team_id": game.home_team_id,
-            "home_score": game.home_score,
-            "away_team_id": game.away_team_id,
-            "away_score": game.away_score
-        }
-        for game in games
-    ]
-    return jsonify(games_list)
+    season = season_arg()
+    # Every season when none is given, as for season=all
+    if season == db.all_seasons:
+        season = None
+    if is_stream_request():
+        return stream_response(db.stream_game_table(season))
+    return jsonify(db.get_game_table(season))
 
 #######################
 ## Team routes       ##
 #######################
-@app.route('/team/get_teams', methods=['GET'])
+@api.route('/team/get_teams', methods=['GET'])
+@conditional('team')
 def team_data():
-    teams = db.get_team_table()
-    teams_list = [
-        {
-            "team_id": team.team_id,
-            "name": team.name,
-            "coach": team.coach
-        }
-        for team in teams
-    ]
-    return jsonify(teams_list)
+    if is_stream_request():
+        return stream_response(db.stream_team_table())
+    return jsonify(db.get_team_table())
 
 #######################
 ## Report routes     ##
 #######################
-@app.route('/report/get_record', methods=['GET'])
+@api.route('/report/get_record', methods=['GET'])
+@conditional('game', per_team=True)
+@cached_report('game')
 def get_record():
-    team_id = request.args.get('team_id')
-    (wins, losses) = db.get_team_record(team_id)
-    record = {
-        'wins': wins,
-        'losses': losses
-    }
-    return jsonify(record)
+    team_id = int_arg('team_id')
+    season = season_arg()
+    return record_to_dict(db.get_team_record(team_id, season))
 
-@app.route('/report/get_past_games', methods=['GET'])
+@api.route('/report/get_past_games', methods=['GET'])
+@conditional('game', per_team=True)
+@cached_report('game')
 def get_past_games():
-    team_id = request.args.get('team_id')
-    past_games = db.get_team_past_games(team_id)
-    past_games_list = [
-        {
-            'date': (date).strftime("%m/%d/%y"),
-            'opponent': opponent,
-            'score': score,
-            'wl': wl
-        } for (date, opponent, score, wl) in past_games
-    ]
-    return jsonify(past_games_list)
+    team_id = int_arg('team_id')
+    season = season_arg()
+    return past_games_to_list(db.get_team_past_games(team_id, season))
 
-@app.route('/report/get_roster', methods=['GET'])
+@api.route('/report/get_roster', methods=['GET'])
+@conditional('stats', per_team=True)
+@cached_report('stats')
 def get_roster():
-    team_id = request.args.get('team_id')
-    players = db.get_team_roster_stats(team_id)
-    roster_list = [
-        {
-            'player_name': player_name,
-            'ppg': ppg,
-            'apg': apg,
-            'rpg': rpg,
-            'bpg': bpg,
-            'spg': spg
-        } for (player_name, ppg, apg, rpg, bpg, spg) in players
-    ]
-    return jsonify(roster_list)
+    team_id = int_arg('team_id')
+    season = season_arg()
+    return roster_to_list(db.get_team_roster_stats(team_id, season))
 
-@app.route('/report/get_stats_leaders', methods=['GET'])
+@api.route('/report/get_stats_leaders', methods=['GET'])
+@conditional('stats', per_team=True)
+@cached_report('stats')
 def get_stats_leaders():
-    team_id = request.args.get('team_id')
-    leaders = db.get_team_stats_leaders(team_id)
-    leaders_list = [
-        {
-            'stat_category': stat_category,
-            'player_name': player_name
-        } for (stat_category, player_name) in leaders
-    ]
-    return jsonify(leaders_list)
+    team_id = int_arg('team_id')
+    top = int_arg('top')
+    season = season_arg()
+    leaders = db.get_team_stats_leaders(team_id, leaders_top_n(top, 1), season)
+    return leaders_to_list(leaders, top)
+
+@api.route('/report/team_dashboard', methods=['GET'])
+@conditional('game', 'stats', per_team=True)
+@cached_report('game', 'stats')
+def get_team_dashboard():
+    team_id = int_arg('team_id')
+    season = season_arg()
+    return db.get_team_dashboard(team_id, season)
+
+@api.route('/report/standings', methods=['GET'])
+@conditional('game')
+@cached_report('game', per_team=False)
+def get_standings():
+    season = season_arg()
+    return standings_to_list(db.get_league_standings(season))
+
+@api.route('/report/league_leaders', methods=['GET'])
+@conditional('stats')
+@cached_report('stats', per_team=False)
+def get_league_leaders():
+    top = int_arg('top')
+    season = season_arg()
+    leaders = db.get_league_stats_leaders(leaders_top_n(top, 5), season)
+    return league_leaders_to_list(leaders)
+
+def game_log_args():
+    '''
+    Season, page size and cursor of a game log request. Raises
+    ValueError for an invalid page size or cursor.
+    '''
+    limit = int(request.args.get('limit', GAME_LOG_PAGE_SIZE))
+    after = decode_game_cursor(request.args['cursor']) if 'cursor' in request.args else None
+    return (season_arg(),
+            min(max(limit, 1), MAX_GAME_LOG_PAGE_SIZE), after)
+
+@api.route('/report/team_game_log', methods=['GET'])
+@conditional('game', per_team=True)
+def get_team_game_log():
+    team_id = int_arg('team_id')
+    try:
+        (season, limit, after) = game_log_args()
+    except ValueError:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+    if team_id is None:
+        return invalid_team_id()
+
+    def compute():
+        (games, form) = db.get_team_game_log(team_id, season, limit + 1, after)
+        return game_log_to_dict(games, form, limit, team_game_log_entry, team_form_to_dict)
+    return jsonify(report_cache.get_or_compute(request.full_path, team_id,
+                                               ('game',), compute))
+
+@api.route('/report/player_game_log', methods=['GET'])
+@conditional('game', 'stats')
+def get_player_game_log():
+    player_id = int_arg('player_id')
+    try:
+        (season, limit, after) = game_log_args()
+    except ValueError:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+    if player_id is None:
+        return jsonify({"message": "player_id must be an integer"}), 400
+
+    def compute():
+        (games, form) = db.get_player_game_log(player_id, season, limit + 1, after)
+        return game_log_to_dict(games, form, limit, player_game_log_entry, player_form_to_dict)
+    return jsonify(report_cache.get_or_compute(request.full_path, None,
+                                               ('game', 'stats'), compute))
+
+def requires_numpy(view):
+    '''
+    Answer 501 from a view that needs the optional numpy package
+    when it is not installed
+    '''
+    @functools.wraps(view)
+    def wrapper():
+        if analytics.np is None:
+            return jsonify({"message": "Advanced metrics require numpy (pip install numpy)"}), 501
+        return view()
+    return wrapper
+
+def single_season(view):
+    '''
+    Answer 400 from a view that reports on one season when
+    season=all is asked for
+    '''
+    @functools.wraps(view)
+    def wrapper():
+        if request.args.get('season') == db.all_seasons:
+            return jsonify({"message": "season=all is not supported by this report"}), 400
+        return view()
+    return wrapper
+
+@api.route('/report/advanced', methods=['GET'])
+@requires_numpy
+@single_season
+@conditional('stats')
+@cached_report('stats', per_team=False)
+def get_advanced_players():
+    team_id = int_arg('team_id')
+    season = season_arg()
+    min_games = int_arg('min_games')
+    return advanced_metrics.player_report(season, team_id, min_games)
+
+@api.route('/report/advanced/teams', methods=['GET'])
+@requires_numpy
+@single_season
+@conditional('game')
+@cached_report('game', per_team=False)
+def get_advanced_teams():
+    season = season_arg()
+    return advanced_metrics.team_report(season)
+
+@api.route('/report/cache_stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(report_cache.stats())
+
+
+#######################
+## Event routes      ##
+#######################
+
+def stream_subscription():
+    '''
+    Filters of an event stream request (game_id and team_id may be
+    repeated) and the id of the last event the client received
+    '''
+    return {
+        'game_ids': [int(value) for value in request.args.getlist('game_id')],
+        'team_ids': [int(value) for value in request.args.getlist('team_id')],
+        'last_event_id': request.headers.get('Last-Event-ID')
+    }
+
+@api.route('/events/stream', methods=['GET'])
+def event_stream():
+    invalid = invalid_int_arg()
+    if invalid is not None:
+        return invalid
+    args = stream_subscription()
+    event_bus.start()
+    subscription = event_broker.subscribe(
+        events.Subscription(args['game_ids'], args['team_ids']), args['last_event_id'])
+
+    def generate():
+        try:
+            # Ask clients to reconnect after 3 seconds
+            yield "retry: 3000\n\n"
+            while True:
+                event = subscription.get(events.keepalive)
+                yield events.format_event(event) if event is not None else ": keepalive\n\n"
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep proxies such as nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+#######################
+## Metrics routes    ##
+#######################
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render_metrics(request_metrics, report_cache,
+                                           advanced_metrics, event_broker, write_queue),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def create_app():
+    '''
+    Build the Flask app. Nothing here touches the database: the engine
+    and its pool are created by the first query, and tables, triggers and
+    indexes are set up once with `flask --app app migrate`, so a worker
+    starts without any round trips.
+    '''
+    app = Flask(__name__)
+    # Time spent serializing JSON is part of each request's profile
+    app.json = metrics.ProfilingJSONProvider(app)
+    app.register_blueprint(api)
+    return app
+
+# App served by `flask --app app`, WSGI servers and asgi.py
+app = create_app()
 
-# Main function - connect to DB and start app
+# Main function - start development server
 if __name__ == "__main__":
-    db.connect_sqlalchemy()
     app.run(debug=True, host="localhost", port=5000)
\ No newline at end of file
@@ -0,0 +1,334 @@
+# ASGI entry point for serving the app with asyncio
+#
+#   cd backend && python asgi.py
+#   cd backend && uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 4
+#
+# The /report/* routes are answered by coroutines that await their queries on
+# an asyncpg connection pool, so one worker keeps serving while any number of
+# report queries are in flight. They use the same SQL, payloads, report cache
+# and ETags as the Flask routes. Every other route is passed to the Flask app
+# unchanged (asgiref runs it in a thread).
+#
+# /events/stream is also served by a coroutine, so an open event stream
+# holds no thread: a worker can keep any number of viewers connected.
+import asyncio
+import json
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+import asyncpg
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_etags
+
+import database as db
+import events
+from app import (app, report_cache, data_versions, request_metrics, event_bus, event_broker,
+                 int_args, leaders_top_n, record_to_dict,
+                 past_games_to_list, roster_to_list, leaders_to_list,
+                 standings_to_list, league_leaders_to_list)
+
+# Settings of the async connection pool (one pool per worker process)
+async_pool_min_size = int(os.getenv("ASYNC_POOL_MIN_SIZE", "2"))
+async_pool_max_size = int(os.getenv("ASYNC_POOL_MAX_SIZE", "20"))
+async_pool = None
+
+flask_application = WsgiToAsgi(app)
+
+
+#######################
+## Connection Pool   ##
+#######################
+
+def asyncpg_dsn(db_uri):
+    '''
+    Turn the SQLAlchemy DB_URI (which may name a driver, as in
+    postgresql+psycopg2://) into a DSN asyncpg accepts
+    '''
+    return re.sub(r"^postgres(ql)?(\+\w+)?://", "postgresql://", db_uri)
+
+
+async def open_async_pool():
+    '''
+    Create this process's asyncpg pool. asyncpg prepares each report
+    query once per connection and reuses it from then on.
+    '''
+    global async_pool
+    if async_pool is None:
+        async_pool = await asyncpg.create_pool(asyncpg_dsn(db.db_uri),
+                                               min_size=async_pool_min_size,
+                                               max_size=async_pool_max_size)
+    return async_pool
+
+
+async def close_async_pool():
+    global async_pool
+    if async_pool is not None:
+        await async_pool.close()
+        async_pool = None
+
+
+#######################
+## Report handlers   ##
+#######################
+# Each handler takes the pool, the team_id (or None) and the query
+# parameters, and returns the payload of the matching Flask route. A
+# missing season parameter is None, the current season, and season=all
+# runs the all-seasons version of the query; integer parameters that
+# do not parse were answered with 400 already.
+
+def season_query(select, args):
+    '''
+    The query to run for a report select and its season parameter:
+    for season=all, the all-seasons version of the select with NULL
+    '''
+    season = args.get('season')
+    if season == db.all_seasons:
+        return (db.all_seasons_query(select), None)
+    return (select, parse_int(season))
+
+
+async def get_record(pool, team_id, args):
+    (query, season) = season_query(db.record_select, args)
+    row = await pool.fetchrow(query, team_id, season)
+    # Teams that have not finished a game yet have no standings row
+    return record_to_dict(tuple(row) if row is not None else (0, 0))
+
+
+async def get_past_games(pool, team_id, args):
+    (query, season) = season_query(db.past_games_select, args)
+    return past_games_to_list(await pool.fetch(query, team_id, season))
+
+
+async def get_roster(pool, team_id, args):
+    (query, season) = season_query(db.roster_select, args)
+    return roster_to_list(await pool.fetch(query, team_id, season))
+
+
+async def get_stats_leaders(pool, team_id, args):
+    top = parse_int(args.get('top'))
+    (query, season) = season_query(db.stats_leaders_select, args)
+    leaders = await pool.fetch(query, team_id, season, leaders_top_n(top, 1))
+    return leaders_to_list(leaders, top)
+
+
+async def get_team_dashboard(pool, team_id, args):
+    (query, season) = season_query(db.team_dashboard_select, args)
+    return json.loads(await pool.fetchval(query, team_id, season, 1))
+
+
+async def get_standings(pool, team_id, args):
+    (query, season) = season_query(db.league_standings_select, args)
+    return standings_to_list(await pool.fetch(query, season))
+
+
+async def get_league_leaders(pool, team_id, args):
+    top = parse_int(args.get('top'))
+    (query, season) = season_query(db.league_leaders_select, args)
+    leaders = await pool.fetch(query, season, leaders_top_n(top, 5))
+    return league_leaders_to_list(leaders)
+
+
+# path: (handler, tables read, cached per team)
+report_routes = {
+    '/report/get_record': (get_record, ('game',), True),
+    '/report/get_past_games': (get_past_games, ('game',), True),
+    '/report/get_roster': (get_roster, ('stats',), True),
+    '/report/get_stats_leaders': (get_stats_leaders, ('stats',), True),
+    '/report/team_dashboard': (get_team_dashboard, ('game', 'stats'), True),
+    '/report/standings': (get_standings, ('game',), False),
+    '/report/league_leaders': (get_league_leaders, ('stats',), False)
+}
+
+
+#######################
+## ASGI application  ##
+#######################
+
+def parse_int(value):
+    '''
+    Parse an optional integer query parameter
+    '''
+    return int(value) if value is not None else None
+
+
+def invalid_int_arg(query):
+    '''
+    Message naming the first integer query parameter (of app.int_args)
+    that is not an integer, or None if they all are
+    '''
+    for name in int_args:
+        for value in query.get(name, []):
+            if name == 'season' and value == db.all_seasons:
+                continue
+            try:
+                int(value)
+            except ValueError:
+                return {"message": "%s must be an integer" % name}
+    return None
+
+
+def json_body(payload):
+    '''
+    Serialize a payload exactly as jsonify would
+    '''
+    return app.json.response(payload).get_data()
+
+
+async def send_response(send, status, body=b"", headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.encode(), value.encode()) for (name, value) in headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def report_application(scope, send):
+    '''
+    Answer a GET of a report route, with the report cache, the
+    ETag / If-None-Match handling and the request metrics of the
+    Flask routes
+    '''
+    start = time.perf_counter()
+    # The event loop serves many requests at once, so the profile is
+    # measured around this request's own query and serialization
+    profile = {"queries": 0, "db_seconds": 0.0, "acquire_seconds": 0.0,
+               "serialize_seconds": 0.0}
+
+    async def respond(status, payload=None, headers=()):
+        body = b""
+        if payload is not None:
+            serialize_start = time.perf_counter()
+            body = json_body(payload)
+            profile["serialize_seconds"] = time.perf_counter() - serialize_start
+            headers = [('Content-Type', 'application/json')] + list(headers)
+        await send_response(send, status, body, headers)
+        profile["seconds"] = time.perf_counter() - start
+        request_metrics.observe('GET', scope['path'], status, profile)
+
+    (handler, tables, per_team) = report_routes[scope['path']]
+    query_string = scope['query_string'].decode('latin-1')
+    # Same key as Flask's request.full_path, so both share cache entries
+    request_key = "%s?%s" % (scope['path'], query_string)
+    query = parse_qs(query_string, keep_blank_values=True)
+    invalid = invalid_int_arg(query)
+    if invalid is not None:
+        await respond(400, invalid)
+        return
+    args = {name: values[0] for (name, values) in query.items()}
+    # Keys use the int, like app.team_id_arg, as writes bump int team ids
+    team_id = parse_int(args.get('team_id')) if per_team else None
+
+    etag = data_versions.etag(request_key, tables, team_id)
+    headers = [('ETag', '"%s"' % etag), ('Cache-Control', 'no-cache')]
+    request_headers = dict(scope['headers'])
+    if_none_match = request_headers.get(b'if-none-match', b'').decode('latin-1')
+    if parse_etags(if_none_match).contains(etag):
+        await respond(304, headers=headers)
+        return
+
+    async def compute():
+        pool = await open_async_pool()
+        query_start = time.perf_counter()
+        try:
+            return await handler(pool, team_id, args)
+        finally:
+            profile["queries"] += 1
+            profile["db_seconds"] += time.perf_counter() - query_start
+
+    payload = await report_cache.get_or_compute_async(request_key, team_id,
+                                                      tables, compute)
+    await respond(200, payload, headers)
+
+
+async def event_stream_application(scope, receive, send):
+    '''
+    Send the events of /events/stream until the client disconnects,
+    as the Flask route does, without holding a thread
+    '''
+    query = parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True)
+    invalid = invalid_int_arg(query)
+    if invalid is not None:
+        await send_response(send, 400, json_body(invalid),
+                            [('Content-Type', 'application/json')])
+        return
+    game_ids = [int(value) for value in query.get('game_id', [])]
+    team_ids = [int(value) for value in query.get('team_id', [])]
+    last_event_id = dict(scope['headers']).get(b'last-event-id')
+    if last_event_id is not None:
+        last_event_id = last_event_id.decode('latin-1')
+
+    event_bus.start()
+    subscription = event_broker.subscribe(
+        events.AsyncSubscription(asyncio.get_running_loop(), game_ids, team_ids),
+        last_event_id)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                        (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')]
+        })
+        text = "retry: 3000\n\n"
+        while True:
+            await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+            next_event = asyncio.ensure_future(subscription.get(events.keepalive))
+            await asyncio.wait([next_event, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                next_event.cancel()
+                return
+            event = next_event.result()
+            text = events.format_event(event) if event is not None else ": keepalive\n\n"
+    finally:
+        disconnected.cancel()
+        event_broker.unsubscribe(subscription)
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def lifespan(receive, send):
+    '''
+    Open the async pool when the server starts and close it on shutdown
+    '''
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await open_async_pool()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_pool()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    '''
+    ASGI application: async report routes, Flask for everything else
+    '''
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif (scope['type'] == 'http' and scope['method'] == 'GET'
+          and scope['path'] in report_routes):
+        await report_application(scope, send)
+    elif (scope['type'] == 'http' and scope['method'] == 'GET'
+          and scope['path'] == '/events/stream'):
+        await event_stream_application(scope, receive, send)
+    else:
+        await flask_application(scope, receive, send)
+
+
+# Production launcher - WEB_WORKERS processes, each with its own pools
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("asgi:application",
+                host=os.getenv("WEB_HOST", "0.0.0.0"),
+                port=int(os.getenv("WEB_PORT", "5000")),
+                workers=int(os.getenv("WEB_WORKERS", "1")),
+                log_level=os.getenv("WEB_LOG_LEVEL", "info"))
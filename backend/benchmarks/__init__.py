@@ -0,0 +1 @@
+# Benchmarks for the backend queries and routes
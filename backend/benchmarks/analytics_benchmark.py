@@ -0,0 +1,135 @@
+# Compare Python loops with the NumPy arrays of analytics.py for the
+# advanced player metrics, and a full season reload with the partial
+# refresh that follows a write
+#
+#   cd backend && python -m benchmarks.analytics_benchmark --players-per-team 100
+import argparse
+import bisect
+import math
+import os
+import statistics
+import time
+
+import analytics
+import database as db
+import migrations
+from benchmarks.synthetic import (generate_league, create_schema_engine,
+                                  drop_schema, load_league)
+
+
+def python_player_metrics(players, lines, min_games=None):
+    '''
+    Per game averages, efficiency, z-scores and percentiles of every
+    player computed row by row, as analytics.player_metrics does with arrays
+    '''
+    (player_ids, player_teams, names) = players
+    totals = {}
+    for line in lines.tolist():
+        entry = totals.setdefault(line[0], [0, 0, 0, 0, 0, 0])
+        entry[0] += 1
+        for k in range(5):
+            entry[k + 1] += line[k + 2]
+
+    measures = {}
+    for (player_id, entry) in totals.items():
+        averages = [value / entry[0] for value in entry[1:]]
+        measures[player_id] = (entry[0], averages + [sum(averages)])
+    if min_games is None:
+        min_games = max(1, math.ceil(max(games for (games, _) in measures.values()) / 2))
+    population = [values for (games, values) in measures.values() if games >= min_games]
+    columns = [sorted(values[k] for values in population) for k in range(6)]
+    means = [statistics.fmean(column) for column in columns]
+    spreads = [statistics.pstdev(column) for column in columns]
+
+    metrics = {}
+    for (player_id, (games, values)) in measures.items():
+        metrics[player_id] = {
+            "games": games,
+            "efficiency": values[5],
+            "z_scores": [(values[k] - means[k]) / spreads[k] if spreads[k] else 0.0
+                         for k in range(5)],
+            "percentiles": [bisect.bisect_right(columns[k], values[k]) * 100.0 / len(population)
+                            for k in range(6)]
+        }
+    return metrics
+
+
+def best_of(repeat, function):
+    '''
+    Milliseconds of the fastest of repeat calls
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    '''
+    Load a synthetic league into its own schema and time each variant
+    '''
+    parser = argparse.ArgumentParser(
+        description="Compare Python loops with NumPy arrays for the advanced metrics")
+    parser.add_argument("--db-uri", default=os.getenv("BENCH_DB_URI", db.db_uri))
+    parser.add_argument("--schema", default="bench_analytics")
+    parser.add_argument("--teams", type=int, default=30)
+    parser.add_argument("--players-per-team", type=int, default=100)
+    parser.add_argument("--games-per-team", type=int, default=82)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+    if analytics.np is None:
+        raise SystemExit("The advanced metrics require numpy (pip install numpy)")
+
+    league = generate_league(args.teams, args.players_per_team, args.games_per_team)
+    print("League: %d teams, %d players, %d games, %d stat lines" % (
+        len(league["team"]), len(league["player"]),
+        len(league["game"]), len(league["stats"])))
+
+    engine = create_schema_engine(args.db_uri, args.schema)
+    try:
+        load_league(engine, league)
+        db.engine = engine
+        migrations.migrate()
+
+        metrics = analytics.AdvancedMetrics()
+        db.write_listeners.append(metrics.mark_stale)
+        full_load = best_of(args.repeat, lambda: (
+            metrics.mark_stale("stats"), metrics.player_report()))
+        (player_id, game_id) = league["stats"][0][:2]
+        partial_load = best_of(args.repeat, lambda: (
+            db.edit_player_stats(player_id, game_id, 10, 1, 2, 3, 4),
+            metrics.player_report()))
+
+        with metrics.lock:
+            arrays = metrics.season_arrays(None)
+        players = metrics.players
+        loops = best_of(args.repeat, lambda: python_player_metrics(players, arrays.lines))
+        vectorized = best_of(args.repeat, lambda: analytics.player_metrics(players, arrays.lines))
+
+        # Both variants must agree (the app rounds to 3 decimals)
+        expected = python_player_metrics(players, arrays.lines)
+        for row in analytics.player_metrics(players, arrays.lines):
+            reference = expected[row["player_id"]]
+            assert math.isclose(row["efficiency"], reference["efficiency"], abs_tol=1e-3)
+            assert math.isclose(row["percentiles"]["efficiency"],
+                                reference["percentiles"][5], abs_tol=0.1)
+    finally:
+        if not args.keep:
+            drop_schema(engine, args.schema)
+
+    print("%-40s %12s %10s" % ("variant", "ms", "speedup"))
+    for (label, ms, baseline) in [
+            ("metrics with Python loops", loops, loops),
+            ("metrics with NumPy arrays (app)", vectorized, loops),
+            ("full season reload + metrics", full_load, full_load),
+            ("refresh after a write + metrics (app)", partial_load, full_load)]:
+        print("%-40s %12.3f %9.1fx" % (label, ms, baseline / ms))
+
+
+if __name__ == "__main__":
+    main()
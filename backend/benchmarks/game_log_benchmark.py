@@ -0,0 +1,173 @@
+# Compare the "last N games" form read from the team_form and player_form
+# tables with computing it from the game history on every request, the
+# past games query with UNION and with UNION ALL, and what the form
+# triggers add to a write
+#
+#   cd backend && python -m benchmarks.game_log_benchmark --seasons 3
+import argparse
+import os
+import time
+
+import database as db
+import migrations
+from benchmarks.synthetic import (generate_league, create_schema_engine,
+                                  drop_schema, load_league)
+
+# Form of a team computed from all its games of the season per request
+team_history_query = """
+PREPARE bench_team_history (int) AS
+WITH r AS (
+    SELECT x.scored, x.allowed, x.scored > x.allowed AS won,
+        ROW_NUMBER() OVER (ORDER BY x.date DESC, x.game_id DESC) AS recent
+    FROM (
+        SELECT game_id, date, home_score AS scored, away_score AS allowed
+        FROM game
+        WHERE home_team_id = $1 AND season = (SELECT current_season())
+            AND home_score IS NOT NULL AND away_score IS NOT NULL
+        UNION ALL
+        SELECT game_id, date, away_score, home_score
+        FROM game
+        WHERE away_team_id = $1 AND season = (SELECT current_season())
+            AND home_score IS NOT NULL AND away_score IS NOT NULL
+    ) x
+)
+SELECT COUNT(*) FILTER (WHERE recent <= %(form_games)d),
+    COUNT(*) FILTER (WHERE recent <= %(form_games)d AND won),
+    SUM(scored) FILTER (WHERE recent <= %(form_games)d),
+    SUM(allowed) FILTER (WHERE recent <= %(form_games)d),
+    COALESCE(MIN(recent) FILTER (WHERE won <> (SELECT won FROM r WHERE recent = 1)),
+             COUNT(*) + 1) - 1
+FROM r
+""" % {"form_games": db.form_games}
+
+# Form of a player computed from all their stat lines of the season per request
+player_history_query = """
+PREPARE bench_player_history (int) AS
+SELECT COUNT(*), SUM(r.points), SUM(r.assists), SUM(r.rebounds), SUM(r.blocks), SUM(r.steals)
+FROM (
+    SELECT s.points, s.assists, s.rebounds, s.blocks, s.steals
+    FROM stats s
+        JOIN game g ON g.game_id = s.game_id AND g.season = s.season
+    WHERE s.player_id = $1 AND s.season = (SELECT current_season())
+    ORDER BY g.date DESC, g.game_id DESC
+    LIMIT %(form_games)d
+) r
+""" % {"form_games": db.form_games}
+
+# The past games query as it was before, deduplicating its two halves
+past_games_union_query = "PREPARE bench_past_games_union (int, int) AS " + \
+    db.past_games_select.replace("UNION ALL", "UNION").replace("ORDER BY date\n", "")
+
+
+def time_requests(cursor, name, prepare_query, params_list, repeat):
+    '''
+    Average milliseconds per execution of a prepared statement over
+    every parameter tuple of params_list
+    '''
+    for params in params_list:
+        db.execute_prepared(cursor, name, prepare_query, params)
+        cursor.fetchall()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for params in params_list:
+            db.execute_prepared(cursor, name, prepare_query, params)
+            cursor.fetchall()
+    return (time.perf_counter() - start) * 1000 / (repeat * len(params_list))
+
+
+def time_writes(conn, box_scores, repeat):
+    '''
+    Average milliseconds per box score written again, with the game's
+    score, in its own transaction
+    '''
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for (game_id, rows) in box_scores:
+            db.upsert_stats_rows(cursor, rows)
+            cursor.execute("UPDATE game SET home_score = home_score WHERE game_id = %s",
+                           (game_id,))
+            conn.commit()
+    cursor.close()
+    return (time.perf_counter() - start) * 1000 / (repeat * len(box_scores))
+
+
+def main():
+    '''
+    Load a synthetic league into its own schema and time each variant
+    '''
+    parser = argparse.ArgumentParser(
+        description="Compare stored recent form with computing it per request")
+    parser.add_argument("--db-uri", default=os.getenv("BENCH_DB_URI", db.db_uri))
+    parser.add_argument("--schema", default="bench_game_log")
+    parser.add_argument("--teams", type=int, default=30)
+    parser.add_argument("--players-per-team", type=int, default=15)
+    parser.add_argument("--games-per-team", type=int, default=82)
+    parser.add_argument("--seasons", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+
+    league = generate_league(args.teams, args.players_per_team, args.games_per_team,
+                             seasons=args.seasons)
+    print("League: %d teams, %d players, %d games, %d stat lines" % (
+        len(league["team"]), len(league["player"]),
+        len(league["game"]), len(league["stats"])))
+
+    engine = create_schema_engine(args.db_uri, args.schema)
+    try:
+        load_league(engine, league)
+        db.engine = engine
+        migrations.migrate()
+
+        conn = engine.raw_connection()
+        cursor = conn.cursor()
+        teams = [(team_id,) for (team_id, _, _) in league["team"]]
+        players = [(row[0],) for row in league["player"]]
+        results = [
+            ("past games, UNION", time_requests(
+                cursor, "bench_past_games_union", past_games_union_query,
+                [team + (None,) for team in teams], args.repeat)),
+            ("past games, UNION ALL (app)", time_requests(
+                cursor, "get_past_games", "PREPARE get_past_games (int, int) AS "
+                + db.past_games_select, [team + (None,) for team in teams], args.repeat)),
+            ("team form from game history", time_requests(
+                cursor, "bench_team_history", team_history_query, teams, args.repeat)),
+            ("team form from team_form (app)", time_requests(
+                cursor, "get_team_form", "PREPARE get_team_form (int, int) AS "
+                + db.team_form_select, [team + (None,) for team in teams], args.repeat)),
+            ("player form from stat lines", time_requests(
+                cursor, "bench_player_history", player_history_query, players,
+                args.repeat)),
+            ("player form from player_form (app)", time_requests(
+                cursor, "get_player_form", "PREPARE get_player_form (int, int) AS "
+                + db.player_form_select, [player + (None,) for player in players],
+                args.repeat))]
+        cursor.close()
+
+        # Write the latest box scores again, with and without the form triggers
+        latest = sorted({row[1] for row in league["stats"]})[-args.teams // 2:]
+        box_scores = [(game_id, [(row[0], row[1]) + tuple(row[3:]) for row in league["stats"]
+                                 if row[1] == game_id]) for game_id in latest]
+        with_triggers = time_writes(conn, box_scores, 5)
+        cursor = conn.cursor()
+        cursor.execute("ALTER TABLE stats DISABLE TRIGGER stats_form")
+        cursor.execute("ALTER TABLE game DISABLE TRIGGER game_form")
+        conn.commit()
+        without_triggers = time_writes(conn, box_scores, 5)
+        cursor.close()
+        conn.close()
+    finally:
+        if not args.keep:
+            drop_schema(engine, args.schema)
+
+    print("%-40s %12s" % ("variant", "ms/request"))
+    for (label, ms) in results:
+        print("%-40s %12.3f" % (label, ms))
+    print("%-40s %12.3f" % ("box score write, form triggers off", without_triggers))
+    print("%-40s %12.3f" % ("box score write, form triggers on (app)", with_triggers))
+
+
+if __name__ == "__main__":
+    main()
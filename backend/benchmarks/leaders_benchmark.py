@@ -0,0 +1,153 @@
+# Compare the stats leaders report queries on a synthetic league
+#
+#   cd backend && python -m benchmarks.leaders_benchmark --teams 30 --players-per-team 100
+import argparse
+import os
+import time
+
+import database as db
+import migrations
+from benchmarks.synthetic import (generate_league, create_schema_engine,
+                                  drop_schema, load_league)
+
+# Five UNIONed subqueries over every stat line (the original report)
+legacy_leaders_query = """
+PREPARE legacy_leaders (int) AS
+""" + "UNION".join("""
+SELECT '{cat}' AS stat_category, temp.player_name
+FROM (
+    SELECT
+        MAX(CONCAT(p.first_name, ' ', p.last_name)) AS player_name,
+        ROUND(AVG(s.{col}), 1) AS {cat}
+    FROM player p
+        JOIN stats s ON p.player_id = s.player_id
+    WHERE p.team_id = $1
+    GROUP BY p.player_id
+    ORDER BY {cat} DESC
+    LIMIT 1
+) temp
+""".format(cat=cat, col=col) for (cat, col) in [
+    ("PPG", "points"), ("APG", "assists"), ("RPG", "rebounds"),
+    ("BPG", "blocks"), ("SPG", "steals")])
+
+# Single aggregation over stat lines ranked in one pass
+single_pass_stats_query = """
+PREPARE single_pass_stats (int, int) AS
+WITH averages AS (
+    SELECT
+        p.player_id,
+        MAX(CONCAT(p.first_name, ' ', p.last_name)) AS player_name,
+        AVG(s.points) AS ppg,
+        AVG(s.assists) AS apg,
+        AVG(s.rebounds) AS rpg,
+        AVG(s.blocks) AS bpg,
+        AVG(s.steals) AS spg
+    FROM player p
+        JOIN stats s ON p.player_id = s.player_id
+    WHERE p.team_id = $1
+    GROUP BY p.player_id
+),
+ranked AS (
+    SELECT
+        c.category_order,
+        c.stat_category,
+        a.player_name,
+        ROUND(c.average, 1) AS average,
+        ROW_NUMBER() OVER (
+            PARTITION BY c.category_order
+            ORDER BY c.average DESC, a.player_id
+        ) AS rank
+    FROM averages a
+        CROSS JOIN LATERAL (VALUES
+            (1, 'PPG', a.ppg), (2, 'APG', a.apg), (3, 'RPG', a.rpg),
+            (4, 'BPG', a.bpg), (5, 'SPG', a.spg)
+        ) AS c (category_order, stat_category, average)
+)
+SELECT stat_category, rank, player_name, average
+FROM ranked
+WHERE rank <= $2
+ORDER BY category_order, rank;
+"""
+
+# (label, PREPARE text, EXECUTE text) for each variant
+variants = [
+    ("legacy 5x UNION over stats", legacy_leaders_query,
+     "EXECUTE legacy_leaders(%s)"),
+    ("single pass over stats", single_pass_stats_query,
+     "EXECUTE single_pass_stats(%s, 1)"),
+    ("single pass over totals (app)", db.stats_leaders_query,
+     "EXECUTE get_stats_leaders(%s, NULL, 1)")
+]
+
+
+def time_variant(cursor, prepare_query, execute_query, team_ids, repeat):
+    '''
+    Average milliseconds per call of a prepared leaders query
+    '''
+    cursor.execute(prepare_query)
+    # Warm up caches and the plan
+    for team_id in team_ids:
+        cursor.execute(execute_query, (team_id,))
+        cursor.fetchall()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for team_id in team_ids:
+            cursor.execute(execute_query, (team_id,))
+            cursor.fetchall()
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000 / (repeat * len(team_ids))
+
+
+def main():
+    '''
+    Load a synthetic league into its own schema and time each variant
+    '''
+    parser = argparse.ArgumentParser(
+        description="Compare the stats leaders report queries")
+    parser.add_argument("--db-uri", default=os.getenv("BENCH_DB_URI", db.db_uri))
+    parser.add_argument("--schema", default="bench_leaders")
+    parser.add_argument("--teams", type=int, default=30)
+    parser.add_argument("--players-per-team", type=int, default=100)
+    parser.add_argument("--games-per-team", type=int, default=82)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+
+    league = generate_league(args.teams, args.players_per_team, args.games_per_team)
+    print("League: %d teams, %d players, %d games, %d stat lines" % (
+        len(league["team"]), len(league["player"]),
+        len(league["game"]), len(league["stats"])))
+
+    engine = create_schema_engine(args.db_uri, args.schema)
+    try:
+        load_league(engine, league)
+        # Partitions, aggregate tables and indexes of the app
+        db.engine = engine
+        migrations.migrate()
+        conn = engine.raw_connection()
+        cursor = conn.cursor()
+        conn.autocommit = True
+        cursor.execute("ANALYZE")
+
+        team_ids = [row[0] for row in league["team"]]
+        results = []
+        for (label, prepare_query, execute_query) in variants:
+            ms = time_variant(cursor, prepare_query, execute_query,
+                              team_ids, args.repeat)
+            results.append((label, ms))
+        cursor.close()
+        conn.close()
+    finally:
+        if not args.keep:
+            drop_schema(engine, args.schema)
+
+    baseline = results[0][1]
+    print("%-32s %12s %10s" % ("query", "ms / call", "speedup"))
+    for (label, ms) in results:
+        print("%-32s %12.3f %9.1fx" % (label, ms, baseline / ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# Compare ORM objects with plain column rows for the list endpoints
+#
+#   cd backend && python -m benchmarks.list_benchmark --seasons 3
+#
+# Each variant reads a whole table and encodes it as the JSON body of its
+# list endpoint. CPU time and peak Python memory are reported per row.
+import argparse
+import os
+import time
+import tracemalloc
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import database as db
+import serialization
+from models import Stats, Game
+from benchmarks.synthetic import (generate_league, create_schema_engine,
+                                  drop_schema, load_league)
+
+
+def stat_to_dict(stat):
+    return {
+        "player_id": stat.player_id,
+        "game_id": stat.game_id,
+        "points": stat.points,
+        "assists": stat.assists,
+        "rebounds": stat.rebounds,
+        "blocks": stat.blocks,
+        "steals": stat.steals
+    }
+
+
+def game_to_dict(game):
+    return {
+        "game_id": game.game_id,
+        "date": (game.date).strftime("%m/%d/%y"),
+        "time": (game.time).strftime("%H:%M:%S"),
+        "location": game.location,
+        "home_team_id": game.home_team_id,
+        "home_score": game.home_score,
+        "away_team_id": game.away_team_id,
+        "away_score": game.away_score
+    }
+
+
+def orm_rows(engine, model, to_dict):
+    '''
+    Rows the way the list endpoints used to build them: ORM objects
+    copied attribute by attribute into dicts
+    '''
+    with Session(engine) as session:
+        return [to_dict(row) for row in session.query(model).all()]
+
+
+# (table, model, ORM serializer, Core columns of the app)
+tables = [
+    ("stats", Stats, stat_to_dict, db.stats_list_columns),
+    ("game", Game, game_to_dict, db.game_list_columns)
+]
+
+
+def variants(engine, std_json, fast_json):
+    '''
+    (label, build(model, to_dict, columns) -> JSON text) for each variant
+    '''
+    return [
+        ("ORM objects + json",
+         lambda model, to_dict, columns: std_json.dumps(
+             orm_rows(engine, model, to_dict), separators=(",", ":"))),
+        ("Core rows + json",
+         lambda model, to_dict, columns: std_json.dumps(
+             db.read_rows(select(*columns)), separators=(",", ":"))),
+        ("Core rows + orjson (app)",
+         lambda model, to_dict, columns: fast_json.dumps(
+             db.read_rows(select(*columns)), separators=(",", ":")))
+    ]
+
+
+def measure(build, model, to_dict, columns, repeat):
+    '''
+    CPU seconds of the fastest of repeat runs, and peak traced memory
+    in bytes of one more run
+    '''
+    cpu = None
+    for _ in range(repeat):
+        start = time.process_time()
+        body = build(model, to_dict, columns)
+        elapsed = time.process_time() - start
+        cpu = elapsed if cpu is None else min(cpu, elapsed)
+
+    tracemalloc.start()
+    build(model, to_dict, columns)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (cpu, peak, len(body))
+
+
+def main():
+    '''
+    Load a synthetic league into its own schema and time each variant
+    '''
+    parser = argparse.ArgumentParser(
+        description="Compare ORM objects with plain rows for the list endpoints")
+    parser.add_argument("--db-uri", default=os.getenv("BENCH_DB_URI", db.db_uri))
+    parser.add_argument("--schema", default="bench_lists")
+    parser.add_argument("--teams", type=int, default=30)
+    parser.add_argument("--players-per-team", type=int, default=15)
+    parser.add_argument("--games-per-team", type=int, default=82)
+    parser.add_argument("--seasons", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+
+    league = generate_league(args.teams, args.players_per_team, args.games_per_team,
+                             seasons=args.seasons)
+    print("League: %d teams, %d players, %d games, %d stat lines" % (
+        len(league["team"]), len(league["player"]),
+        len(league["game"]), len(league["stats"])))
+    if serialization.orjson is None:
+        print("orjson is not installed, the app variant falls back to json")
+
+    app = Flask(__name__)
+    std_json = DefaultJSONProvider(app)
+    fast_json = serialization.FastJSONProvider(app)
+
+    engine = create_schema_engine(args.db_uri, args.schema)
+    # The app's read functions use the benchmark schema
+    db.engine = engine
+    try:
+        load_league(engine, league)
+        results = []
+        for (table, model, to_dict, columns) in tables:
+            rows = len(league[table])
+            for (label, build) in variants(engine, std_json, fast_json):
+                (cpu, peak, size) = measure(build, model, to_dict, columns, args.repeat)
+                results.append((table, rows, label, cpu, peak))
+    finally:
+        if not args.keep:
+            drop_schema(engine, args.schema)
+
+    print("%-6s %8s %-26s %10s %10s %10s" % (
+        "table", "rows", "variant", "us / row", "KB peak", "B / row"))
+    for (table, rows, label, cpu, peak) in results:
+        print("%-6s %8d %-26s %10.2f %10.0f %10.0f" % (
+            table, rows, label, cpu * 1e6 / rows, peak / 1024, peak / rows))
+
+
+if __name__ == "__main__":
+    main()
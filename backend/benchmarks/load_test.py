@@ -0,0 +1,351 @@
+# Load test every API route and compare the results with a saved baseline
+#
+#   cd backend && python -m benchmarks.load_test --concurrency 8 --requests 200
+#   cd backend && python -m benchmarks.load_test --save-baseline benchmarks/baselines/load_test.json
+#   cd backend && python -m benchmarks.load_test --compare benchmarks/baselines/load_test.json
+#
+# By default a synthetic league is loaded into its own schema and the Flask
+# app is driven in this process against it, which also counts the database
+# queries each request sends. With --url an already running server is
+# driven over HTTP instead (its own data is used and queries are not counted).
+#
+# The app relies on PostgreSQL (plpgsql triggers, prepared statements), so
+# the league is always loaded into PostgreSQL rather than SQLite.
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+from benchmarks.synthetic import (generate_league, create_schema_engine,
+                                  drop_schema, load_league)
+
+
+#######################
+## Clients           ##
+#######################
+
+class AppClient:
+    '''
+    Drive the Flask app in this process, one test client per thread
+    '''
+    counts_queries = True
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body)
+        return (response.status_code, response.get_data())
+
+
+class HttpClient:
+    '''
+    Drive a running server over HTTP
+    '''
+    counts_queries = False
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return (response.status, response.read())
+        except urllib.error.HTTPError as error:
+            return (error.code, error.read())
+
+
+#######################
+## Endpoints         ##
+#######################
+
+class Fixtures:
+    '''
+    Ids and stat lines read from the API, used to build valid requests
+    '''
+    def __init__(self, client):
+        (status, body) = client.request("GET", "/team/get_teams")
+        self.team_ids = [team["team_id"] for team in json.loads(body)]
+        (status, body) = client.request("GET", "/stats/get_stats?limit=5000")
+        self.stat_lines = json.loads(body)
+        self.box_scores = {}
+        for line in self.stat_lines:
+            self.box_scores.setdefault(line["game_id"], []).append(line)
+        self.game_ids = list(self.box_scores)
+        if not self.team_ids or not self.stat_lines:
+            raise SystemExit("The database has no teams or stat lines to load test")
+
+
+def endpoints(fixtures, rng):
+    '''
+    (name, build) for every route, where build() returns the
+    (method, path, body, restore) of one request. restore is an
+    optional request sent afterwards (untimed) to undo a write.
+    '''
+    def team():
+        return rng.choice(fixtures.team_ids)
+
+    def line():
+        return dict(rng.choice(fixtures.stat_lines))
+
+    def delete_stats():
+        stat = line()
+        key = {"player_id": stat["player_id"], "game_id": stat["game_id"]}
+        return ("DELETE", "/stats/delete_stats", key,
+                ("POST", "/stats/add_stats", stat))
+
+    return [
+        ("GET /stats/get_stats", lambda: (
+            "GET", "/stats/get_stats?limit=100&team_id=%d" % team(), None, None)),
+        ("GET /stats/get_stats (player, desc)", lambda: (
+            "GET", "/stats/get_stats?limit=100&sort=desc&player_id=%d" % line()["player_id"],
+            None, None)),
+        ("GET /player/get_players", lambda: ("GET", "/player/get_players", None, None)),
+        ("GET /game/get_games", lambda: ("GET", "/game/get_games", None, None)),
+        ("GET /team/get_teams", lambda: ("GET", "/team/get_teams", None, None)),
+        ("GET /report/get_record", lambda: (
+            "GET", "/report/get_record?team_id=%d" % team(), None, None)),
+        ("GET /report/get_past_games", lambda: (
+            "GET", "/report/get_past_games?team_id=%d" % team(), None, None)),
+        ("GET /report/get_roster", lambda: (
+            "GET", "/report/get_roster?team_id=%d" % team(), None, None)),
+        ("GET /report/get_stats_leaders", lambda: (
+            "GET", "/report/get_stats_leaders?team_id=%d&top=3" % team(), None, None)),
+        ("GET /report/team_dashboard", lambda: (
+            "GET", "/report/team_dashboard?team_id=%d" % team(), None, None)),
+        ("GET /report/standings", lambda: ("GET", "/report/standings", None, None)),
+        ("GET /report/league_leaders", lambda: (
+            "GET", "/report/league_leaders?top=5", None, None)),
+        ("GET /report/team_game_log", lambda: (
+            "GET", "/report/team_game_log?team_id=%d" % team(), None, None)),
+        ("GET /report/player_game_log", lambda: (
+            "GET", "/report/player_game_log?player_id=%d" % line()["player_id"], None, None)),
+        # Needs numpy, answers 501 without it
+        ("GET /report/advanced", lambda: (
+            "GET", "/report/advanced?team_id=%d" % team(), None, None)),
+        ("GET /report/advanced/teams", lambda: (
+            "GET", "/report/advanced/teams", None, None)),
+        # Writes put back the values already stored, so the data does not drift
+        ("POST /stats/add_stats", lambda: ("POST", "/stats/add_stats", line(), None)),
+        ("PUT /stats/edit_stats", lambda: ("PUT", "/stats/edit_stats", line(), None)),
+        ("DELETE /stats/delete_stats", delete_stats),
+        ("POST /stats/bulk_add", lambda: (
+            "POST", "/stats/bulk_add",
+            {"stats": fixtures.box_scores[rng.choice(fixtures.game_ids)], "upsert": True},
+            None))
+    ]
+
+
+#######################
+## Measurements      ##
+#######################
+
+def percentile(sorted_values, percent):
+    '''
+    Nearest-rank percentile of an already sorted list
+    '''
+    if not sorted_values:
+        return None
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def run_endpoint(client, build, requests, concurrency):
+    '''
+    Send requests to one endpoint from concurrency threads and
+    summarize latency, throughput, errors and queries per request
+    '''
+    latencies = []
+    queries = []
+    errors = []
+    lock = threading.Lock()
+    requests_list = [build() for _ in range(requests)]
+
+    def send(request):
+        (method, path, body, restore) = request
+        before = db.get_query_count()
+        start = time.perf_counter()
+        (status, data) = client.request(method, path, body)
+        elapsed = time.perf_counter() - start
+        count = db.get_query_count() - before
+        if restore is not None:
+            client.request(*restore)
+        with lock:
+            latencies.append(elapsed * 1000)
+            queries.append(count)
+            if status >= 400:
+                errors.append(status)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, requests_list))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": len(errors),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "rps": round(requests / wall, 1),
+        "queries_per_request": (round(sum(queries) / len(queries), 2)
+                                if client.counts_queries else None)
+    }
+
+
+def compare(results, baseline, threshold, min_delta_ms):
+    '''
+    List the regressions of results against a baseline: p95 latency more
+    than threshold percent and min_delta_ms slower, or more queries per
+    request. Fractions of a query come from connections that skipped the
+    pool's ping, so only a difference of half a query or more counts.
+    '''
+    regressions = []
+    for (name, result) in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        if (result["p95_ms"] > base["p95_ms"] * (1 + threshold / 100)
+                and result["p95_ms"] - base["p95_ms"] > min_delta_ms):
+            regressions.append("%s: p95 %.3f ms, baseline %.3f ms"
+                               % (name, result["p95_ms"], base["p95_ms"]))
+        if (result["queries_per_request"] is not None
+                and base.get("queries_per_request") is not None
+                and result["queries_per_request"] >= base["queries_per_request"] + 0.5):
+            regressions.append("%s: %.2f queries per request, baseline %.2f"
+                               % (name, result["queries_per_request"],
+                                  base["queries_per_request"]))
+    return regressions
+
+
+def print_results(results):
+    print("%-34s %8s %6s %10s %10s %10s %9s %8s" % (
+        "endpoint", "requests", "errors", "p50 ms", "p95 ms", "p99 ms", "req/s", "queries"))
+    for (name, result) in results.items():
+        queries = result["queries_per_request"]
+        print("%-34s %8d %6d %10.3f %10.3f %10.3f %9.1f %8s" % (
+            name, result["requests"], result["errors"], result["p50_ms"],
+            result["p95_ms"], result["p99_ms"], result["rps"],
+            "-" if queries is None else "%.2f" % queries))
+
+
+def schema_uri(db_uri, schema):
+    '''
+    Add a search_path to a database URI so its connections only see the schema
+    '''
+    separator = "&" if "?" in db_uri else "?"
+    return "%s%soptions=-csearch_path%%3D%s" % (db_uri, separator, schema)
+
+
+def main():
+    '''
+    Load a synthetic league (unless --url is given), drive every
+    endpoint in turn and report, save or compare the results
+    '''
+    parser = argparse.ArgumentParser(description="Load test the backend API")
+    parser.add_argument("--url", help="drive a running server instead of the app in this process")
+    parser.add_argument("--db-uri", default=os.getenv("BENCH_DB_URI", db.db_uri))
+    parser.add_argument("--schema", default="bench_load")
+    parser.add_argument("--teams", type=int, default=30)
+    parser.add_argument("--players-per-team", type=int, default=15)
+    parser.add_argument("--games-per-team", type=int, default=82)
+    parser.add_argument("--seasons", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests sent to each endpoint")
+    parser.add_argument("--endpoint", action="append",
+                        help="only run endpoints whose name contains this (repeatable)")
+    parser.add_argument("--report-cache", action="store_true",
+                        help="keep the report cache on (by default every report hits the database)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=50,
+                        help="percent of p95 slowdown reported as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=10,
+                        help="smallest p95 slowdown in ms reported as a regression")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in (
+        "teams", "players_per_team", "games_per_team", "seasons",
+        "concurrency", "requests", "report_cache", "seed")}
+    engine = None
+    if args.url is None:
+        league = generate_league(args.teams, args.players_per_team,
+                                 args.games_per_team, seed=args.seed,
+                                 seasons=args.seasons)
+        print("League: %d teams, %d players, %d games, %d stat lines" % (
+            len(league["team"]), len(league["player"]),
+            len(league["game"]), len(league["stats"])), file=sys.stderr)
+        engine = create_schema_engine(args.db_uri, args.schema)
+        load_league(engine, league)
+        # The app reads its settings when it is imported
+        db.db_uri = schema_uri(args.db_uri, args.schema)
+        if not args.report_cache:
+            os.environ["REPORT_CACHE"] = "off"
+        # Triggers and indexes of the benchmark schema
+        import migrations
+        migrations.migrate()
+        from app import app
+        client = AppClient(app)
+    else:
+        client = HttpClient(args.url)
+
+    try:
+        rng = random.Random(args.seed)
+        fixtures = Fixtures(client)
+        results = {}
+        for (name, build) in endpoints(fixtures, rng):
+            if args.endpoint and not any(part in name for part in args.endpoint):
+                continue
+            # Warm up plans, prepared statements and the pool
+            run_endpoint(client, build, min(args.requests, args.concurrency * 2),
+                         args.concurrency)
+            results[name] = run_endpoint(client, build, args.requests, args.concurrency)
+            print("%s done" % name, file=sys.stderr)
+    finally:
+        if engine is not None and not args.keep:
+            if db.engine is not None:
+                db.engine.dispose()
+            drop_schema(engine, args.schema)
+
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+            f.write("\n")
+        print("Baseline saved to %s" % args.save_baseline)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("Warning: baseline was recorded with %s" % baseline.get("config"))
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against %s" % args.compare)
+
+
+if __name__ == "__main__":
+    main()
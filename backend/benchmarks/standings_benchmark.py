@@ -0,0 +1,137 @@
+# Compare league standings and leaders computed per team against the
+# single statements behind /report/standings and /report/league_leaders
+#
+#   cd backend && python -m benchmarks.standings_benchmark --teams 30 --players-per-team 15
+import argparse
+import os
+import time
+
+import database as db
+import migrations
+from benchmarks.synthetic import (generate_league, create_schema_engine,
+                                  drop_schema, load_league)
+
+record_query = """
+PREPARE bench_record (int) AS
+SELECT wins, losses, points_for - points_against
+FROM team_standings
+WHERE team_id = $1 AND season = (SELECT current_season());
+"""
+
+
+def per_team_loop(engine, team_ids, top_n):
+    '''
+    Build the standings and league leaders the way a client of the per-team
+    reports would: a pool checkout and two queries per team, merged in Python
+    '''
+    records = []
+    leaders = {}
+    for team_id in team_ids:
+        conn = engine.raw_connection()
+        cursor = conn.cursor()
+        db.execute_prepared(cursor, "bench_record", record_query, (team_id,))
+        (wins, losses, differential) = cursor.fetchone() or (0, 0, 0)
+        records.append((team_id, wins, losses, differential))
+        db.execute_prepared(cursor, "get_stats_leaders", db.stats_leaders_query,
+                            (team_id, None, top_n))
+        for (stat_category, rank, player_name, average) in cursor.fetchall():
+            leaders.setdefault(stat_category, []).append((average, player_name))
+        cursor.close()
+        conn.close()
+
+    best = max(wins - losses for (team_id, wins, losses, differential) in records)
+    standings = sorted(
+        ((team_id, wins, losses,
+          wins / (wins + losses) if wins + losses else None,
+          (best - (wins - losses)) / 2, differential)
+         for (team_id, wins, losses, differential) in records),
+        key=lambda row: (-(row[3] or 0), -row[5], row[0]))
+    for category in leaders:
+        leaders[category] = sorted(leaders[category], reverse=True)[:top_n]
+    return (standings, leaders)
+
+
+def single_statements(engine, team_ids, top_n):
+    '''
+    Build the standings and league leaders with the application's
+    two set-based statements on one connection
+    '''
+    conn = engine.raw_connection()
+    cursor = conn.cursor()
+    db.execute_prepared(cursor, "get_league_standings",
+                        db.league_standings_query, (None,))
+    standings = cursor.fetchall()
+    db.execute_prepared(cursor, "get_league_leaders",
+                        db.league_leaders_query, (None, top_n))
+    leaders = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return (standings, leaders)
+
+
+def time_variant(build, engine, team_ids, top_n, repeat):
+    '''
+    Average milliseconds per full standings and leaders build
+    '''
+    # Warm up caches and the connection pool
+    build(engine, team_ids, top_n)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        build(engine, team_ids, top_n)
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000 / repeat
+
+
+def main():
+    '''
+    Load a synthetic league into its own schema and time each variant
+    '''
+    parser = argparse.ArgumentParser(
+        description="Compare per-team and league-wide standings and leaders")
+    parser.add_argument("--db-uri", default=os.getenv("BENCH_DB_URI", db.db_uri))
+    parser.add_argument("--schema", default="bench_standings")
+    parser.add_argument("--teams", type=int, default=30)
+    parser.add_argument("--players-per-team", type=int, default=15)
+    parser.add_argument("--games-per-team", type=int, default=82)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+
+    league = generate_league(args.teams, args.players_per_team, args.games_per_team)
+    print("League: %d teams, %d players, %d games, %d stat lines" % (
+        len(league["team"]), len(league["player"]),
+        len(league["game"]), len(league["stats"])))
+
+    engine = create_schema_engine(args.db_uri, args.schema)
+    try:
+        load_league(engine, league)
+        # Partitions, aggregate tables and indexes of the app
+        db.engine = engine
+        migrations.migrate()
+        conn = engine.raw_connection()
+        cursor = conn.cursor()
+        conn.autocommit = True
+        cursor.execute("ANALYZE")
+        cursor.close()
+        conn.close()
+
+        team_ids = [row[0] for row in league["team"]]
+        results = []
+        for (label, build) in [("per-team loop", per_team_loop),
+                               ("league-wide statements (app)", single_statements)]:
+            ms = time_variant(build, engine, team_ids, args.top, args.repeat)
+            results.append((label, ms))
+    finally:
+        if not args.keep:
+            drop_schema(engine, args.schema)
+
+    baseline = results[0][1]
+    print("%-32s %12s %10s" % ("variant", "ms / build", "speedup"))
+    for (label, ms) in results:
+        print("%-32s %12.3f %9.1fx" % (label, ms, baseline / ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Generate and load a synthetic league for benchmarks
+import io
+import random
+from datetime import date, timedelta
+
+import sqlalchemy
+from models import Base
+from database import season_of, reset_game_id_sequence
+
+first_names = ["James", "Chris", "Kevin", "Luka", "Nikola", "Jalen", "Devin",
+               "Jayson", "Anthony", "Tyrese", "Darius", "Zach", "Coby", "Josh"]
+last_names = ["Williams", "Johnson", "Brown", "Davis", "Miller", "Wilson",
+              "Moore", "Taylor", "Thomas", "Jackson", "White", "Harris"]
+positions = ["PG", "SG", "SF", "PF", "C"]
+
+
+def generate_league(teams=30, players_per_team=15, games_per_team=82,
+                    start=date(2023, 10, 24), seed=0, seasons=1):
+    '''
+    Generate rows for the team, player, game and stats tables shaped like
+    the sample data, returned as a dict of lists of tuples in column order.
+    Each of the seasons has games_per_team games per team, starting one
+    year after the previous one.
+    '''
+    rng = random.Random(seed)
+
+    team_rows = [(team_id, "Team %d" % team_id, "Coach %d" % team_id)
+                 for team_id in range(1, teams + 1)]
+
+    player_rows = []
+    roster = {}
+    # Per player scoring profile so averages (and leaders) differ
+    profile = {}
+    for team_id in range(1, teams + 1):
+        roster[team_id] = []
+        for jersey in range(players_per_team):
+            player_id = len(player_rows) + 1
+            player_rows.append((player_id, team_id, rng.choice(first_names),
+                                rng.choice(last_names), rng.choice(positions),
+                                jersey))
+            roster[team_id].append(player_id)
+            profile[player_id] = [rng.uniform(0.2, 1.0) for _ in range(5)]
+
+    game_rows = []
+    stats_rows = []
+    num_games = teams * games_per_team // 2
+    for game_id in range(1, num_games * seasons + 1):
+        home, away = rng.sample(range(1, teams + 1), 2)
+        (season, number) = divmod(game_id - 1, max(num_games, 1))
+        day = start + timedelta(days=season * 365 + (number + 1) * 170 // max(num_games, 1))
+        home_score = rng.randint(85, 135)
+        away_score = rng.randint(85, 135)
+        if home_score == away_score:
+            home_score += 1
+        game_rows.append((game_id, season_of(day), day, "19:00:00", "Arena %d" % home,
+                          home, home_score, away, away_score))
+        for player_id in roster[home] + roster[away]:
+            skill = profile[player_id]
+            stats_rows.append((player_id, game_id, season_of(day),
+                               int(rng.random() * 40 * skill[0]),
+                               int(rng.random() * 12 * skill[1]),
+                               int(rng.random() * 15 * skill[2]),
+                               int(rng.random() * 4 * skill[3]),
+                               int(rng.random() * 4 * skill[4])))
+
+    return {
+        "team": team_rows,
+        "player": player_rows,
+        "game": game_rows,
+        "stats": stats_rows
+    }
+
+
+def create_schema_engine(db_uri, schema):
+    '''
+    Create an engine whose connections only see the given schema,
+    (re)creating it empty with the application's tables, so benchmarks
+    never touch the application's own data
+    '''
+    engine = sqlalchemy.create_engine(
+        db_uri, connect_args={"options": "-csearch_path=%s" % schema})
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+        conn.exec_driver_sql("CREATE SCHEMA %s" % schema)
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+def drop_schema(engine, schema):
+    '''
+    Remove a benchmark schema and everything in it
+    '''
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+    engine.dispose()
+
+
+def copy_rows(cursor, table, rows):
+    '''
+    Load rows into a table with COPY
+    '''
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(str(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert("COPY %s FROM STDIN" % table, buffer)
+
+
+def load_league(engine, league):
+    '''
+    Bulk load a generated league into the engine's schema
+    '''
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for table in ("team", "player", "game", "stats"):
+            copy_rows(cursor, table, league[table])
+        # Rows are copied with their ids, so new ones number on from the last
+        reset_game_id_sequence(cursor)
+        for (table, column) in (("team", "team_id"), ("player", "player_id")):
+            cursor.execute("SELECT setval(pg_get_serial_sequence('%s', '%s'), "
+                           "(SELECT MAX(%s) FROM %s))" % (table, column, column, table))
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
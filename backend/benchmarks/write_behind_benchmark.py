@@ -0,0 +1,113 @@
+# Compare stat writes sent straight to the database with the write-behind
+# queue of write_behind.py, for a stat crew updating the lines of a live game
+#
+#   cd backend && python -m benchmarks.write_behind_benchmark --writers 4 --writes 500
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+import database as db
+import migrations
+import write_behind
+from benchmarks.synthetic import (generate_league, create_schema_engine,
+                                  drop_schema, load_league)
+
+
+def run_writers(writers, writes, lines, write):
+    '''
+    Run write(row) writes times from each of writers threads, each row
+    a random update of one of lines. Returns the seconds taken and the
+    latency of every write in milliseconds.
+    '''
+    latencies = []
+    lock = threading.Lock()
+
+    def writer(seed):
+        rng = random.Random(seed)
+        own = []
+        for _ in range(writes):
+            (player_id, game_id) = rng.choice(lines)
+            row = (player_id, game_id) + tuple(rng.randint(0, 40) for _ in db.stat_columns)
+            start = time.perf_counter()
+            write(row)
+            own.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=writer, args=(seed,)) for seed in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (time.perf_counter() - start, latencies)
+
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    '''
+    Load a synthetic league into its own schema and time each variant
+    '''
+    parser = argparse.ArgumentParser(
+        description="Compare direct stat writes with the write-behind queue")
+    parser.add_argument("--db-uri", default=os.getenv("BENCH_DB_URI", db.db_uri))
+    parser.add_argument("--schema", default="bench_write_behind")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--writes", type=int, default=500,
+                        help="writes per writer")
+    parser.add_argument("--games", type=int, default=1,
+                        help="live games whose lines are updated")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark schema afterwards")
+    args = parser.parse_args()
+
+    league = generate_league(teams=30, players_per_team=15, games_per_team=82)
+    lines = [row[:2] for row in league["stats"] if row[1] <= args.games]
+    print("%d writers x %d writes over the %d stat lines of %d games" % (
+        args.writers, args.writes, len(lines), args.games))
+
+    engine = create_schema_engine(args.db_uri, args.schema)
+    directory = tempfile.mkdtemp()
+    try:
+        load_league(engine, league)
+        db.engine = engine
+        migrations.migrate()
+
+        (direct_seconds, direct) = run_writers(
+            args.writers, args.writes, lines, lambda row: db.upsert_player_stats([row]))
+
+        queue = write_behind.WriteBehindQueue(
+            os.path.join(directory, "queue.sqlite3"), write_behind.batch_size,
+            write_behind.flush_interval, write_behind.max_pending,
+            write_behind.enqueue_timeout)
+        (queued_seconds, queued) = run_writers(args.writers, args.writes, lines, queue.enqueue)
+        drain_start = time.perf_counter()
+        queue.close()
+        drain_seconds = time.perf_counter() - drain_start
+        stats = queue.stats()
+    finally:
+        if not args.keep:
+            drop_schema(engine, args.schema)
+
+    total = args.writers * args.writes
+    print("%-32s %10s %10s %10s %12s" % ("variant", "writes/s", "p50 ms", "p95 ms",
+                                         "transactions"))
+    for (label, seconds, latencies, transactions) in [
+            ("direct", direct_seconds, direct, total),
+            ("write-behind (acknowledged)", queued_seconds, queued, stats["batches"])]:
+        print("%-32s %10.0f %10.3f %10.3f %12d" % (
+            label, total / seconds, statistics.median(latencies),
+            percentile(latencies, 0.95), transactions))
+    print("write-behind: %d writes coalesced, %d lines flushed, %.3f s to drain at close" % (
+        stats["coalesced"], stats["flushed"], drain_seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# Read-through cache for report responses
+#
+# Entries are keyed by the request and by the data versions (see
+# versions.py) of the tables and team the report depends on. A write bumps
+# the versions of the affected teams, so their old entries are never read
+# again and simply age out, while other teams keep their entries.
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    '''
+    In-process cache bounded by a number of entries, where entries
+    also expire ttl seconds after they were stored
+    '''
+    def __init__(self, max_entries=1024, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            (expires, value) = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.evictions += 1
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def size(self):
+        return len(self.entries)
+
+
+class LocalKeyValueStore:
+    '''
+    Stand-in for a shared key-value server, implementing the subset of
+    the Redis client API used by SharedCache (get, setex, incr) in memory
+    '''
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                return None
+            (expires, value) = entry
+            if expires is not None and expires < time.monotonic():
+                del self.values[key]
+                return None
+            return value
+
+    def setex(self, key, ttl, value):
+        with self.lock:
+            self.values[key] = (time.monotonic() + ttl, value)
+
+    def incr(self, key):
+        with self.lock:
+            (expires, value) = self.values.get(key, (None, 0))
+            self.values[key] = (expires, int(value) + 1)
+            return int(value) + 1
+
+    def size(self, prefix=""):
+        with self.lock:
+            return sum(1 for key in self.values if key.startswith(prefix))
+
+
+class SharedCache:
+    '''
+    Cache stored in a key-value server shared by every worker process
+    (a Redis client, or LocalKeyValueStore to emulate one). Expiry and
+    eviction are left to the server.
+    '''
+    def __init__(self, client, ttl=30, prefix="blm:cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value):
+        # Decimals are stored as strings, the same way jsonify sends them
+        self.client.setex(self.prefix + key, self.ttl, json.dumps(value, default=str))
+
+    def size(self):
+        size = getattr(self.client, "size", None)
+        return size(self.prefix) if size is not None else None
+
+
+class ReportCache:
+    '''
+    Read-through cache of report payloads, invalidated per team by writes
+    '''
+    def __init__(self, backend, versions):
+        self.backend = backend
+        self.versions = versions
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def key(self, request_key, team_id, tables):
+        '''
+        Build the cache key of a request whose result depends on
+        the given tables for one team (or all teams if team_id is None)
+        '''
+        return "%s|%s" % (request_key, self.versions.token(tables, team_id))
+
+    def get_or_compute(self, request_key, team_id, tables, compute):
+        '''
+        Return the cached value for a request, computing
+        and storing it on a miss
+        '''
+        key = self.key(request_key, team_id, tables)
+        value = self.backend.get(key)
+        if value is not None:
+            self.count("hits")
+            return value
+        self.count("misses")
+        value = compute()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    async def get_or_compute_async(self, request_key, team_id, tables, compute):
+        '''
+        Same as get_or_compute, for a compute coroutine function
+        '''
+        key = self.key(request_key, team_id, tables)
+        value = self.backend.get(key)
+        if value is not None:
+            self.count("hits")
+            return value
+        self.count("misses")
+        value = await compute()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["evictions"] = self.backend.evictions
+        stats["entries"] = self.backend.size()
+        return stats
+
+
+class NullCache(ReportCache):
+    '''
+    Report cache that never stores anything
+    '''
+    def __init__(self):
+        super().__init__(None, None)
+
+    def get_or_compute(self, request_key, team_id, tables, compute):
+        return compute()
+
+    async def get_or_compute_async(self, request_key, team_id, tables, compute):
+        return await compute()
+
+    def stats(self):
+        return dict(self.counters, evictions=0, entries=0)
+
+
+# Settings of the report cache
+cache_mode = os.getenv("REPORT_CACHE", "memory")
+cache_ttl = int(os.getenv("REPORT_CACHE_TTL", "30"))
+cache_size = int(os.getenv("REPORT_CACHE_SIZE", "1024"))
+cache_url = os.getenv("REPORT_CACHE_URL", "local")
+
+shared_client = None
+
+
+def get_shared_client():
+    '''
+    Get the process-wide client of the shared key-value server
+    (REPORT_CACHE_URL of a Redis server, or "local" for the stand-in)
+    '''
+    global shared_client
+    if shared_client is None:
+        if cache_url == "local":
+            shared_client = LocalKeyValueStore()
+        else:
+            import redis
+            shared_client = redis.Redis.from_url(cache_url)
+    return shared_client
+
+
+def create_report_cache(versions):
+    '''
+    Build the report cache described by the REPORT_CACHE settings:
+    "memory" (default), "shared" or "off"
+    '''
+    if cache_mode == "off":
+        return NullCache()
+    if cache_mode == "shared":
+        return ReportCache(SharedCache(get_shared_client(), cache_ttl), versions)
+    return ReportCache(LRUCache(cache_size, cache_ttl), versions)
@@ -1,22 +1,32 @@
 # Connect to Database and define operations
 import os
+import time
+import datetime
+import functools
+import logging
+import re
+import threading
+import weakref
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import psycopg2
+from psycopg2 import errors
+from psycopg2.extras import execute_values
 import sqlalchemy
-from sqlalchemy import create_engine, insert
+from sqlalchemy import create_engine, insert, event, tuple_, select, func
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 from models import *
-from sample_data.teams import sample_teams
-from sample_data.players import sample_players
-from sample_data.games import sample_games
-from sample_data.stats import sample_stats
 
 
 #####################################
 ## Connect and Initialize Database ##
 #####################################
 
-load_dotenv(dotenv_path='C:/Users/Lexie/BasketballLeagueManager/.env')
+# Settings come from the environment, then from DOTENV_PATH or the
+# .env file at the root of the repository
+load_dotenv(dotenv_path=os.getenv("DOTENV_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, ".env"))
 db_uri = os.getenv("DB_URI")
 database = os.getenv("DATABASE")
 user = os.getenv("USER")
@@ -26,38 +36,288 @@ port = os.getenv("PORT")
 if db_uri is None:
     raise Exception("DB_URI is not defined in the .env file")
 
-def connect_sqlalchemy():
+# Connection pool settings (shared by SQLAlchemy sessions and raw psycopg2)
+pool_size = int(os.getenv("DB_POOL_SIZE", "5"))
+pool_max_overflow = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+pool_recycle = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+engine = None
+
+
+#####################
+## Connection Pool ##
+#####################
+
+pool_metrics_lock = threading.Lock()
+pool_metrics = {
+    "checkouts": 0,
+    "connects": 0,
+    "invalidations": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0
+}
+
+
+# Statements, database time and connection wait of each thread, so
+# callers (the request profiler, the load test) can tell what a piece of
+# work cost. Every statement goes through ProfilingCursor, whether it
+# comes from the SQLAlchemy ORM or from the raw psycopg2 report path.
+query_profile = threading.local()
+
+query_metrics_lock = threading.Lock()
+query_metrics = {
+    "queries": 0,
+    "query_seconds_total": 0.0,
+    "slow_queries": 0
+}
+
+# Statements slower than this are logged (0 turns the log off), with
+# their EXPLAIN ANALYZE plan if SLOW_QUERY_EXPLAIN=1
+slow_query_ms = float(os.getenv("SLOW_QUERY_MS", "250"))
+slow_query_explain = os.getenv("SLOW_QUERY_EXPLAIN", "0") == "1"
+slow_query_log = logging.getLogger("blm.slow_query")
+
+# Statements EXPLAIN ANALYZE accepts
+explainable_statements = ("SELECT", "WITH", "VALUES", "INSERT", "UPDATE",
+                          "DELETE", "EXECUTE")
+
+
+def add_to_profile(name, amount):
+    setattr(query_profile, name, getattr(query_profile, name, 0) + amount)
+
+
+def get_query_count():
+    '''
+    Get the number of statements the current thread has executed
+    '''
+    return getattr(query_profile, "queries", 0)
+
+
+def get_thread_profile():
+    '''
+    Get the statements, seconds spent in them and seconds spent waiting
+    for pooled connections of the current thread since it started
+    '''
+    return {
+        "queries": getattr(query_profile, "queries", 0),
+        "db_seconds": getattr(query_profile, "db_seconds", 0.0),
+        "acquire_seconds": getattr(query_profile, "acquire_seconds", 0.0)
+    }
+
+
+def get_query_stats():
+    '''
+    Get the statement counters collected since startup
+    '''
+    with query_metrics_lock:
+        return dict(query_metrics)
+
+
+def explain_query(cursor):
+    '''
+    EXPLAIN ANALYZE the statement a cursor just ran. The statement runs
+    again inside a savepoint that is rolled back, so writes are undone.
+    Returns None for statements that cannot be explained.
+    '''
+    query = cursor.query.decode(errors="replace") if cursor.query else ""
+    conn = cursor.connection
+    words = query.split(None, 1)
+    # Savepoints need an open transaction
+    if conn.autocommit or not words or words[0].upper() not in explainable_statements:
+        return None
+
+    explain_cursor = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+    try:
+        explain_cursor.execute("SAVEPOINT explain_slow_query")
+        try:
+            explain_cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + query)
+            plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+        finally:
+            explain_cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            explain_cursor.execute("RELEASE SAVEPOINT explain_slow_query")
+    finally:
+        explain_cursor.close()
+    return plan
+
+
+def record_query(cursor, seconds, succeeded):
+    '''
+    Add a statement to the thread's profile and the counters,
+    and log it if it was slow
+    '''
+    add_to_profile("queries", 1)
+    add_to_profile("db_seconds", seconds)
+    slow = slow_query_ms > 0 and seconds * 1000 >= slow_query_ms
+    with query_metrics_lock:
+        query_metrics["queries"] += 1
+        query_metrics["query_seconds_total"] += seconds
+        if slow:
+            query_metrics["slow_queries"] += 1
+    if not slow:
+        return
+
+    query = cursor.query.decode(errors="replace") if cursor.query else "?"
+    plan = None
+    if slow_query_explain and succeeded:
+        try:
+            plan = explain_query(cursor)
+        except psycopg2.Error as error:
+            plan = "EXPLAIN failed: %s" % error
+    if plan is None:
+        slow_query_log.warning("Slow query (%.1f ms): %s", seconds * 1000, query)
+    else:
+        slow_query_log.warning("Slow query (%.1f ms): %s\n%s", seconds * 1000, query, plan)
+
+
+class ProfilingCursor(psycopg2.extensions.cursor):
+    '''
+    psycopg2 cursor timing and counting the statements it sends
+    '''
+    def profiled(self, method, *args):
+        start = time.perf_counter()
+        succeeded = False
+        try:
+            result = method(*args)
+            succeeded = True
+            return result
+        finally:
+            record_query(self, time.perf_counter() - start, succeeded)
+
+    def execute(self, query, vars=None):
+        return self.profiled(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self.profiled(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self.profiled(super().copy_expert, sql, file, size)
+
+
+class TimedQueuePool(QueuePool):
+    '''
+    QueuePool that records how long callers wait to get a connection
     '''
-    Connect SQLAlchemy to application's PostgreSQL database and
-    create tables if they do not already exist.
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            add_to_profile("acquire_seconds", waited)
+            with pool_metrics_lock:
+                pool_metrics["wait_seconds_total"] += waited
+                if waited > pool_metrics["wait_seconds_max"]:
+                    pool_metrics["wait_seconds_max"] = waited
+
+
+def count_pool_event(name):
+    '''
+    Increment one of the pool event counters
+    '''
+    with pool_metrics_lock:
+        pool_metrics[name] += 1
+
+
+def get_pool_stats():
+    '''
+    Get the current state of the shared connection pool along
+    with checkout / wait counters collected since startup
+    '''
+    with pool_metrics_lock:
+        stats = dict(pool_metrics)
+    if engine is not None:
+        stats["size"] = engine.pool.size()
+        stats["checked_out"] = engine.pool.checkedout()
+        stats["idle"] = engine.pool.checkedin()
+        stats["overflow"] = engine.pool.overflow()
+    return stats
+
+
+def get_engine():
+    '''
+    Get the SQLAlchemy engine of application's PostgreSQL database.
+    The engine (and its connection pool) is created once per process,
+    on first use, and opens connections only as queries need them.
     '''
     global engine
-    engine = sqlalchemy.create_engine(db_uri, echo=False)
-    
-    global Base
-    Base.metadata.create_all(bind=engine)
+    if engine is None:
+        engine = sqlalchemy.create_engine(
+            db_uri,
+            echo=False,
+            poolclass=TimedQueuePool,
+            pool_size=pool_size,
+            max_overflow=pool_max_overflow,
+            pool_timeout=pool_timeout,
+            pool_recycle=pool_recycle,
+            pool_pre_ping=True,
+            connect_args={"cursor_factory": ProfilingCursor}
+        )
+        event.listen(engine, "connect", lambda *args: count_pool_event("connects"))
+        event.listen(engine, "checkout", lambda *args: count_pool_event("checkouts"))
+        event.listen(engine, "invalidate", lambda *args: count_pool_event("invalidations"))
+    return engine
+
+
+def create_tables():
+    '''
+    Create tables that do not already exist (part of the migrations,
+    see migrations.py)
+    '''
+    Base.metadata.create_all(bind=get_engine())
 
 
 def connect_database():
     '''
-    Connect to application's PostgreSQL database
+    Get a psycopg2 connection to application's PostgreSQL database
+    from the shared pool. Calling close() on it returns it to the pool.
     '''
-    conn = psycopg2.connect(
-        database=database,
-        user=user,
-        password=password,
-        host=host,
-        port=port
-    )
-    return conn
+    return get_engine().raw_connection()
+
+
+@contextmanager
+def pooled_cursor():
+    '''
+    Borrow a pooled connection and yield a cursor on it. The transaction
+    is committed on success and rolled back on failure, and the connection
+    goes back to the pool either way.
+    '''
+    conn = connect_database()
+    cursor = conn.cursor()
+    try:
+        yield cursor
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
 
 
 def initialize_tables():
     '''
-    Populate database with example instance
+    Populate database with example instance. Returns False, without
+    inserting anything, if the database already holds teams.
     '''
-    connect_sqlalchemy()
-    session = scoped_session(sessionmaker(bind=engine))
+    # The sample league is only needed here, not by the running app
+    from sample_data.teams import sample_teams
+    from sample_data.players import sample_players
+    from sample_data.games import sample_games
+    from sample_data.stats import sample_stats
+
+    session = scoped_session(sessionmaker(bind=get_engine()))
+    if session.execute(select(Team.team_id).limit(1)).first() is not None:
+        session.close()
+        return False
+
+    # Create the partitions of the games' seasons first: creating one locks
+    # team and player for their foreign keys, which would wait forever on
+    # the session's uncommitted inserts into them
+    games = [dict(game, season=season_of(datetime.date.fromisoformat(game["date"])))
+             for game in sample_games]
+    with pooled_cursor() as cursor:
+        create_season_partitions(cursor, {game["season"] for game in games})
 
     # Add Teams
     teams_to_insert = insert(Team).values(sample_teams)
@@ -65,124 +325,1231 @@ def initialize_tables():
     # Add Players
     players_to_insert = insert(Player).values(sample_players)
     session.execute(players_to_insert)
-    # Add Games
-    games_to_insert = insert(Game).values(sample_games)
+    # Add Games, in the partitions of their seasons
+    games_to_insert = insert(Game).values(games)
     session.execute(games_to_insert)
     # Add Stats
-    stats_to_insert = insert(Stats).values(sample_stats)
+    seasons = dict(session.execute(select(Game.game_id, Game.season)).all())
+    stats = [dict(line, season=seasons[line["game_id"]]) for line in sample_stats]
+    stats_to_insert = insert(Stats).values(stats)
     session.execute(stats_to_insert)
 
     session.commit()
     session.close()
+    notify_write("game")
+    notify_write("stats")
+    return True
+
+
+#####################
+## Write Listeners ##
+#####################
+
+# Functions called as listener(table, team_ids) after a write to table
+# commits. team_ids holds the teams whose data changed, or is None when
+# the write may have touched any team.
+write_listeners = []
+
+
+def notify_write(table, team_ids=None):
+    '''
+    Tell every write listener that table changed for the given teams
+    '''
+    for listener in write_listeners:
+        listener(table, team_ids)
+
+
+# Functions called as listener(changes) after stat lines or game scores
+# written through the API commit, with one dict per changed row:
+#   {"type": "stats", "player_id", "game_id", "team_id", *stat_columns, "result"}
+#   {"type": "stats_deleted", "player_id", "game_id", "team_id"}
+#   {"type": "score", "game_id", "home_team_id", "away_team_id",
+#    "home_score", "away_score"}
+change_listeners = []
+change_log = logging.getLogger("blm.changes")
+
+
+def notify_changes(changes):
+    '''
+    Tell every change listener which rows a write changed
+    '''
+    if changes:
+        for listener in change_listeners:
+            # The write has committed already: a listener failing (e.g. the
+            # event bus losing its connection) must not fail the request
+            try:
+                listener(changes)
+            except Exception:
+                change_log.exception("change listener %r failed", listener)
+
+
+def stat_change(row, team_id, result):
+    '''
+    Change of a stat line written as a (player_id, game_id, *stat_columns) row
+    '''
+    change = {"type": "stats", "player_id": row[0], "game_id": row[1], "team_id": team_id}
+    change.update(zip(stat_columns, row[2:]))
+    change["result"] = result
+    return change
+
+
+#########################
+## Prepared Statements ##
+#########################
+
+# Names of the statements each pooled psycopg2 connection has prepared.
+# Keyed weakly by the DBAPI connection, so a reconnect (new connection
+# object) starts with an empty set and statements get prepared again.
+prepared_statements = weakref.WeakKeyDictionary()
+prepared_statements_lock = threading.Lock()
+statement_metrics = {
+    "prepares": 0,
+    "executions": 0
+}
+
+
+def execute_prepared(cursor, name, prepare_query, params):
+    '''
+    Execute a named prepared statement on the cursor's connection,
+    sending prepare_query (PREPARE name ... AS ...) only the first
+    time that connection runs the statement
+    '''
+    conn = cursor.connection
+    with prepared_statements_lock:
+        prepared = prepared_statements.setdefault(conn, set())
+        statement_metrics["executions"] += 1
+
+    if name not in prepared:
+        cursor.execute(prepare_query)
+        with prepared_statements_lock:
+            prepared.add(name)
+            statement_metrics["prepares"] += 1
+
+    execute_query = "EXECUTE %s" % name
+    if params:
+        execute_query += "(%s)" % ", ".join(["%s"] * len(params))
+    try:
+        cursor.execute(execute_query, params)
+    except errors.InvalidSqlStatementName:
+        # Statement was dropped on the server (e.g. DISCARD ALL),
+        # prepare it again and retry once
+        conn.rollback()
+        cursor.execute(prepare_query)
+        with prepared_statements_lock:
+            statement_metrics["prepares"] += 1
+        cursor.execute(execute_query, params)
+
+
+def get_statement_stats():
+    '''
+    Get prepare / execute counters for the prepared statement registry
+    '''
+    with prepared_statements_lock:
+        stats = dict(statement_metrics)
+        stats["connections"] = len(prepared_statements)
+    return stats
 
 
 #############
-## INDEXES ##
+## Seasons ##
 #############
+# A season is named by the year it starts in and starts in August, so a
+# season's games are all in one partition of game (and its stat lines in
+# one partition of stats) even though it spans two calendar years.
+season_start_month = 8
 
-def create_indexes():
+
+def season_of(day):
     '''
-    Create indexes in application's PostgreSQL
-    database if they do not already exist
+    Get the season a game played on day belongs to
     '''
-    i1_query = """CREATE INDEX IF NOT EXISTS player_team_index ON Player USING hash (team_id);"""
-    i2_query = """CREATE INDEX IF NOT EXISTS home_team_index ON Game USING hash (home_team_id);"""
-    i3_query = """CREATE INDEX IF NOT EXISTS away_team_index ON Game USING hash (away_team_id);"""
+    return day.year if day.month >= season_start_month else day.year - 1
 
-    conn = connect_database()
-    cursor = conn.cursor()
 
-    cursor.execute(i1_query)
-    cursor.execute(i2_query)
-    cursor.execute(i3_query)
+# season_of in SQL, and the season reports default to: the season of the
+# latest game (partitions may be created ahead of a season). Queries call
+# it as (SELECT current_season()), which runs it once per statement
+# instead of once per row, and PL/pgSQL keeps its plan between calls.
+season_functions_query = """
+CREATE OR REPLACE FUNCTION season_of(d date) RETURNS int AS $$
+    SELECT (EXTRACT(YEAR FROM d) - (EXTRACT(MONTH FROM d) < %d)::int)::int
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION current_season() RETURNS int AS $$
+BEGIN
+    -- MAX(date) is read backwards from each partition's game_date_index
+    RETURN COALESCE((SELECT season_of(MAX(date)) FROM game),
+                    season_of(current_date));
+END
+$$ LANGUAGE plpgsql STABLE;
+""" % season_start_month
+
+
+def create_season_partitions(cursor, seasons):
+    '''
+    Create the game and stats partitions of the given seasons if they
+    do not exist yet. Games must have their season's partition before
+    they are inserted: rows of a season without one go to the default
+    partitions, which are scanned by every report.
+    '''
+    cursor.execute("SELECT season FROM season")
+    existing = {season for (season,) in cursor.fetchall()}
+    for season in sorted(set(seasons) - existing - {None}):
+        for table in ("game", "stats"):
+            cursor.execute("CREATE TABLE IF NOT EXISTS %s_%d PARTITION OF %s FOR VALUES IN (%d)"
+                           % (table, season, table, season))
+        cursor.execute("INSERT INTO season (season) VALUES (%s) ON CONFLICT DO NOTHING",
+                       (season,))
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+
+# The primary key of the partitioned game table is (game_id, season), so
+# it does not keep a game_id from being used in two seasons. Stat writes
+# look a game's season up by game_id alone, so game_ids holds every
+# game_id once, claimed by a trigger on each write to game.
+game_ids_function_query = """
+CREATE OR REPLACE FUNCTION claim_game_id() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM game_ids WHERE game_id = OLD.game_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        BEGIN
+            INSERT INTO game_ids (game_id) VALUES (NEW.game_id);
+        EXCEPTION WHEN unique_violation THEN
+            RAISE unique_violation USING
+                MESSAGE = format('game_id %s is already used by another game', NEW.game_id);
+        END;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+game_ids_trigger_query = """
+CREATE TRIGGER game_id_unique
+AFTER INSERT OR DELETE OR UPDATE OF game_id ON game
+FOR EACH ROW EXECUTE FUNCTION claim_game_id();
+"""
+
+
+def create_game_id_guard(cursor):
+    '''
+    Fill game_ids from the games and install the trigger that keeps
+    game_id unique across seasons (applied by migrations.py). Fails
+    listing the ids if games of different seasons already share one.
+    '''
+    cursor.execute("SELECT game_id FROM game GROUP BY game_id HAVING COUNT(*) > 1 "
+                   "ORDER BY game_id")
+    duplicates = [game_id for (game_id,) in cursor.fetchall()]
+    if duplicates:
+        raise Exception("game_id used by more than one game: %s" % duplicates)
+    cursor.execute(game_ids_function_query)
+    if not trigger_exists(cursor, "game_id_unique", "game"):
+        cursor.execute("DELETE FROM game_ids")
+        cursor.execute("INSERT INTO game_ids (game_id) SELECT game_id FROM game")
+        cursor.execute(game_ids_trigger_query)
+    reset_game_id_sequence(cursor)
+
+
+def reset_game_id_sequence(cursor):
+    '''
+    Move the game_id sequence past the largest game_id, after games
+    were loaded with explicit ids
+    '''
+    cursor.execute("SELECT setval(pg_get_serial_sequence('game', 'game_id'), "
+                   "GREATEST((SELECT MAX(game_id) FROM game), 1), "
+                   "(SELECT MAX(game_id) IS NOT NULL FROM game))")
+
+
+######################
+## Aggregate Tables ##
+######################
+# team_standings and player_season_totals hold one row per team (player)
+# and season.
+
+standings_function_query = """
+CREATE OR REPLACE FUNCTION apply_game_to_standings(
+    p_home_team_id int, p_away_team_id int,
+    p_home_score int, p_away_score int, p_sign int, p_season int
+) RETURNS void AS $$
+BEGIN
+    -- Games without a final score do not count towards the standings
+    IF p_home_score IS NULL OR p_away_score IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- Rows are touched in team_id order so concurrent writers
+    -- cannot deadlock on the two standings rows
+    INSERT INTO team_standings AS ts (
+        team_id, wins, losses, home_wins, home_losses,
+        away_wins, away_losses, points_for, points_against, season
+    )
+    SELECT *, p_season FROM (VALUES
+        (p_home_team_id,
+         p_sign * (p_home_score > p_away_score)::int,
+         p_sign * (p_home_score < p_away_score)::int,
+         p_sign * (p_home_score > p_away_score)::int,
+         p_sign * (p_home_score < p_away_score)::int,
+         0, 0,
+         p_sign * p_home_score,
+         p_sign * p_away_score),
+        (p_away_team_id,
+         p_sign * (p_away_score > p_home_score)::int,
+         p_sign * (p_away_score < p_home_score)::int,
+         0, 0,
+         p_sign * (p_away_score > p_home_score)::int,
+         p_sign * (p_away_score < p_home_score)::int,
+         p_sign * p_away_score,
+         p_sign * p_home_score)
+    ) AS delta (team_id, wins, losses, home_wins, home_losses,
+                away_wins, away_losses, points_for, points_against)
+    WHERE delta.team_id IS NOT NULL
+    ORDER BY delta.team_id
+    ON CONFLICT (team_id, season) DO UPDATE SET
+        wins = ts.wins + EXCLUDED.wins,
+        losses = ts.losses + EXCLUDED.losses,
+        home_wins = ts.home_wins + EXCLUDED.home_wins,
+        home_losses = ts.home_losses + EXCLUDED.home_losses,
+        away_wins = ts.away_wins + EXCLUDED.away_wins,
+        away_losses = ts.away_losses + EXCLUDED.away_losses,
+        points_for = ts.points_for + EXCLUDED.points_for,
+        points_against = ts.points_against + EXCLUDED.points_against;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION game_standings_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM apply_game_to_standings(OLD.home_team_id, OLD.away_team_id,
+                                        OLD.home_score, OLD.away_score, -1, OLD.season);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM apply_game_to_standings(NEW.home_team_id, NEW.away_team_id,
+                                        NEW.home_score, NEW.away_score, 1, NEW.season);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+standings_trigger_query = """
+CREATE TRIGGER game_standings
+AFTER INSERT OR DELETE
+    OR UPDATE OF home_team_id, away_team_id, home_score, away_score
+ON game
+FOR EACH ROW EXECUTE FUNCTION game_standings_trigger();
+"""
+
+totals_function_query = """
+CREATE OR REPLACE FUNCTION apply_stats_to_totals(
+    p_player_id int, p_sign int, p_points int, p_assists int,
+    p_rebounds int, p_blocks int, p_steals int, p_season int
+) RETURNS void AS $$
+BEGIN
+    INSERT INTO player_season_totals AS pt (
+        player_id, season, games_played, points, assists, rebounds, blocks, steals
+    )
+    VALUES (
+        p_player_id,
+        p_season,
+        p_sign,
+        p_sign * COALESCE(p_points, 0),
+        p_sign * COALESCE(p_assists, 0),
+        p_sign * COALESCE(p_rebounds, 0),
+        p_sign * COALESCE(p_blocks, 0),
+        p_sign * COALESCE(p_steals, 0)
+    )
+    ON CONFLICT (player_id, season) DO UPDATE SET
+        games_played = pt.games_played + EXCLUDED.games_played,
+        points = pt.points + EXCLUDED.points,
+        assists = pt.assists + EXCLUDED.assists,
+        rebounds = pt.rebounds + EXCLUDED.rebounds,
+        blocks = pt.blocks + EXCLUDED.blocks,
+        steals = pt.steals + EXCLUDED.steals;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_totals_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM apply_stats_to_totals(OLD.player_id, -1, OLD.points, OLD.assists,
+                                      OLD.rebounds, OLD.blocks, OLD.steals, OLD.season);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM apply_stats_to_totals(NEW.player_id, 1, NEW.points, NEW.assists,
+                                      NEW.rebounds, NEW.blocks, NEW.steals, NEW.season);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+totals_trigger_query = """
+CREATE TRIGGER stats_totals
+AFTER INSERT OR UPDATE OR DELETE ON stats
+FOR EACH ROW EXECUTE FUNCTION stats_totals_trigger();
+"""
+
+rebuild_totals_query = """
+INSERT INTO player_season_totals (
+    player_id, season, games_played, points, assists, rebounds, blocks, steals
+)
+SELECT
+    player_id,
+    season,
+    COUNT(*),
+    COALESCE(SUM(points), 0),
+    COALESCE(SUM(assists), 0),
+    COALESCE(SUM(rebounds), 0),
+    COALESCE(SUM(blocks), 0),
+    COALESCE(SUM(steals), 0)
+FROM stats
+GROUP BY player_id, season;
+"""
+
+rebuild_standings_query = """
+INSERT INTO team_standings (
+    team_id, season, wins, losses, home_wins, home_losses,
+    away_wins, away_losses, points_for, points_against
+)
+SELECT
+    r.team_id,
+    r.season,
+    COUNT(*) FILTER (WHERE r.scored > r.allowed),
+    COUNT(*) FILTER (WHERE r.scored < r.allowed),
+    COUNT(*) FILTER (WHERE r.is_home AND r.scored > r.allowed),
+    COUNT(*) FILTER (WHERE r.is_home AND r.scored < r.allowed),
+    COUNT(*) FILTER (WHERE NOT r.is_home AND r.scored > r.allowed),
+    COUNT(*) FILTER (WHERE NOT r.is_home AND r.scored < r.allowed),
+    COALESCE(SUM(r.scored), 0),
+    COALESCE(SUM(r.allowed), 0)
+FROM (
+    SELECT home_team_id AS team_id, season, TRUE AS is_home,
+        home_score AS scored, away_score AS allowed
+    FROM game
+    WHERE home_score IS NOT NULL AND away_score IS NOT NULL
+    UNION ALL
+    SELECT away_team_id AS team_id, season, FALSE AS is_home,
+        away_score AS scored, home_score AS allowed
+    FROM game
+    WHERE home_score IS NOT NULL AND away_score IS NOT NULL
+) r
+WHERE r.team_id IS NOT NULL
+GROUP BY r.team_id, r.season;
+"""
+
+
+def trigger_exists(cursor, trigger_name, table):
+    '''
+    Check whether a trigger with the given name is installed on the
+    table (the one the search_path resolves, so other schemas holding
+    their own copy of the tables do not count)
+    '''
+    cursor.execute("SELECT 1 FROM pg_trigger WHERE tgname = %s AND tgrelid = %s::regclass",
+                   (trigger_name, table))
+    return cursor.fetchone() is not None
+
+
+def create_aggregate_triggers(cursor):
+    '''
+    Install the triggers that keep the aggregate tables up to date
+    (applied by migrations.py). An aggregate table is rebuilt from scratch
+    when its trigger is first installed, since earlier writes were never
+    applied to it.
+    '''
+    cursor.execute(standings_function_query)
+    if not trigger_exists(cursor, "game_standings", "game"):
+        cursor.execute(standings_trigger_query)
+        rebuild_team_standings(cursor)
+
+    cursor.execute(totals_function_query)
+    if not trigger_exists(cursor, "stats_totals", "stats"):
+        cursor.execute(totals_trigger_query)
+        rebuild_player_totals(cursor)
+
+
+def rebuild_team_standings(cursor=None):
+    '''
+    Recompute the team_standings table from every game
+    '''
+    if cursor is None:
+        with pooled_cursor() as cursor:
+            rebuild_team_standings(cursor)
+        notify_write("game")
+        return
+
+    # Block game writes while the table is rebuilt
+    cursor.execute("LOCK TABLE game IN SHARE MODE")
+    cursor.execute("DELETE FROM team_standings")
+    cursor.execute(rebuild_standings_query)
+
+
+def rebuild_player_totals(cursor=None):
+    '''
+    Recompute the player_season_totals table from every stat line
+    '''
+    if cursor is None:
+        with pooled_cursor() as cursor:
+            rebuild_player_totals(cursor)
+        notify_write("stats")
+        return
+
+    # Block stats writes while the table is rebuilt
+    cursor.execute("LOCK TABLE stats IN SHARE MODE")
+    cursor.execute("DELETE FROM player_season_totals")
+    cursor.execute(rebuild_totals_query)
+
+
+##########################
+## Recent Form Triggers ##
+##########################
+# team_form holds the totals of each team's last form_games games of a
+# season and its current streak. A game write refreshes the form of its
+# teams by reading their latest games through the game log indexes
+# (form_games rows, or as many as the streak is long).
+#
+# player_form holds each player's stat lines of their last form_games
+# games of a season, latest first, as arrays. Stat entry adds or edits
+# lines of the latest games all the time, so those writes change the
+# arrays in place: an edited line replaces its values and a new line is
+# put in its place, pushing out the oldest. Only a line leaving the last
+# games (a delete) or a game changing date reads the player's lines again.
+# Either way the form is never computed per request.
+
+# Games in the "last N games" of the game logs
+form_games = 10
+
+# A team's played games of a season, latest first
+team_games_select = """
+SELECT r.game_id, r.date, r.scored, r.allowed
+FROM (
+    SELECT g.game_id, g.date, g.home_score AS scored, g.away_score AS allowed
+    FROM game g
+    WHERE g.home_team_id = p_team_id AND g.season = p_season
+        AND g.home_score IS NOT NULL AND g.away_score IS NOT NULL AND g.date IS NOT NULL
+    UNION ALL
+    SELECT g.game_id, g.date, g.away_score, g.home_score
+    FROM game g
+    WHERE g.away_team_id = p_team_id AND g.season = p_season
+        AND g.home_score IS NOT NULL AND g.away_score IS NOT NULL AND g.date IS NOT NULL
+) r
+ORDER BY r.date DESC, r.game_id DESC
+"""
+
+form_functions_query = """
+CREATE OR REPLACE FUNCTION refresh_team_form(p_team_id int, p_season int)
+RETURNS void AS $$
+DECLARE
+    v_game record;
+    v_games int := 0;
+    v_wins int := 0;
+    v_points_for int := 0;
+    v_points_against int := 0;
+    v_streak int := 0;
+    v_streak_open boolean := TRUE;
+BEGIN
+    IF p_team_id IS NULL OR p_season IS NULL THEN
+        RETURN;
+    END IF;
+    -- Latest games first, until both the window and the streak are complete
+    FOR v_game IN """ + team_games_select + """ LOOP
+        IF v_games < %(form_games)d THEN
+            v_games := v_games + 1;
+            v_wins := v_wins + (v_game.scored > v_game.allowed)::int;
+            v_points_for := v_points_for + v_game.scored;
+            v_points_against := v_points_against + v_game.allowed;
+        END IF;
+        IF v_streak_open THEN
+            IF v_streak = 0 OR (v_streak > 0) = (v_game.scored > v_game.allowed) THEN
+                v_streak := v_streak + CASE WHEN v_game.scored > v_game.allowed THEN 1 ELSE -1 END;
+            ELSE
+                v_streak_open := FALSE;
+            END IF;
+        END IF;
+        EXIT WHEN v_games >= %(form_games)d AND NOT v_streak_open;
+    END LOOP;
+
+    INSERT INTO team_form AS f (team_id, season, games, wins, points_for, points_against, streak)
+    VALUES (p_team_id, p_season, v_games, v_wins, v_points_for, v_points_against, v_streak)
+    ON CONFLICT (team_id, season) DO UPDATE SET
+        games = EXCLUDED.games,
+        wins = EXCLUDED.wins,
+        points_for = EXCLUDED.points_for,
+        points_against = EXCLUDED.points_against,
+        streak = EXCLUDED.streak;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_player_form(p_player_id int, p_season int)
+RETURNS void AS $$
+BEGIN
+    IF p_player_id IS NULL OR p_season IS NULL THEN
+        RETURN;
+    END IF;
+    DELETE FROM player_form WHERE player_id = p_player_id AND season = p_season;
+    INSERT INTO player_form (player_id, season, game_ids, game_dates, points, assists,
+                             rebounds, blocks, steals)
+    SELECT p_player_id, p_season,
+        array_agg(r.game_id ORDER BY r.date DESC, r.game_id DESC),
+        array_agg(r.date ORDER BY r.date DESC, r.game_id DESC),
+        array_agg(r.points ORDER BY r.date DESC, r.game_id DESC),
+        array_agg(r.assists ORDER BY r.date DESC, r.game_id DESC),
+        array_agg(r.rebounds ORDER BY r.date DESC, r.game_id DESC),
+        array_agg(r.blocks ORDER BY r.date DESC, r.game_id DESC),
+        array_agg(r.steals ORDER BY r.date DESC, r.game_id DESC)
+    FROM (
+        SELECT s.game_id, g.date, s.points, s.assists, s.rebounds, s.blocks, s.steals
+        FROM stats s
+            JOIN game g ON g.game_id = s.game_id AND g.season = p_season
+        WHERE s.player_id = p_player_id AND s.season = p_season AND g.date IS NOT NULL
+        ORDER BY g.date DESC, g.game_id DESC
+        LIMIT %(form_games)d
+    ) r
+    HAVING COUNT(*) > 0;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Put a new stat line in its player's last games, if it is one of them,
+-- pushing the oldest one out. Only the player_form row is read, so rows
+-- inserted by the same statement are never counted twice.
+CREATE OR REPLACE FUNCTION add_player_form_line(p_line stats)
+RETURNS void AS $$
+DECLARE
+    v_form player_form%%ROWTYPE;
+    v_date date;
+    v_at int;
+BEGIN
+    SELECT g.date INTO v_date
+    FROM game g
+    WHERE g.game_id = p_line.game_id AND g.season = p_line.season;
+    IF v_date IS NULL THEN
+        RETURN;
+    END IF;
+    SELECT * INTO v_form
+    FROM player_form
+    WHERE player_id = p_line.player_id AND season = p_line.season
+    FOR UPDATE;
+    IF NOT FOUND THEN
+        INSERT INTO player_form (player_id, season, game_ids, game_dates, points, assists,
+                                 rebounds, blocks, steals)
+        VALUES (p_line.player_id, p_line.season, ARRAY[p_line.game_id], ARRAY[v_date],
+                ARRAY[p_line.points], ARRAY[p_line.assists], ARRAY[p_line.rebounds],
+                ARRAY[p_line.blocks], ARRAY[p_line.steals]);
+        RETURN;
+    END IF;
+
+    -- Position of the line, latest game first
+    SELECT 1 + COUNT(*) INTO v_at
+    FROM unnest(v_form.game_ids, v_form.game_dates) AS w (game_id, date)
+    WHERE (w.date, w.game_id) > (v_date, p_line.game_id);
+    IF v_at > %(form_games)d THEN
+        RETURN;
+    END IF;
+    UPDATE player_form SET
+        game_ids = (game_ids[:v_at - 1] || p_line.game_id || game_ids[v_at:])[:%(form_games)d],
+        game_dates = (game_dates[:v_at - 1] || v_date || game_dates[v_at:])[:%(form_games)d],
+        points = (points[:v_at - 1] || p_line.points || points[v_at:])[:%(form_games)d],
+        assists = (assists[:v_at - 1] || p_line.assists || assists[v_at:])[:%(form_games)d],
+        rebounds = (rebounds[:v_at - 1] || p_line.rebounds || rebounds[v_at:])[:%(form_games)d],
+        blocks = (blocks[:v_at - 1] || p_line.blocks || blocks[v_at:])[:%(form_games)d],
+        steals = (steals[:v_at - 1] || p_line.steals || steals[v_at:])[:%(form_games)d]
+    WHERE player_id = p_line.player_id AND season = p_line.season;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION game_form_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND (OLD.home_team_id, OLD.away_team_id)
+                            IS DISTINCT FROM (NEW.home_team_id, NEW.away_team_id)) THEN
+        PERFORM refresh_team_form(OLD.home_team_id, OLD.season);
+        PERFORM refresh_team_form(OLD.away_team_id, OLD.season);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM refresh_team_form(NEW.home_team_id, NEW.season);
+        PERFORM refresh_team_form(NEW.away_team_id, NEW.season);
+    END IF;
+    -- A new date can move the game's stat lines in or out of their
+    -- players' last games (games with stat lines cannot be deleted)
+    IF TG_OP = 'UPDATE' AND OLD.date IS DISTINCT FROM NEW.date THEN
+        PERFORM refresh_player_form(s.player_id, s.season)
+        FROM stats s
+        WHERE s.game_id = NEW.game_id AND s.season = NEW.season;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_form_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND (OLD.player_id, OLD.game_id, OLD.season)
+                            = (NEW.player_id, NEW.game_id, NEW.season) THEN
+        -- Only the values of the line change
+        UPDATE player_form SET
+            points[array_position(game_ids, NEW.game_id)] = NEW.points,
+            assists[array_position(game_ids, NEW.game_id)] = NEW.assists,
+            rebounds[array_position(game_ids, NEW.game_id)] = NEW.rebounds,
+            blocks[array_position(game_ids, NEW.game_id)] = NEW.blocks,
+            steals[array_position(game_ids, NEW.game_id)] = NEW.steals
+        WHERE player_id = NEW.player_id AND season = NEW.season
+            AND NEW.game_id = ANY(game_ids);
+        RETURN NULL;
+    END IF;
+    -- A line leaving the last games lets an older one in, which takes
+    -- reading the player's lines again
+    IF TG_OP IN ('UPDATE', 'DELETE') AND EXISTS (
+            SELECT 1 FROM player_form
+            WHERE player_id = OLD.player_id AND season = OLD.season
+                AND OLD.game_id = ANY(game_ids)) THEN
+        PERFORM refresh_player_form(OLD.player_id, OLD.season);
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        PERFORM add_player_form_line(NEW);
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM refresh_player_form(NEW.player_id, NEW.season);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+""" % {"form_games": form_games}
+
+form_triggers_query = """
+CREATE TRIGGER game_form
+AFTER INSERT OR DELETE
+    OR UPDATE OF date, home_team_id, away_team_id, home_score, away_score
+ON game
+FOR EACH ROW EXECUTE FUNCTION game_form_trigger();
+
+CREATE TRIGGER stats_form
+AFTER INSERT OR UPDATE OR DELETE ON stats
+FOR EACH ROW EXECUTE FUNCTION stats_form_trigger();
+"""
+
+# The streak of a team is the number of its latest games, in a row, with
+# the result of its very latest game
+rebuild_team_form_query = """
+WITH r AS (
+    SELECT x.team_id, x.season, x.scored, x.allowed, x.scored > x.allowed AS won,
+        ROW_NUMBER() OVER (PARTITION BY x.team_id, x.season
+                           ORDER BY x.date DESC, x.game_id DESC) AS recent
+    FROM (
+        SELECT home_team_id AS team_id, season, game_id, date,
+            home_score AS scored, away_score AS allowed
+        FROM game
+        WHERE home_score IS NOT NULL AND away_score IS NOT NULL AND date IS NOT NULL
+        UNION ALL
+        SELECT away_team_id, season, game_id, date, away_score, home_score
+        FROM game
+        WHERE home_score IS NOT NULL AND away_score IS NOT NULL AND date IS NOT NULL
+    ) x
+    WHERE x.team_id IS NOT NULL
+)
+INSERT INTO team_form (team_id, season, games, wins, points_for, points_against, streak)
+SELECT r.team_id, r.season,
+    COUNT(*) FILTER (WHERE r.recent <= %(form_games)d),
+    COUNT(*) FILTER (WHERE r.recent <= %(form_games)d AND r.won),
+    COALESCE(SUM(r.scored) FILTER (WHERE r.recent <= %(form_games)d), 0),
+    COALESCE(SUM(r.allowed) FILTER (WHERE r.recent <= %(form_games)d), 0),
+    (COALESCE(MIN(r.recent) FILTER (WHERE r.won <> latest.won), COUNT(*) + 1) - 1)
+        * CASE WHEN latest.won THEN 1 ELSE -1 END
+FROM r
+    JOIN r latest ON latest.team_id = r.team_id AND latest.season = r.season
+        AND latest.recent = 1
+GROUP BY r.team_id, r.season, latest.won;
+""" % {"form_games": form_games}
+
+rebuild_player_form_query = """
+INSERT INTO player_form (player_id, season, game_ids, game_dates, points, assists,
+                         rebounds, blocks, steals)
+SELECT r.player_id, r.season,
+    array_agg(r.game_id ORDER BY r.recent),
+    array_agg(r.date ORDER BY r.recent),
+    array_agg(r.points ORDER BY r.recent),
+    array_agg(r.assists ORDER BY r.recent),
+    array_agg(r.rebounds ORDER BY r.recent),
+    array_agg(r.blocks ORDER BY r.recent),
+    array_agg(r.steals ORDER BY r.recent)
+FROM (
+    SELECT s.player_id, s.season, s.game_id, g.date,
+        s.points, s.assists, s.rebounds, s.blocks, s.steals,
+        ROW_NUMBER() OVER (PARTITION BY s.player_id, s.season
+                           ORDER BY g.date DESC, g.game_id DESC) AS recent
+    FROM stats s
+        JOIN game g ON g.game_id = s.game_id AND g.season = s.season
+    WHERE g.date IS NOT NULL
+) r
+WHERE r.recent <= %(form_games)d
+GROUP BY r.player_id, r.season;
+""" % {"form_games": form_games}
+
+
+def create_form_triggers(cursor):
+    '''
+    Install the triggers that keep team_form and player_form up to date
+    (applied by migrations.py) and fill both tables
+    '''
+    cursor.execute(form_functions_query)
+    if not trigger_exists(cursor, "game_form", "game"):
+        cursor.execute(form_triggers_query)
+    rebuild_form(cursor)
+
+
+def rebuild_form(cursor=None):
+    '''
+    Recompute the team_form and player_form tables from every game and
+    stat line
+    '''
+    if cursor is None:
+        with pooled_cursor() as cursor:
+            rebuild_form(cursor)
+        notify_write("game")
+        notify_write("stats")
+        return
+
+    # Block game and stats writes while the tables are rebuilt
+    cursor.execute("LOCK TABLE game, stats IN SHARE MODE")
+    cursor.execute("DELETE FROM team_form")
+    cursor.execute(rebuild_team_form_query)
+    cursor.execute("DELETE FROM player_form")
+    cursor.execute(rebuild_player_form_query)
+
+
+###############
+## Row Reads ##
+###############
+# The list endpoints select plain columns with Core instead of building
+# ORM objects, and get each row back as a dict that can be serialized as
+# is. Column labels are the JSON field names, and dates and times are
+# formatted by PostgreSQL.
+
+# Rows fetched per round trip from a server-side cursor
+stream_batch_size = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+stats_list_columns = (Stats.player_id, Stats.game_id, Stats.season, Stats.points,
+                      Stats.assists, Stats.rebounds, Stats.blocks, Stats.steals)
+player_list_columns = (Player.player_id, Player.team_id, Player.first_name,
+                       Player.last_name, Player.position, Player.jersey_number)
+game_list_columns = (Game.game_id, Game.season,
+                     func.to_char(Game.date, "MM/DD/YY").label("date"),
+                     func.to_char(Game.time, "HH24:MI:SS").label("time"),
+                     Game.location, Game.home_team_id, Game.home_score,
+                     Game.away_team_id, Game.away_score)
+team_list_columns = (Team.team_id, Team.name, Team.coach)
+
+
+def read_rows(statement):
+    '''
+    Execute a Core select and return its rows as a list of dicts
+    '''
+    with get_engine().connect() as conn:
+        result = conn.execute(statement)
+        keys = tuple(result.keys())
+        return [dict(zip(keys, row)) for row in result]
+
+
+def stream_rows(statement):
+    '''
+    Generator over the rows of a Core select as dicts. Rows are read
+    through a server-side cursor stream_batch_size at a time, so memory
+    use does not grow with the size of the table. The connection stays
+    checked out until the generator is exhausted or closed.
+    '''
+    with get_engine().connect() as conn:
+        result = conn.execution_options(
+            stream_results=True, yield_per=stream_batch_size).execute(statement)
+        keys = tuple(result.keys())
+        for row in result:
+            yield dict(zip(keys, row))
 
 
 #################################
 ## Stats Table CRUD Operations ##
 #################################
 
-def get_stats_table():
+def filter_stats_query(query, player_id=None, game_id=None, team_id=None,
+                       date_from=None, date_to=None, season=None):
     '''
-    Retrieve all rows in the Stats table
+    Apply the optional player, game, team, date range and season filters
+    to a query over the Stats table. A date range also limits the seasons
+    read, so only the partitions of those seasons are scanned.
     '''
-    session = scoped_session(sessionmaker(bind=engine))
-    stats = session.query(Stats).all()
-    session.close()
-    return stats
+    if season is not None:
+        query = query.filter(Stats.season == season)
+    if player_id is not None:
+        query = query.filter(Stats.player_id == player_id)
+    if game_id is not None:
+        query = query.filter(Stats.game_id == game_id)
+    if team_id is not None:
+        query = query.join(Player, Player.player_id == Stats.player_id) \
+                     .filter(Player.team_id == team_id)
+    if date_from is not None or date_to is not None:
+        query = query.join(Game, (Game.game_id == Stats.game_id)
+                           & (Game.season == Stats.season))
+        if date_from is not None:
+            query = query.filter(Game.date >= date_from)
+        if date_to is not None:
+            query = query.filter(Game.date <= date_to)
+        # A range within one season is an equality, which also rules
+        # out the default partitions
+        seasons = (season_of(date_from) if date_from is not None else None,
+                   season_of(date_to) if date_to is not None else None)
+        if seasons[0] is not None and seasons[0] == seasons[1]:
+            query = query.filter(Stats.season == seasons[0])
+        else:
+            if seasons[0] is not None:
+                query = query.filter(Stats.season >= seasons[0])
+            if seasons[1] is not None:
+                query = query.filter(Stats.season <= seasons[1])
+    return query
+
+
+def stats_table_select(descending=False, after=None, limit=None, **filters):
+    '''
+    Build the select of get_stats_table
+    '''
+    query = filter_stats_query(select(*stats_list_columns), **filters)
+
+    key = tuple_(Stats.player_id, Stats.game_id)
+    if after is not None:
+        query = query.filter(key < tuple_(*after) if descending else key > tuple_(*after))
+    if descending:
+        query = query.order_by(Stats.player_id.desc(), Stats.game_id.desc())
+    else:
+        query = query.order_by(Stats.player_id, Stats.game_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def get_stats_table(descending=False, after=None, limit=None, **filters):
+    '''
+    Retrieve rows in the Stats table matching the given filters, ordered
+    by (player_id, game_id), as dicts. Pages are fetched with a keyset cursor:
+    after is the (player_id, game_id) key of the last row already seen.
+    '''
+    return read_rows(stats_table_select(descending, after, limit, **filters))
+
+
+def stream_stats_table(**filters):
+    '''
+    Stream every row in the Stats table matching the given filters
+    '''
+    return stream_rows(filter_stats_query(
+        select(*stats_list_columns), **filters
+    ).order_by(Stats.player_id, Stats.game_id))
+
+
+# Per game statistics stored for each (player_id, game_id) stat line
+stat_columns = ("points", "assists", "rebounds", "blocks", "steals")
+
+# Stat lines written as (player_id, game_id, *stat_columns) VALUES rows,
+# with the season of their game (NULL, and so rejected, if it does not exist)
+stats_values_select = """
+SELECT v.player_id::int, v.game_id::int,
+    (SELECT g.season FROM game g WHERE g.game_id = v.game_id::int),
+    v.points::int, v.assists::int, v.rebounds::int, v.blocks::int, v.steals::int
+FROM (VALUES %s) AS v (player_id, game_id, points, assists, rebounds, blocks, steals)
+"""
+
+upsert_stats_query = """
+WITH written AS (
+    INSERT INTO stats (player_id, game_id, season, points, assists, rebounds, blocks, steals)
+    """ + stats_values_select + """
+    ON CONFLICT (player_id, game_id, season) DO UPDATE SET
+        points = EXCLUDED.points,
+        assists = EXCLUDED.assists,
+        rebounds = EXCLUDED.rebounds,
+        blocks = EXCLUDED.blocks,
+        steals = EXCLUDED.steals
+    RETURNING player_id, game_id, season
+)
+SELECT w.player_id, w.game_id,
+    -- Reads stats as it was before this statement's writes
+    NOT EXISTS (SELECT 1 FROM stats s
+                WHERE s.player_id = w.player_id
+                    AND s.game_id = w.game_id
+                    AND s.season = w.season) AS inserted,
+    p.team_id
+FROM written w
+    JOIN player p ON p.player_id = w.player_id
+"""
+
+
+def upsert_stats_rows(cursor, rows):
+    '''
+    Insert or update stat lines given as (player_id, game_id, points,
+    assists, rebounds, blocks, steals) tuples with one statement.
+    Returns {(player_id, game_id): "inserted" or "updated"} and the
+    {player_id: team_id} of the players written.
+    Rows must have distinct (player_id, game_id) keys.
+    '''
+    # player_season_totals is updated by the stats_totals
+    # trigger as part of the caller's transaction
+    returned = execute_values(cursor, upsert_stats_query, rows,
+                              page_size=max(len(rows), 1), fetch=True)
+    results = {
+        (player_id, game_id): "inserted" if inserted else "updated"
+        for (player_id, game_id, inserted, team_id) in returned
+    }
+    teams = {player_id: team_id for (player_id, game_id, inserted, team_id) in returned}
+    return (results, teams)
+
+
+def upsert_player_stats(rows):
+    '''
+    Insert or update stat lines in their own transaction
+    (see upsert_stats_rows)
+    '''
+    with pooled_cursor() as cursor:
+        (results, teams) = upsert_stats_rows(cursor, rows)
+    notify_write("stats", set(teams.values()))
+    notify_changes([stat_change(row, teams[row[0]], results[row[:2]])
+                    for row in rows if row[:2] in results])
+    return results
 
 
 def add_player_stats(player_id, game_id, points, assists,
                      rebounds, blocks, steals):
     '''
-    Add a player's stats for a game to the Stats table
+    Add a player's stats for a game to the Stats table, replacing them
+    if they were already recorded. Returns "inserted" or "updated".
     '''
-    session = scoped_session(sessionmaker(bind=engine))
-    ## TRANSACTION
-    try:
-        # REPEATABLE READ isolation level for transaction
-        session.begin()
-        session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
-        new = Stats(player_id=player_id, game_id=game_id, points=points,
-                    assists=assists, rebounds=rebounds, blocks=blocks,
-                    steals=steals)
-        session.add(new)
-        # commit transaction on success
-        session.commit()
-    except:
-        # abort (rollback) transaction on failure
-        session.rollback()
-    finally:
-        session.close()
+    results = upsert_player_stats([(player_id, game_id, points, assists,
+                                    rebounds, blocks, steals)])
+    return list(results.values())[0]
 
 
 def edit_player_stats(player_id, game_id, points, assists,
                       rebounds, blocks, steals):
     '''
-    Edit a player's stats for a game in the Stats table
+    Edit a player's recorded stats for a game in the Stats table.
+    Returns "updated", or None if no stats were recorded for the game.
     '''
-    session = scoped_session(sessionmaker(bind=engine))
-    ## TRANSACTION
-    try:
-        # READ COMMITTED isolation level for transaction
-        session.begin()
-        session.connection(execution_options={"isolation_level": "READ COMMITTED"})
-        stat = session.query(Stats).filter_by(player_id=player_id, game_id=game_id).first()
-        stat.points = points
-        stat.assists = assists
-        stat.rebounds = rebounds
-        stat.blocks = blocks
-        stat.steals = steals
-        # commit transaction on success
-        session.commit()
-    except:
-        # abort (rollback) transaction on failure
-        session.rollback()
-    finally:
-        session.close()
+    # The game's season limits the update to one partition
+    update_query = """
+    UPDATE stats s
+    SET points = %s, assists = %s, rebounds = %s, blocks = %s, steals = %s
+    FROM player p
+    WHERE s.player_id = p.player_id AND s.player_id = %s AND s.game_id = %s
+        AND s.season = (SELECT g.season FROM game g WHERE g.game_id = %s)
+    RETURNING p.team_id
+    """
+    # player_season_totals is updated by the stats_totals
+    # trigger as part of this transaction
+    with pooled_cursor() as cursor:
+        cursor.execute(update_query, (points, assists, rebounds, blocks, steals,
+                                      player_id, game_id, game_id))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    notify_write("stats", {row[0]})
+    notify_changes([stat_change((player_id, game_id, points, assists, rebounds, blocks, steals),
+                                row[0], "updated")])
+    return "updated"
 
 
 def delete_player_stats(player_id, game_id):
     '''
     Delete a player's stats for a game in the Stats table
     '''
-    session = scoped_session(sessionmaker(bind=engine))
-    ## TRANSACTION
-    try:
-        # READ COMMITTED isolation level for transaction
-        session.begin()
-        session.connection(execution_options={"isolation_level": "READ COMMITTED"})
-        session.query(Stats).filter_by(player_id=player_id, game_id=game_id).delete()
-        # commit transaction on success
-        session.commit()
-    except:
-        # abort (rollback) transaction on failure
-        session.rollback()
-    finally:
-        session.close()
+    # The game's season limits the delete to one partition
+    delete_query = """
+    DELETE FROM stats s
+    USING player p
+    WHERE s.player_id = p.player_id AND s.player_id = %s AND s.game_id = %s
+        AND s.season = (SELECT g.season FROM game g WHERE g.game_id = %s)
+    RETURNING p.team_id
+    """
+    # player_season_totals is updated by the stats_totals
+    # trigger as part of this transaction
+    with pooled_cursor() as cursor:
+        cursor.execute(delete_query, (player_id, game_id, game_id))
+        team_ids = {team_id for (team_id,) in cursor.fetchall()}
+    notify_write("stats", team_ids)
+    notify_changes([{"type": "stats_deleted", "player_id": player_id,
+                     "game_id": game_id, "team_id": team_id} for team_id in team_ids])
+
+
+delete_stats_rows_query = """
+DELETE FROM stats s
+USING player p, (VALUES %s) AS v (player_id, game_id)
+WHERE s.player_id = p.player_id AND s.player_id = v.player_id::int
+    AND s.game_id = v.game_id::int
+    AND s.season = (SELECT g.season FROM game g WHERE g.game_id = v.game_id::int)
+RETURNING s.player_id, s.game_id, p.team_id
+"""
+
+
+def write_stats_batch(rows, deletes):
+    '''
+    Upsert stat lines given as (player_id, game_id, *stat_columns) tuples
+    and delete the (player_id, game_id) keys in deletes, all in one
+    transaction. Keys must be distinct across both lists. Lines of
+    players or games that do not exist are skipped. Returns the
+    {(player_id, game_id): "inserted" or "updated"} of the written lines,
+    the keys deleted and the keys skipped.
+    '''
+    results = {}
+    deleted = []
+    teams = {}
+    with pooled_cursor() as cursor:
+        keys = [row[:2] for row in rows] + list(deletes)
+        cursor.execute("SELECT player_id, team_id FROM player WHERE player_id = ANY(%s)",
+                       (list({key[0] for key in keys}),))
+        players = dict(cursor.fetchall())
+        cursor.execute("SELECT game_id FROM game WHERE game_id = ANY(%s)",
+                       (list({key[1] for key in keys}),))
+        games = {game_id for (game_id,) in cursor.fetchall()}
+        skipped = [key for key in keys if key[0] not in players or key[1] not in games]
+        rows = [row for row in rows if row[0] in players and row[1] in games]
+        deletes = [key for key in deletes if key[0] in players and key[1] in games]
+
+        if rows:
+            (results, teams) = upsert_stats_rows(cursor, rows)
+        if deletes:
+            deleted = execute_values(cursor, delete_stats_rows_query, deletes,
+                                     page_size=len(deletes), fetch=True)
+
+    notify_write("stats", set(teams.values()) | {team_id for (_, _, team_id) in deleted})
+    notify_changes([stat_change(row, teams[row[0]], results[row[:2]])
+                    for row in rows if row[:2] in results] +
+                   [{"type": "stats_deleted", "player_id": player_id,
+                     "game_id": game_id, "team_id": team_id}
+                    for (player_id, game_id, team_id) in deleted])
+    return (results, [(player_id, game_id) for (player_id, game_id, _) in deleted], skipped)
+
+
+def is_count(value):
+    '''
+    Check that a value is a non-negative integer (and not a bool)
+    '''
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def validate_stat_line(line):
+    '''
+    Check one stat line for bulk ingestion. Returns the row as a tuple in
+    (player_id, game_id, *stat_columns) order and an error message, one
+    of which is None.
+    '''
+    if not isinstance(line, dict):
+        return (None, "stat line must be an object")
+    missing = [key for key in ("player_id", "game_id") + stat_columns
+               if key not in line]
+    if missing:
+        return (None, "missing fields: " + ", ".join(missing))
+    for key in ("player_id", "game_id") + stat_columns:
+        if not is_count(line[key]):
+            return (None, "%s must be a non-negative integer" % key)
+    row = tuple(line[key] for key in ("player_id", "game_id") + stat_columns)
+    return (row, None)
+
+
+def bulk_add_player_stats(stat_lines, game=None, upsert=False):
+    '''
+    Add many players' stats (e.g. a whole box score) in one transaction
+    with a single multi-row INSERT, optionally recording the game's final
+    score. Invalid lines are skipped and reported as
+    {"index": i, "message": ...}; the valid ones are still inserted.
+    With upsert, existing stat lines are updated instead of reported,
+    and every written line is listed with whether it was inserted or updated.
+    '''
+    errors_found = []
+    rows = {}
+    for (index, line) in enumerate(stat_lines):
+        (row, error) = validate_stat_line(line)
+        if error is None and row[:2] in rows:
+            error = "duplicate stat line for player %d in game %d" % row[:2]
+        if error is not None:
+            errors_found.append({"index": index, "message": error})
+        else:
+            rows[row[:2]] = (index, row)
+
+    if game is not None and not (
+            isinstance(game, dict) and
+            all(is_count(game.get(key)) for key in ("game_id", "home_score", "away_score"))):
+        errors_found.append({"index": None, "message":
+                             "game needs integer game_id, home_score and away_score"})
+        game = None
+
+    inserted = 0
+    updated = 0
+    results = []
+    game_updated = False
+    stats_teams = set()
+    game_teams = set()
+    changes = []
+    with pooled_cursor() as cursor:
+        # Foreign keys are checked up front so one bad line
+        # cannot abort the whole transaction
+        cursor.execute("SELECT player_id, team_id FROM player WHERE player_id = ANY(%s)",
+                       (list({key[0] for key in rows}),))
+        players = dict(cursor.fetchall())
+        cursor.execute("SELECT game_id FROM game WHERE game_id = ANY(%s)",
+                       (list({key[1] for key in rows}),))
+        games = {game_id for (game_id,) in cursor.fetchall()}
+        for (key, (index, row)) in list(rows.items()):
+            if key[0] not in players or key[1] not in games:
+                missing = "player %d" % key[0] if key[0] not in players else "game %d" % key[1]
+                errors_found.append({"index": index, "message": missing + " does not exist"})
+                del rows[key]
+
+        if rows and upsert:
+            (written, teams) = upsert_stats_rows(
+                cursor, [row for (index, row) in rows.values()])
+            stats_teams = set(teams.values())
+            for (key, result) in written.items():
+                results.append({"index": rows[key][0], "player_id": key[0],
+                                "game_id": key[1], "result": result})
+                changes.append(stat_change(rows[key][1], teams[key[0]], result))
+            results.sort(key=lambda result: result["index"])
+            inserted = sum(1 for result in results if result["result"] == "inserted")
+            updated = len(results) - inserted
+        elif rows:
+            insert_query = """
+            INSERT INTO stats (player_id, game_id, season, %s)
+            %s
+            ON CONFLICT (player_id, game_id, season) DO NOTHING
+            RETURNING player_id, game_id
+            """ % (", ".join(stat_columns), stats_values_select)
+            returned = execute_values(cursor, insert_query,
+                                      [row for (index, row) in rows.values()],
+                                      page_size=len(rows), fetch=True)
+            inserted = len(returned)
+            stats_teams = {players[player_id] for (player_id, game_id) in returned}
+            changes += [stat_change(rows[key][1], players[key[0]], "inserted")
+                        for key in map(tuple, returned)]
+            for key in set(rows) - set(returned):
+                errors_found.append({"index": rows[key][0],
+                                     "message": "stats for player %d in game %d already exist" % key})
+
+        if game is not None:
+            cursor.execute("UPDATE game SET home_score = %s, away_score = %s WHERE game_id = %s "
+                           "RETURNING home_team_id, away_team_id",
+                           (game["home_score"], game["away_score"], game["game_id"]))
+            teams = cursor.fetchone()
+            game_teams = set(teams or ())
+            game_updated = cursor.rowcount == 1
+            if game_updated:
+                changes.append({"type": "score", "game_id": game["game_id"],
+                                "home_team_id": teams[0], "away_team_id": teams[1],
+                                "home_score": game["home_score"],
+                                "away_score": game["away_score"]})
+            if not game_updated:
+                errors_found.append({"index": None, "message":
+                                     "game %d does not exist" % game["game_id"]})
+
+    errors_found.sort(key=lambda error: -1 if error["index"] is None else error["index"])
+    if stats_teams:
+        notify_write("stats", stats_teams)
+    if game_teams:
+        notify_write("game", game_teams)
+    notify_changes(changes)
+
+    summary = {"inserted": inserted, "game_updated": game_updated, "errors": errors_found}
+    if upsert:
+        summary["updated"] = updated
+        summary["results"] = results
+    return summary
 
 
 ############################
@@ -191,25 +1558,44 @@ def delete_player_stats(player_id, game_id):
 
 def get_player_table():
     '''
-    Retrieve all rows in the Player table
+    Retrieve all rows in the Player table as dicts
     '''
-    session = scoped_session(sessionmaker(bind=engine))
-    players = session.query(Player).all()
-    session.close()
-    return players
+    return read_rows(select(*player_list_columns))
+
+
+def stream_player_table():
+    '''
+    Stream all rows in the Player table
+    '''
+    return stream_rows(select(*player_list_columns).order_by(Player.player_id))
 
 
 ##########################
 ## Game Table Functions ##
 ##########################
-def get_game_table():
+def game_table_select(season=None):
     '''
-    Retrieve all rows in the Game table
+    Build the select of the Game table rows, of one season if given,
+    in game_id order
     '''
-    session = scoped_session(sessionmaker(bind=engine))
-    games = session.query(Game).all()
-    session.close()
-    return games
+    query = select(*game_list_columns)
+    if season is not None:
+        query = query.filter(Game.season == season)
+    return query.order_by(Game.game_id)
+
+
+def get_game_table(season=None):
+    '''
+    Retrieve all rows in the Game table (of a season) as dicts
+    '''
+    return read_rows(game_table_select(season))
+
+
+def stream_game_table(season=None):
+    '''
+    Stream all rows in the Game table (of a season)
+    '''
+    return stream_rows(game_table_select(season))
 
 
 ##########################
@@ -217,242 +1603,501 @@ def get_game_table():
 ##########################
 def get_team_table():
     '''
-    Retrieve all rows in the Team table
+    Retrieve all rows in the Team table as dicts
     '''
-    session = scoped_session(sessionmaker(bind=engine))
-    teams = session.query(Team).all()
-    session.close()
-    return teams
+    return read_rows(select(*team_list_columns))
+
+
+def stream_team_table():
+    '''
+    Stream all rows in the Team table
+    '''
+    return stream_rows(select(*team_list_columns).order_by(Team.team_id))
 
 
 ######################
 ## Report Functions ##
 ######################
-def get_team_record(team_id):
+
+# Queries shared by the report functions, the team dashboard and the
+# async report handlers (asgi.py). $1 is always the team_id and $2 the
+# season, where NULL stands for the current season. Filtering game and
+# stats on the season lets PostgreSQL skip the partitions of every other
+# season.
+
+# Season argument of the report functions asking for every season
+all_seasons = "all"
+
+season_condition = re.compile(
+    r"(?:\w+\.)?season = COALESCE\((\$\d)::int, \(SELECT current_season\(\)\)\)")
+aggregate_table = re.compile(
+    r"\b(FROM|JOIN) (team_standings|player_season_totals)\b(?: (\w+)(?= ON\b))?")
+
+# Rows of the aggregate tables added up over every season
+career_totals_selects = {
+    "team_standings": """(SELECT team_id, SUM(wins) AS wins, SUM(losses) AS losses,
+        SUM(home_wins) AS home_wins, SUM(home_losses) AS home_losses,
+        SUM(away_wins) AS away_wins, SUM(away_losses) AS away_losses,
+        SUM(points_for) AS points_for, SUM(points_against) AS points_against
+    FROM team_standings GROUP BY team_id)""",
+    "player_season_totals": """(SELECT player_id, SUM(games_played) AS games_played,
+        SUM(points) AS points, SUM(assists) AS assists, SUM(rebounds) AS rebounds,
+        SUM(blocks) AS blocks, SUM(steals) AS steals
+    FROM player_season_totals GROUP BY player_id)"""
+}
+
+
+@functools.lru_cache(maxsize=None)
+def all_seasons_query(query):
     '''
-    Get a team's win-loss record from their previous games
+    All-seasons version of a report query: its season conditions hold
+    when the season parameter is NULL (it is sent as NULL), and it reads
+    team_standings and player_season_totals added up over every season
     '''
-    conn = connect_database()
-    cursor = conn.cursor()
+    query = season_condition.sub(r"\1::int IS NULL", query)
+    return aggregate_table.sub(lambda match: "%s %s AS %s" % (
+        match.group(1), career_totals_selects[match.group(2)],
+        match.group(3) or match.group(2)), query)
 
-    record_query = """
-    PREPARE get_record (int) AS
-    SELECT 
-        (tbl.num_home_wins + tbl.num_away_wins) AS wins,
-        (tbl.num_home_losses + tbl.num_away_losses) AS losses
-    FROM (
-        SELECT
-            (
-                SELECT COUNT(*) 
-                FROM game g1 
-                WHERE g1.home_team_id = team.team_id AND 
-                    g1.home_score > g1.away_score
-            ) AS num_home_wins,
-            (
-                SELECT COUNT(*) 
-                FROM game g2
-                WHERE g2.away_team_id = team.team_id AND 
-                    g2.away_score > g2.home_score
-            ) AS num_away_wins,
-            (
-                SELECT COUNT(*) 
-                FROM game g3
-                WHERE g3.home_team_id = team.team_id AND 
-                    g3.home_score < g3.away_score
-            ) AS num_home_losses,
-            (
-                SELECT COUNT(*) 
-                FROM game g4
-                WHERE g4.away_team_id = team.team_id AND 
-                    g4.away_score < g4.home_score
-            ) AS num_away_losses
-        FROM team
-        WHERE team.team_id = $1
-    ) tbl;
-    """
-    cursor.execute(record_query)
 
-    cursor.execute("EXECUTE get_record(%s)", team_id)
-    (wins, losses) = cursor.fetchone()
+def execute_report(cursor, name, prepare_query, params):
+    '''
+    execute_prepared for a report statement. When a parameter is
+    all_seasons, the statement's all-seasons version is run instead,
+    with NULL for that parameter.
+    '''
+    if all_seasons in params:
+        prepare_query = all_seasons_query(prepare_query.replace(
+            "PREPARE %s " % name, "PREPARE %s_all_seasons " % name, 1))
+        name += "_all_seasons"
+        params = tuple(None if param == all_seasons else param for param in params)
+    execute_prepared(cursor, name, prepare_query, params)
+
+record_select = """
+SELECT wins, losses
+FROM team_standings
+WHERE team_id = $1 AND season = COALESCE($2::int, (SELECT current_season()))
+"""
+
+past_games_select = """
+SELECT
+    g1.date,
+    (ateam1.name) AS opponent,
+    (CONCAT(g1.home_score, ' - ', g1.away_score)) AS score,
+    (CASE WHEN g1.home_score > g1.away_score THEN 'W' ELSE 'L' END) AS wl
+FROM team hteam1
+    JOIN game g1 ON g1.home_team_id = hteam1.team_id
+    JOIN team ateam1 ON g1.away_team_id = ateam1.team_id
+WHERE hteam1.team_id = $1 AND g1.season = COALESCE($2::int, (SELECT current_season()))
+-- A game is either at home or away, so there are no duplicates to remove
+UNION ALL
+SELECT
+    g2.date,
+    (hteam2.name) AS opponent,
+    (CONCAT(g2.away_score, ' - ', g2.home_score)) AS score,
+    (CASE WHEN g2.away_score > g2.home_score THEN 'W' ELSE 'L' END) AS wl
+FROM team hteam2
+    JOIN game g2 ON g2.home_team_id = hteam2.team_id
+    JOIN team ateam2 ON g2.away_team_id = ateam2.team_id
+WHERE ateam2.team_id = $1 AND g2.season = COALESCE($2::int, (SELECT current_season()))
+ORDER BY date
+"""
+
+roster_select = """
+SELECT
+    CONCAT(p1.first_name, ' ', p1.last_name) AS player_name,
+    ROUND(t1.points::numeric / NULLIF(t1.games_played, 0), 1) AS PPG,
+    ROUND(t1.assists::numeric / NULLIF(t1.games_played, 0), 1) AS APG,
+    ROUND(t1.rebounds::numeric / NULLIF(t1.games_played, 0), 1) AS RPG,
+    ROUND(t1.blocks::numeric / NULLIF(t1.games_played, 0), 1) AS BPG,
+    ROUND(t1.steals::numeric / NULLIF(t1.games_played, 0), 1) AS SPG
+FROM player p1
+    LEFT OUTER JOIN player_season_totals t1 ON p1.player_id = t1.player_id
+        AND t1.season = COALESCE($2::int, (SELECT current_season()))
+WHERE p1.team_id = $1
+ORDER BY p1.player_id
+"""
+
+# All five per game averages come out of one pass over the team's
+# player_season_totals rows, and a single window ranks every category.
+# Ties are broken by player_id so the same leader is always returned.
+# $3 is the number of players to return per category.
+stats_leaders_select = """
+WITH averages AS (
+    SELECT
+        p.player_id,
+        CONCAT(p.first_name, ' ', p.last_name) AS player_name,
+        t.points::numeric / t.games_played AS ppg,
+        t.assists::numeric / t.games_played AS apg,
+        t.rebounds::numeric / t.games_played AS rpg,
+        t.blocks::numeric / t.games_played AS bpg,
+        t.steals::numeric / t.games_played AS spg
+    FROM player p
+        JOIN player_season_totals t ON p.player_id = t.player_id
+    WHERE p.team_id = $1 AND t.season = COALESCE($2::int, (SELECT current_season()))
+        AND t.games_played > 0
+),
+ranked AS (
+    SELECT
+        c.category_order,
+        c.stat_category,
+        a.player_name,
+        ROUND(c.average, 1) AS average,
+        ROW_NUMBER() OVER (
+            PARTITION BY c.category_order
+            ORDER BY c.average DESC, a.player_id
+        ) AS rank
+    FROM averages a
+        CROSS JOIN LATERAL (VALUES
+            (1, 'PPG', a.ppg),
+            (2, 'APG', a.apg),
+            (3, 'RPG', a.rpg),
+            (4, 'BPG', a.bpg),
+            (5, 'SPG', a.spg)
+        ) AS c (category_order, stat_category, average)
+)
+SELECT stat_category, rank, player_name, average
+FROM ranked
+WHERE rank <= $3
+ORDER BY category_order, rank
+"""
+
+stats_leaders_query = "PREPARE get_stats_leaders (int, int, int) AS " + stats_leaders_select
+
+# The whole team page as one JSON document, built in a single statement.
+# Averages are sent as text, like the individual report routes send them.
+team_dashboard_select = """
+SELECT json_build_object(
+    'record', (
+        SELECT json_build_object(
+            'wins', COALESCE(MAX(wins), 0),
+            'losses', COALESCE(MAX(losses), 0)
+        )
+        FROM team_standings
+        WHERE team_id = $1 AND season = COALESCE($2::int, (SELECT current_season()))
+    ),
+    'past_games', (
+        SELECT COALESCE(json_agg(json_build_object(
+            'date', to_char(pg.date, 'MM/DD/YY'),
+            'opponent', pg.opponent,
+            'score', pg.score,
+            'wl', pg.wl
+        ) ORDER BY pg.date), '[]')
+        FROM (%s) pg
+    ),
+    'roster', (
+        SELECT COALESCE(json_agg(json_build_object(
+            'player_name', r.player_name,
+            'ppg', r.ppg::text,
+            'apg', r.apg::text,
+            'rpg', r.rpg::text,
+            'bpg', r.bpg::text,
+            'spg', r.spg::text
+        )), '[]')
+        FROM (%s) r
+    ),
+    'leaders', (
+        SELECT COALESCE(json_agg(json_build_object(
+            'stat_category', l.stat_category,
+            'player_name', l.player_name
+        ) ORDER BY array_position(ARRAY['PPG', 'APG', 'RPG', 'BPG', 'SPG'],
+                                  l.stat_category::text)), '[]')
+        FROM (%s) l
+        WHERE l.rank = 1
+    )
+)
+""" % (past_games_select, roster_select, stats_leaders_select)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+team_dashboard_query = "PREPARE get_team_dashboard (int, int, int) AS " + team_dashboard_select
+
+# Game logs, latest game first, one page of $3 games at a time. $4 and
+# $5 are the date and game_id of the last game of the previous page
+# (NULL for the first page). Each side of a team's log reads at most $3
+# games from its game_home_team_index / game_away_team_index range.
+# Games without a date are left out of the logs and the form.
+team_game_log_select = """
+SELECT l.game_id, l.date, l.is_home, l.opponent_id, t.name AS opponent,
+    l.scored, l.allowed
+FROM (
+    (SELECT g.game_id, g.date, TRUE AS is_home, g.away_team_id AS opponent_id,
+        g.home_score AS scored, g.away_score AS allowed
+    FROM game g
+    WHERE g.home_team_id = $1 AND g.season = COALESCE($2::int, (SELECT current_season()))
+        AND g.home_score IS NOT NULL AND g.away_score IS NOT NULL AND g.date IS NOT NULL
+        AND ($4::date IS NULL OR (g.date, g.game_id) < ($4::date, $5::int))
+    ORDER BY g.date DESC, g.game_id DESC
+    LIMIT $3)
+    UNION ALL
+    (SELECT g.game_id, g.date, FALSE, g.home_team_id, g.away_score, g.home_score
+    FROM game g
+    WHERE g.away_team_id = $1 AND g.season = COALESCE($2::int, (SELECT current_season()))
+        AND g.home_score IS NOT NULL AND g.away_score IS NOT NULL AND g.date IS NOT NULL
+        AND ($4::date IS NULL OR (g.date, g.game_id) < ($4::date, $5::int))
+    ORDER BY g.date DESC, g.game_id DESC
+    LIMIT $3)
+) l
+    JOIN team t ON t.team_id = l.opponent_id
+ORDER BY l.date DESC, l.game_id DESC
+LIMIT $3
+"""
+
+# The opponent and result are those of the player's current team
+player_game_log_select = """
+SELECT s.game_id, g.date, g.home_team_id = p.team_id AS is_home,
+    o.team_id AS opponent_id, o.name AS opponent,
+    CASE WHEN g.home_team_id = p.team_id THEN g.home_score ELSE g.away_score END AS scored,
+    CASE WHEN g.home_team_id = p.team_id THEN g.away_score ELSE g.home_score END AS allowed,
+    s.points, s.assists, s.rebounds, s.blocks, s.steals
+FROM stats s
+    JOIN player p ON p.player_id = s.player_id
+    JOIN game g ON g.game_id = s.game_id AND g.season = s.season
+    LEFT JOIN team o ON o.team_id = CASE WHEN g.home_team_id = p.team_id
+                                         THEN g.away_team_id ELSE g.home_team_id END
+WHERE s.player_id = $1 AND s.season = COALESCE($2::int, (SELECT current_season()))
+    AND g.season = COALESCE($2::int, (SELECT current_season())) AND g.date IS NOT NULL
+    AND ($4::date IS NULL OR (g.date, g.game_id) < ($4::date, $5::int))
+ORDER BY g.date DESC, g.game_id DESC
+LIMIT $3
+"""
+
+team_form_select = """
+SELECT games, wins, points_for, points_against, streak
+FROM team_form
+WHERE team_id = $1 AND season = COALESCE($2::int, (SELECT current_season()))
+"""
+
+# Last games and whole season of a player, to compare the two
+player_form_select = """
+SELECT cardinality(f.game_ids), r.points, r.assists, r.rebounds, r.blocks, r.steals,
+    t.games_played, t.points, t.assists, t.rebounds, t.blocks, t.steals
+FROM player_form f
+    CROSS JOIN LATERAL (
+        SELECT COALESCE(SUM(u.points), 0) AS points,
+            COALESCE(SUM(u.assists), 0) AS assists,
+            COALESCE(SUM(u.rebounds), 0) AS rebounds,
+            COALESCE(SUM(u.blocks), 0) AS blocks,
+            COALESCE(SUM(u.steals), 0) AS steals
+        FROM unnest(f.points, f.assists, f.rebounds, f.blocks, f.steals)
+            AS u (points, assists, rebounds, blocks, steals)
+    ) r
+    JOIN player_season_totals t ON t.player_id = f.player_id AND t.season = f.season
+WHERE f.player_id = $1 AND f.season = COALESCE($2::int, (SELECT current_season()))
+"""
+
+
+def get_team_record(team_id, season=None):
+    '''
+    Get a team's win-loss record from their previous games of a season
+    (the current one if season is None, every season if all_seasons)
+    '''
+    record_query = "PREPARE get_record (int, int) AS " + record_select
+
+    with pooled_cursor() as cursor:
+        execute_report(cursor, "get_record", record_query, (team_id, season))
+        row = cursor.fetchone()
+
+    # Teams that have not finished a game yet have no standings row
+    (wins, losses) = row if row is not None else (0, 0)
 
     return (wins, losses)
 
 
-def get_team_past_games(team_id):
+def get_team_past_games(team_id, season=None):
     '''
     Get a summary of a team's performance in their
-    past games (date, opponent, score, w/l)
+    past games of a season (date, opponent, score, w/l)
     '''
-    conn = connect_database()
-    cursor = conn.cursor()
+    games_query = "PREPARE get_past_games (int, int) AS " + past_games_select
 
-    games_query = """
-    PREPARE get_past_games(int) AS
-    SELECT
-        g1.date,
-        (ateam1.name) AS opponent,
-        (CONCAT(g1.home_score, ' - ', g1.away_score)) AS score,
-        (CASE WHEN g1.home_score > g1.away_score THEN 'W' ELSE 'L' END) AS wl
-    FROM team hteam1
-        JOIN game g1 ON g1.home_team_id = hteam1.team_id
-        JOIN team ateam1 ON g1.away_team_id = ateam1.team_id
-    WHERE hteam1.team_id = $1
-    UNION
-    SELECT
-        g2.date,
-        (hteam2.name) AS opponent,
-        (CONCAT(g2.away_score, ' - ', g2.home_score)) AS score,
-        (CASE WHEN g2.away_score > g2.home_score THEN 'W' ELSE 'L' END) AS wl
-    FROM team hteam2
-        JOIN game g2 ON g2.home_team_id = hteam2.team_id
-        JOIN team ateam2 ON g2.away_team_id = ateam2.team_id
-    WHERE ateam2.team_id = $1;
-    """
+    with pooled_cursor() as cursor:
+        execute_report(cursor, "get_past_games", games_query, (team_id, season))
+        past_games = cursor.fetchall()
 
-    cursor.execute(games_query)
+    return past_games
 
-    cursor.execute("EXECUTE get_past_games(%s)", team_id)
-    past_games = cursor.fetchall()
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+def get_team_game_log(team_id, season=None, limit=20, after=None):
+    '''
+    Get a page of a team's game log of a season, latest game first, and
+    its form over its last form_games games. after is the (date, game_id)
+    of the last game of the previous page.
+    '''
+    log_query = ("PREPARE get_team_game_log (int, int, int, date, int) AS "
+                 + team_game_log_select)
+    form_query = "PREPARE get_team_form (int, int) AS " + team_form_select
 
-    return past_games
+    with pooled_cursor() as cursor:
+        execute_report(cursor, "get_team_game_log", log_query,
+                       (team_id, season, limit) + tuple(after or (None, None)))
+        games = cursor.fetchall()
+        # The form of the current season stands for all seasons
+        form_season = None if season == all_seasons else season
+        execute_prepared(cursor, "get_team_form", form_query, (team_id, form_season))
+        form = cursor.fetchone()
+
+    return (games, form)
 
 
-def get_team_roster_stats(team_id):
+def get_player_game_log(player_id, season=None, limit=20, after=None):
     '''
-    Get all the players on a team's roster and
-    their average statistics per game
+    Get a page of a player's game log of a season, latest game first,
+    and their form over their last form_games games (see get_team_game_log)
     '''
-    conn = connect_database()
-    cursor = conn.cursor()
+    log_query = ("PREPARE get_player_game_log (int, int, int, date, int) AS "
+                 + player_game_log_select)
+    form_query = "PREPARE get_player_form (int, int) AS " + player_form_select
 
-    roster_query = """
-    PREPARE get_roster_stats(int) AS
-    SELECT
-        MAX(CONCAT(p1.first_name, ' ', p1.last_name)) AS player_name,
-        ROUND(AVG(s1.points), 1) AS PPG,
-        ROUND(AVG(s1.assists), 1) AS APG,
-        ROUND(AVG(s1.rebounds), 1) AS RPG,
-        ROUND(AVG(s1.blocks), 1) AS BPG,
-        ROUND(AVG(s1.steals), 1) AS SPG
-    FROM player p1
-        LEFT OUTER JOIN stats s1 ON p1.player_id = s1.player_id
-    WHERE p1.team_id = $1
-    GROUP BY p1.player_id;
-    """
+    with pooled_cursor() as cursor:
+        execute_report(cursor, "get_player_game_log", log_query,
+                       (player_id, season, limit) + tuple(after or (None, None)))
+        games = cursor.fetchall()
+        # The form of the current season stands for all seasons
+        form_season = None if season == all_seasons else season
+        execute_prepared(cursor, "get_player_form", form_query, (player_id, form_season))
+        form = cursor.fetchone()
 
-    cursor.execute(roster_query)
+    return (games, form)
 
-    cursor.execute("EXECUTE get_roster_stats(%s)", team_id)
-    roster = cursor.fetchall()
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+def get_team_roster_stats(team_id, season=None):
+    '''
+    Get all the players on a team's roster and
+    their average statistics per game in a season
+    '''
+    roster_query = "PREPARE get_roster_stats (int, int) AS " + roster_select
+
+    with pooled_cursor() as cursor:
+        execute_report(cursor, "get_roster_stats", roster_query, (team_id, season))
+        roster = cursor.fetchall()
 
     return roster
 
 
-def get_team_stats_leaders(team_id):
+def get_team_stats_leaders(team_id, top_n=1, season=None):
     '''
-    Get the players on a team who have the highest
-    average for each per game statistic
+    Get the players on a team who have the highest average for each
+    per game statistic in a season, as (stat_category, rank, player_name,
+    average) rows with the top_n players per category
     '''
-    conn = connect_database()
-    cursor = conn.cursor()
+    with pooled_cursor() as cursor:
+        execute_report(cursor, "get_stats_leaders", stats_leaders_query,
+                       (team_id, season, top_n))
+        leaders = cursor.fetchall()
 
-    leaders_query = """
-    PREPARE get_stats_leaders(int) AS
-    SELECT
-        'PPG' AS stat_category,
-        temp1.player_name
-    FROM (
-        SELECT
-            MAX(CONCAT(p1.first_name, ' ', p1.last_name)) AS player_name,
-            ROUND(AVG(s1.points), 1) AS PPG
-        FROM player p1
-            JOIN stats s1 ON p1.player_id = s1.player_id
-        WHERE p1.team_id = $1
-        GROUP BY p1.player_id
-        ORDER BY PPG DESC
-        LIMIT 1
-    ) temp1
-    UNION
-    SELECT
-        'APG' AS stat_category,
-        temp2.player_name
-    FROM (
-        SELECT
-            MAX(CONCAT(p2.first_name, ' ', p2.last_name)) AS player_name,
-            ROUND(AVG(s2.assists), 1) AS APG
-        FROM player p2
-            JOIN stats s2 ON p2.player_id = s2.player_id
-        WHERE p2.team_id = $1
-        GROUP BY p2.player_id
-        ORDER BY APG DESC
-        LIMIT 1
-    ) temp2
-    UNION
+    return leaders
+
+
+def get_team_dashboard(team_id, season=None):
+    '''
+    Get a team's record, past games, roster averages and stats leaders
+    of a season in one round trip, as a dict shaped like the four report
+    routes
+    '''
+    with pooled_cursor() as cursor:
+        execute_report(cursor, "get_team_dashboard", team_dashboard_query,
+                       (team_id, season, 1))
+        (dashboard,) = cursor.fetchone()
+
+    return dashboard
+
+
+# Standings of every team in a season ($1, NULL for the current one) from
+# team_standings in one statement. Games behind is measured against the
+# team with the best wins minus losses.
+league_standings_select = """
+WITH records AS (
     SELECT
-        'RPG' AS stat_category,
-        temp3.player_name
-    FROM (
-        SELECT
-            MAX(CONCAT(p3.first_name, ' ', p3.last_name)) AS player_name,
-            ROUND(AVG(s3.rebounds), 1) AS RPG
-        FROM player p3
-            JOIN stats s3 ON p3.player_id = s3.player_id
-        WHERE p3.team_id = $1
-        GROUP BY p3.player_id
-        ORDER BY RPG DESC
-        LIMIT 1
-    ) temp3
-    UNION
+        t.team_id,
+        t.name,
+        COALESCE(s.wins, 0) AS wins,
+        COALESCE(s.losses, 0) AS losses,
+        COALESCE(s.points_for, 0) - COALESCE(s.points_against, 0) AS point_differential
+    FROM team t
+        LEFT OUTER JOIN team_standings s ON t.team_id = s.team_id
+            AND s.season = COALESCE($1::int, (SELECT current_season()))
+)
+SELECT
+    team_id,
+    name,
+    wins,
+    losses,
+    ROUND(wins::numeric / NULLIF(wins + losses, 0), 3) AS win_pct,
+    ROUND((MAX(wins - losses) OVER () - (wins - losses)) / 2.0, 1) AS games_behind,
+    point_differential
+FROM records
+ORDER BY win_pct DESC NULLS LAST, point_differential DESC, team_id
+"""
+
+league_standings_query = "PREPARE get_league_standings (int) AS " + league_standings_select
+
+# Same ranking as stats_leaders_select, over every player in the league.
+# $1 is the season and $2 the number of players per category.
+league_leaders_select = """
+WITH averages AS (
     SELECT
-        'BPG' AS stat_category,
-        temp4.player_name
-    FROM (
-        SELECT
-            MAX(CONCAT(p4.first_name, ' ', p4.last_name)) AS player_name,
-            ROUND(AVG(s4.blocks), 1) AS BPG
-        FROM player p4
-            JOIN stats s4 ON p4.player_id = s4.player_id
-        WHERE p4.team_id = $1
-        GROUP BY p4.player_id
-        ORDER BY BPG DESC
-        LIMIT 1
-    ) temp4
-    UNION
+        p.player_id,
+        CONCAT(p.first_name, ' ', p.last_name) AS player_name,
+        tm.name AS team_name,
+        t.points::numeric / t.games_played AS ppg,
+        t.assists::numeric / t.games_played AS apg,
+        t.rebounds::numeric / t.games_played AS rpg,
+        t.blocks::numeric / t.games_played AS bpg,
+        t.steals::numeric / t.games_played AS spg
+    FROM player p
+        JOIN player_season_totals t ON p.player_id = t.player_id
+        JOIN team tm ON p.team_id = tm.team_id
+    WHERE t.season = COALESCE($1::int, (SELECT current_season())) AND t.games_played > 0
+),
+ranked AS (
     SELECT
-        'SPG' AS stat_category,
-        temp5.player_name
-    FROM (
-        SELECT
-            MAX(CONCAT(p5.first_name, ' ', p5.last_name)) AS player_name,
-            ROUND(AVG(s5.steals), 1) AS SPG
-        FROM player p5
-            JOIN stats s5 ON p5.player_id = s5.player_id
-        WHERE p5.team_id = $1
-        GROUP BY p5.player_id
-        ORDER BY SPG DESC
-        LIMIT 1
-    ) temp5;
-    """
+        c.category_order,
+        c.stat_category,
+        a.player_name,
+        a.team_name,
+        ROUND(c.average, 1) AS average,
+        ROW_NUMBER() OVER (
+            PARTITION BY c.category_order
+            ORDER BY c.average DESC, a.player_id
+        ) AS rank
+    FROM averages a
+        CROSS JOIN LATERAL (VALUES
+            (1, 'PPG', a.ppg),
+            (2, 'APG', a.apg),
+            (3, 'RPG', a.rpg),
+            (4, 'BPG', a.bpg),
+            (5, 'SPG', a.spg)
+        ) AS c (category_order, stat_category, average)
+)
+SELECT stat_category, rank, player_name, team_name, average
+FROM ranked
+WHERE rank <= $2
+ORDER BY category_order, rank
+"""
 
-    cursor.execute(leaders_query)
+league_leaders_query = "PREPARE get_league_leaders (int, int) AS " + league_leaders_select
 
-    cursor.execute("EXECUTE get_stats_leaders(%s)", team_id)
-    leaders = cursor.fetchall()
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+def get_league_standings(season=None):
+    '''
+    Get the standings of every team in a season, as (team_id, name, wins,
+    losses, win_pct, games_behind, point_differential) rows, best team first
+    '''
+    with pooled_cursor() as cursor:
+        execute_report(cursor, "get_league_standings", league_standings_query,
+                       (season,))
+        standings = cursor.fetchall()
+
+    return standings
+
+
+def get_league_stats_leaders(top_n=1, season=None):
+    '''
+    Get the top_n players of the whole league for each per game statistic
+    in a season, as (stat_category, rank, player_name, team_name, average) rows
+    '''
+    with pooled_cursor() as cursor:
+        execute_report(cursor, "get_league_leaders", league_leaders_query,
+                       (season, top_n))
+        leaders = cursor.fetchall()
 
-    return leaders
\ No newline at end of file
+    return leaders
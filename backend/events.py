@@ -0,0 +1,345 @@
+# Live stat and score events pushed to viewers with Server-Sent Events
+#
+# Writes hand the rows they changed to database.change_listeners. The
+# event bus groups them into events (the stat lines written or deleted in
+# a game, a game's new score) and publishes them to the broker, which
+# queues each event for the subscribers that asked for its game or team.
+# /events/stream then sends a subscriber's events as they arrive, so a
+# viewer receives the changed rows instead of polling whole tables.
+#
+# EVENTS_BUS picks how events reach the broker:
+#   local     the broker of the process that made the write (one worker)
+#   postgres  NOTIFY on a PostgreSQL channel, which every worker LISTENs
+#             to, so viewers connected to any worker see every write
+#
+# Each event gets an id, and the broker keeps the last EVENTS_HISTORY
+# events so a reconnecting client (Last-Event-ID) gets what it missed. A
+# client that cannot be caught up, or reads too slowly to keep up with
+# EVENTS_QUEUE_SIZE queued events, gets a "reset" event and should fetch
+# the tables again.
+import asyncio
+import collections
+import json
+import os
+import queue
+import select
+import threading
+import time
+import uuid
+
+import psycopg2
+from sqlalchemy.engine import make_url
+
+import database as db
+
+bus_mode = os.getenv("EVENTS_BUS", "local")
+queue_size = int(os.getenv("EVENTS_QUEUE_SIZE", "256"))
+history_size = int(os.getenv("EVENTS_HISTORY", "1000"))
+# Seconds between keep-alive comments on an idle stream
+keepalive = float(os.getenv("EVENTS_KEEPALIVE", "15"))
+
+# NOTIFY channel of the postgres bus, and the largest payload sent
+# per notification (PostgreSQL's limit is 8000 bytes)
+notify_channel = "blm_events"
+max_payload = 7900
+
+# Sent to a subscriber whose events could not all be delivered
+reset_event = {"id": None, "event": "reset", "game_id": None, "team_ids": [], "data": {}}
+
+
+def change_events(changes):
+    '''
+    Group a write's changes into events: the stat lines written, and
+    the stat lines deleted, per game, then the new score of each game
+    '''
+    lines = collections.OrderedDict()
+    scores = []
+    for change in changes:
+        data = {key: value for (key, value) in change.items() if key != "type"}
+        if change["type"] == "score":
+            scores.append({"event": "score", "game_id": change["game_id"],
+                           "team_ids": [change["home_team_id"], change["away_team_id"]],
+                           "data": data})
+        else:
+            lines.setdefault((change["type"], change["game_id"]), []).append(data)
+    return [{
+        "event": event,
+        "game_id": game_id,
+        "team_ids": sorted({line["team_id"] for line in game_lines
+                            if line["team_id"] is not None}),
+        "data": {"game_id": game_id, "lines": game_lines}
+    } for ((event, game_id), game_lines) in lines.items()] + scores
+
+
+def format_event(event):
+    '''
+    Text of an event in the text/event-stream format
+    '''
+    text = "event: %s\ndata: %s\n\n" % (event["event"],
+                                        json.dumps(event["data"], separators=(",", ":")))
+    if event["id"] is not None:
+        text = "id: %s\n" % event["id"] + text
+    return text
+
+
+#######################
+## Subscriptions     ##
+#######################
+
+class Subscription:
+    '''
+    Queue of the events of some games and teams (all events when
+    none are given) for a stream served by a thread
+    '''
+    def __init__(self, game_ids=(), team_ids=()):
+        self.game_ids = set(game_ids)
+        self.team_ids = set(team_ids)
+        self.queue = queue.Queue(queue_size)
+        self.overflows = 0
+        # Held by the publishers while they queue an event
+        self.lock = threading.Lock()
+
+    def matches(self, event):
+        # Every subscriber has to fetch the tables again after a reset
+        if event["event"] == "reset" or (not self.game_ids and not self.team_ids):
+            return True
+        return (event["game_id"] in self.game_ids
+                or not self.team_ids.isdisjoint(event["team_ids"]))
+
+    def deliver(self, event):
+        '''
+        Queue an event. A subscriber too far behind loses its
+        queued events and gets a reset event instead.
+        '''
+        # Publishers take turns, so no other event can fill the queue
+        # between emptying it and queueing the reset
+        with self.lock:
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                self.overflows += 1
+                # The stream may take events at the same time, so the queue
+                # is emptied until get_nowait finds nothing
+                while True:
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                self.queue.put_nowait(reset_event)
+
+    def get(self, timeout):
+        '''
+        Next event, or None after timeout seconds without one
+        '''
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(Subscription):
+    '''
+    Subscription for a stream served by a coroutine on loop. Events are
+    published from other threads, so they are handed to the loop.
+    '''
+    def __init__(self, loop, game_ids=(), team_ids=()):
+        super().__init__(game_ids, team_ids)
+        self.loop = loop
+        self.queue = asyncio.Queue(queue_size)
+
+    def deliver(self, event):
+        self.loop.call_soon_threadsafe(self.put, event)
+
+    def put(self, event):
+        # Runs on the loop, which also runs every other put, so nothing
+        # can fill the queue between emptying it and queueing the reset
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflows += 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(reset_event)
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+#######################
+## Broker            ##
+#######################
+
+class Broker:
+    '''
+    Delivers published events to the matching subscriptions of this
+    process and keeps the most recent ones for reconnecting clients
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.history = collections.deque(maxlen=history_size)
+        # Ids are only meaningful to the process that gave them
+        self.epoch = uuid.uuid4().hex[:8]
+        self.sequence = 0
+        self.published = 0
+        self.delivered = 0
+
+    def publish(self, events):
+        with self.lock:
+            for event in events:
+                self.sequence += 1
+                event["id"] = "%s-%d" % (self.epoch, self.sequence)
+                self.history.append(event)
+            subscriptions = list(self.subscriptions)
+            self.published += len(events)
+        delivered = 0
+        for subscription in subscriptions:
+            for event in events:
+                if subscription.matches(event):
+                    subscription.deliver(event)
+                    delivered += 1
+        with self.lock:
+            self.delivered += delivered
+
+    def subscribe(self, subscription, last_event_id=None):
+        '''
+        Start delivering events to subscription, first the events after
+        last_event_id when the client reconnects
+        '''
+        with self.lock:
+            self.subscriptions.add(subscription)
+            if last_event_id is None:
+                return subscription
+            ids = [event["id"] for event in self.history]
+            if last_event_id not in ids:
+                missed = [reset_event]
+            else:
+                missed = list(self.history)[ids.index(last_event_id) + 1:]
+            for event in missed:
+                if subscription.matches(event):
+                    subscription.deliver(event)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "subscribers": len(self.subscriptions),
+                "published": self.published,
+                "delivered": self.delivered
+            }
+
+
+#######################
+## Event buses       ##
+#######################
+
+class LocalBus:
+    '''
+    Publishes a write's events to the broker of this process
+    '''
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish_changes(self, changes):
+        '''
+        Database change listener
+        '''
+        self.broker.publish(change_events(changes))
+
+    def start(self):
+        pass
+
+
+def notify_payloads(events):
+    '''
+    JSON payloads of events, each small enough for one notification.
+    Events with too many lines for one payload are split.
+    '''
+    payloads = []
+    for event in events:
+        payload = json.dumps(event, separators=(",", ":"))
+        lines = event["data"].get("lines", [])
+        if len(payload.encode()) <= max_payload or len(lines) < 2:
+            payloads.append(payload)
+            continue
+        half = len(lines) // 2
+        payloads += notify_payloads([
+            dict(event, data=dict(event["data"], lines=part))
+            for part in (lines[:half], lines[half:])])
+    return payloads
+
+
+class PostgresBus:
+    '''
+    Publishes a write's events with NOTIFY, and feeds the broker of this
+    process from a thread that LISTENs on the channel, so every worker
+    delivers every worker's events
+    '''
+    def __init__(self, broker):
+        self.broker = broker
+        self.lock = threading.Lock()
+        self.thread = None
+        self.reconnects = 0
+
+    def publish_changes(self, changes):
+        '''
+        Database change listener. The write has already committed, so
+        the notifications are sent in their own short transaction.
+        '''
+        payloads = notify_payloads(change_events(changes))
+        with db.pooled_cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload",
+                           (notify_channel, payloads))
+
+    def start(self):
+        '''
+        Start listening, once per process, when the first stream opens
+        '''
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.listen, name="events-listener",
+                                               daemon=True)
+                self.thread.start()
+
+    def listen(self):
+        # A connection of its own: it stays in LISTEN for the life of the process
+        dsn = make_url(db.db_uri).set(drivername="postgresql").render_as_string(
+            hide_password=False)
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.autocommit = True
+                conn.cursor().execute("LISTEN %s" % notify_channel)
+                while True:
+                    if select.select([conn], [], [], keepalive) == ([], [], []):
+                        continue
+                    conn.poll()
+                    events = [json.loads(notify.payload) for notify in conn.notifies]
+                    conn.notifies.clear()
+                    if events:
+                        self.broker.publish(events)
+            except psycopg2.Error:
+                # Events sent while reconnecting are lost
+                self.reconnects += 1
+                self.broker.publish([dict(reset_event)])
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+def create_event_bus(broker):
+    '''
+    Build the bus described by EVENTS_BUS: "local" (default) or "postgres"
+    '''
+    if bus_mode == "postgres":
+        return PostgresBus(broker)
+    return LocalBus(broker)
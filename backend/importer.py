@@ -0,0 +1,251 @@
+# Import teams, players, games and stats from CSV or Parquet files
+#
+#   cd backend && python importer.py --teams teams.csv --players players.csv \
+#       --games games.csv --stats stats.csv
+#
+# Rows refer to each other by natural keys instead of ids:
+#   teams:   name, coach
+#   players: team_name, first_name, last_name, position, jersey_number
+#   games:   date, time, location, home_team, home_score, away_team, away_score
+#   stats:   date, home_team, away_team, first_name, last_name, jersey_number,
+#            points, assists, rebounds, blocks, steals
+# A stat line is matched to its game by (date, home_team, away_team) and to
+# its player by (first_name, last_name, jersey_number).
+#
+# Each batch is COPYed into a temporary staging table and inserted with one
+# INSERT ... SELECT that resolves the natural keys. Rows that already exist
+# are skipped, and the number of rows done per file is committed together
+# with each batch, so an interrupted import can simply be run again.
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+
+import database as db
+
+# Staging columns for each kind of file, in the order they are copied
+staging_columns = {
+    "team": ["name", "coach"],
+    "player": ["team_name", "first_name", "last_name", "position", "jersey_number"],
+    "game": ["date", "time", "location", "home_team", "home_score",
+             "away_team", "away_score"],
+    "stats": ["date", "home_team", "away_team", "first_name", "last_name",
+              "jersey_number", "points", "assists", "rebounds", "blocks", "steals"]
+}
+
+# One id per team name and per player natural key, even if
+# the tables already hold duplicates
+team_keys = """
+SELECT name, MIN(team_id) AS team_id FROM team GROUP BY name
+"""
+player_keys = """
+SELECT first_name, last_name, jersey_number, MIN(player_id) AS player_id
+FROM player
+GROUP BY first_name, last_name, jersey_number
+"""
+
+insert_queries = {
+    "team": """
+    INSERT INTO team (name, coach)
+    SELECT DISTINCT ON (s.name) s.name, s.coach
+    FROM import_team s
+    WHERE NOT EXISTS (SELECT 1 FROM team t WHERE t.name = s.name);
+    """,
+    "player": """
+    INSERT INTO player (team_id, first_name, last_name, position, jersey_number)
+    SELECT DISTINCT ON (s.first_name, s.last_name, s.jersey_number::int)
+        t.team_id, s.first_name, s.last_name, s.position, s.jersey_number::int
+    FROM import_player s
+        JOIN (%s) t ON t.name = s.team_name
+    WHERE NOT EXISTS (
+        SELECT 1 FROM player p
+        WHERE p.first_name = s.first_name AND p.last_name = s.last_name
+            AND p.jersey_number = s.jersey_number::int
+    );
+    """ % team_keys,
+    "game": """
+    INSERT INTO game (season, date, time, location, home_team_id, home_score,
+                      away_team_id, away_score)
+    SELECT DISTINCT ON (s.date::date, ht.team_id, at.team_id)
+        season_of(s.date::date), s.date::date, s.time::time, s.location, ht.team_id,
+        s.home_score::int, at.team_id, s.away_score::int
+    FROM import_game s
+        JOIN (%s) ht ON ht.name = s.home_team
+        JOIN (%s) at ON at.name = s.away_team
+    WHERE NOT EXISTS (
+        SELECT 1 FROM game g
+        WHERE g.season = season_of(s.date::date) AND g.date = s.date::date
+            AND g.home_team_id = ht.team_id AND g.away_team_id = at.team_id
+    );
+    """ % (team_keys, team_keys),
+    "stats": """
+    WITH teams AS (%s),
+    games AS (
+        SELECT g.date, g.home_team_id, g.away_team_id, g.season,
+            MIN(g.game_id) AS game_id
+        FROM game g
+        WHERE g.date IN (SELECT DISTINCT date::date FROM import_stats)
+        GROUP BY g.date, g.home_team_id, g.away_team_id, g.season
+    )
+    INSERT INTO stats (player_id, game_id, season, points, assists, rebounds,
+                       blocks, steals)
+    SELECT p.player_id, g.game_id, g.season, s.points::int, s.assists::int,
+        s.rebounds::int, s.blocks::int, s.steals::int
+    FROM import_stats s
+        JOIN teams ht ON ht.name = s.home_team
+        JOIN teams at ON at.name = s.away_team
+        JOIN games g ON g.date = s.date::date AND g.home_team_id = ht.team_id
+            AND g.away_team_id = at.team_id
+        JOIN (%s) p ON p.first_name = s.first_name AND p.last_name = s.last_name
+            AND p.jersey_number = s.jersey_number::int
+    ON CONFLICT (player_id, game_id, season) DO NOTHING;
+    """ % (team_keys, player_keys)
+}
+
+save_progress_query = """
+INSERT INTO import_progress (source, rows_done, updated_at)
+VALUES (%s, %s, now())
+ON CONFLICT (source) DO UPDATE SET
+    rows_done = EXCLUDED.rows_done,
+    updated_at = EXCLUDED.updated_at;
+"""
+
+
+def read_csv(path):
+    '''
+    Yield the rows of a CSV file (with a header line) as dicts
+    '''
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            yield row
+
+
+def read_parquet(path, batch_size):
+    '''
+    Yield the rows of a Parquet file as dicts, one record batch at a time
+    '''
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Reading Parquet files requires pyarrow (pip install pyarrow)")
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        for row in batch.to_pylist():
+            yield row
+
+
+def read_rows(path, batch_size):
+    '''
+    Yield the rows of a CSV or Parquet file as dicts
+    '''
+    if path.endswith(".parquet"):
+        return read_parquet(path, batch_size)
+    return read_csv(path)
+
+
+def batches(rows, batch_size, skip):
+    '''
+    Group rows into lists of batch_size, after skipping
+    the rows a previous run already imported
+    '''
+    batch = []
+    for (number, row) in enumerate(rows):
+        if number < skip:
+            continue
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_rows_done(source):
+    '''
+    Number of rows of a source already imported by previous runs
+    '''
+    with db.pooled_cursor() as cursor:
+        cursor.execute("SELECT rows_done FROM import_progress WHERE source = %s",
+                       (source,))
+        row = cursor.fetchone()
+    return row[0] if row is not None else 0
+
+
+def import_batch(cursor, kind, batch):
+    '''
+    COPY one batch into the staging table and insert it into the
+    real table, returning the number of new rows
+    '''
+    columns = staging_columns[kind]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in batch:
+        # Empty values are written unquoted, which COPY reads as NULL
+        writer.writerow(["" if row.get(column) is None else row[column]
+                         for column in columns])
+    buffer.seek(0)
+    cursor.copy_expert("COPY import_%s (%s) FROM STDIN WITH (FORMAT csv)"
+                       % (kind, ", ".join(columns)), buffer)
+    if kind == "game":
+        # Each season's games go to their own partition
+        cursor.execute("SELECT DISTINCT season_of(date::date) FROM import_game")
+        db.create_season_partitions(cursor, {season for (season,) in cursor.fetchall()})
+    cursor.execute(insert_queries[kind])
+    return cursor.rowcount
+
+
+def import_file(kind, path, batch_size, restart=False):
+    '''
+    Import one file in batches, resuming after the rows
+    a previous run of the same file already committed
+    '''
+    source = "%s:%s" % (kind, os.path.abspath(path))
+    rows_done = 0 if restart else get_rows_done(source)
+    if rows_done:
+        print("%s: resuming %s after %d rows" % (kind, path, rows_done), file=sys.stderr)
+
+    inserted = 0
+    start = time.perf_counter()
+    staging = ", ".join("%s text" % column for column in staging_columns[kind])
+    for batch in batches(read_rows(path, batch_size), batch_size, rows_done):
+        with db.pooled_cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_%s (%s) ON COMMIT DELETE ROWS"
+                           % (kind, staging))
+            inserted += import_batch(cursor, kind, batch)
+            rows_done += len(batch)
+            # Saved in the same transaction as the batch itself
+            cursor.execute(save_progress_query, (source, rows_done))
+
+        elapsed = time.perf_counter() - start
+        print("%s: %d rows read, %d inserted (%.0f rows/s)"
+              % (kind, rows_done, inserted, rows_done / max(elapsed, 1e-9)),
+              file=sys.stderr)
+    return inserted
+
+
+def main():
+    '''
+    Parse the command line and import the given files in dependency order
+    '''
+    parser = argparse.ArgumentParser(
+        description="Import teams, players, games and stats from CSV or Parquet files")
+    parser.add_argument("--teams")
+    parser.add_argument("--players")
+    parser.add_argument("--games")
+    parser.add_argument("--stats")
+    parser.add_argument("--batch-size", type=int, default=50000)
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore saved progress and read every file from the start")
+    args = parser.parse_args()
+
+    db.create_tables()
+    for (kind, path) in [("team", args.teams), ("player", args.players),
+                         ("game", args.games), ("stats", args.stats)]:
+        if path is not None:
+            inserted = import_file(kind, path, args.batch_size, args.restart)
+            print("%s: done, %d new rows" % (kind, inserted), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# Per-request profiling and the Prometheus metrics served at /metrics
+#
+# A request's profile is the difference between the current thread's
+# counters (see database.get_thread_profile) at its start and at its end:
+# number of queries, seconds spent in them, seconds spent waiting for a
+# pooled connection, and seconds spent serializing JSON.
+import threading
+import time
+
+import database as db
+from serialization import FastJSONProvider
+
+# Seconds each thread has spent serializing JSON
+serialize_profile = threading.local()
+
+
+def get_serialize_seconds():
+    return getattr(serialize_profile, "seconds", 0.0)
+
+
+class ProfilingJSONProvider(FastJSONProvider):
+    '''
+    Flask JSON provider timing every dumps call
+    '''
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            serialize_profile.seconds = (get_serialize_seconds()
+                                         + time.perf_counter() - start)
+
+
+def start_request():
+    '''
+    Snapshot of the current thread's counters when a request starts
+    '''
+    snapshot = db.get_thread_profile()
+    snapshot["serialize_seconds"] = get_serialize_seconds()
+    snapshot["start"] = time.perf_counter()
+    return snapshot
+
+
+def finish_request(snapshot):
+    '''
+    Profile of the request started with snapshot
+    '''
+    current = db.get_thread_profile()
+    return {
+        "seconds": time.perf_counter() - snapshot["start"],
+        "queries": current["queries"] - snapshot["queries"],
+        "db_seconds": current["db_seconds"] - snapshot["db_seconds"],
+        "acquire_seconds": current["acquire_seconds"] - snapshot["acquire_seconds"],
+        "serialize_seconds": get_serialize_seconds() - snapshot["serialize_seconds"]
+    }
+
+
+def server_timing(profile):
+    '''
+    Server-Timing header value describing a request profile
+    '''
+    return "db;dur=%.2f, acquire;dur=%.2f, serialize;dur=%.2f, total;dur=%.2f" % (
+        profile["db_seconds"] * 1000, profile["acquire_seconds"] * 1000,
+        profile["serialize_seconds"] * 1000, profile["seconds"] * 1000)
+
+
+class RequestMetrics:
+    '''
+    Request counters and a duration histogram per (method, endpoint, status)
+    '''
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, method, endpoint, status, profile):
+        '''
+        Add one request's profile to its series
+        '''
+        key = (method, endpoint, str(status))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {
+                    "count": 0, "seconds": 0.0, "queries": 0, "db_seconds": 0.0,
+                    "acquire_seconds": 0.0, "serialize_seconds": 0.0,
+                    "buckets": [0] * len(self.buckets)
+                }
+            series["count"] += 1
+            for name in ("seconds", "queries", "db_seconds",
+                         "acquire_seconds", "serialize_seconds"):
+                series[name] += profile[name]
+            for (index, bound) in enumerate(self.buckets):
+                if profile["seconds"] <= bound:
+                    series["buckets"][index] += 1
+
+    def render(self):
+        '''
+        Lines of the Prometheus text format for every series
+        '''
+        with self.lock:
+            series = {key: dict(value, buckets=list(value["buckets"]))
+                      for (key, value) in self.series.items()}
+
+        def labels(key, **extra):
+            (method, endpoint, status) = key
+            pairs = [("method", method), ("endpoint", endpoint), ("status", status)]
+            pairs += list(extra.items())
+            return ",".join('%s="%s"' % (name, escape(value)) for (name, value) in pairs)
+
+        lines = []
+        lines += header("blm_http_request_duration_seconds", "histogram",
+                        "Time to serve a request")
+        for (key, value) in sorted(series.items()):
+            for (bound, count) in zip(self.buckets, value["buckets"]):
+                lines.append("blm_http_request_duration_seconds_bucket{%s} %d"
+                             % (labels(key, le=repr(bound)), count))
+            lines.append("blm_http_request_duration_seconds_bucket{%s} %d"
+                         % (labels(key, le="+Inf"), value["count"]))
+            lines.append("blm_http_request_duration_seconds_sum{%s} %s"
+                         % (labels(key), value["seconds"]))
+            lines.append("blm_http_request_duration_seconds_count{%s} %d"
+                         % (labels(key), value["count"]))
+
+        for (name, field, help_text) in [
+                ("blm_http_request_queries_total", "queries",
+                 "Database statements sent while serving requests"),
+                ("blm_http_request_db_seconds_total", "db_seconds",
+                 "Time spent in database statements while serving requests"),
+                ("blm_http_request_acquire_seconds_total", "acquire_seconds",
+                 "Time spent waiting for a pooled connection while serving requests"),
+                ("blm_http_request_serialize_seconds_total", "serialize_seconds",
+                 "Time spent serializing JSON while serving requests")]:
+            lines += header(name, "counter", help_text)
+            for (key, value) in sorted(series.items()):
+                lines.append("%s{%s} %s" % (name, labels(key), value[field]))
+        return lines
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def header(name, metric_type, help_text):
+    return ["# HELP %s %s" % (name, help_text), "# TYPE %s %s" % (name, metric_type)]
+
+
+def render_stats(prefix, stats, counters, help_texts):
+    '''
+    Lines for a dict of stats, as counters for the names in
+    counters and gauges for the others. None values are skipped.
+    '''
+    lines = []
+    for (name, value) in sorted(stats.items()):
+        if value is None:
+            continue
+        metric_type = "counter" if name in counters else "gauge"
+        metric = "%s_%s" % (prefix, name)
+        if metric_type == "counter" and not metric.endswith("_total"):
+            metric += "_total"
+        lines += header(metric, metric_type, help_texts.get(name, name.replace("_", " ")))
+        lines.append("%s %s" % (metric, value))
+    return lines
+
+
+def render_metrics(request_metrics, report_cache, advanced_metrics=None,
+                   event_broker=None, write_queue=None):
+    '''
+    Whole /metrics page: requests, statements, the connection pool,
+    prepared statements, the report cache, the advanced metrics arrays,
+    the event streams and the write-behind queue
+    '''
+    lines = request_metrics.render()
+    lines += render_stats("blm_db", db.get_query_stats(),
+                          ("queries", "query_seconds_total", "slow_queries"),
+                          {"queries": "Database statements sent",
+                           "query_seconds_total": "Time spent in database statements",
+                           "slow_queries": "Statements slower than SLOW_QUERY_MS"})
+    lines += render_stats("blm_db_pool", db.get_pool_stats(),
+                          ("checkouts", "connects", "invalidations", "wait_seconds_total"),
+                          {"wait_seconds_total": "Time spent waiting for a pooled connection",
+                           "wait_seconds_max": "Longest wait for a pooled connection"})
+    lines += render_stats("blm_db_prepared", db.get_statement_stats(),
+                          ("executions", "prepares"),
+                          {"connections": "Connections holding prepared statements"})
+    lines += render_stats("blm_report_cache", report_cache.stats(),
+                          ("hits", "misses", "evictions"),
+                          {"entries": "Reports in the cache"})
+    if advanced_metrics is not None:
+        lines += render_stats("blm_analytics", advanced_metrics.stats(),
+                              ("full_loads", "partial_loads", "rows_loaded"),
+                              {"seasons": "Seasons held in memory",
+                               "full_loads": "Seasons loaded in full",
+                               "partial_loads": "Refreshes of the teams written to",
+                               "rows_loaded": "Rows read into the arrays"})
+    if event_broker is not None:
+        lines += render_stats("blm_events", event_broker.stats(),
+                              ("published", "delivered"),
+                              {"subscribers": "Open event streams",
+                               "published": "Events published to this worker",
+                               "delivered": "Events queued for event streams"})
+    if write_queue is not None:
+        lines += render_stats("blm_write_behind", write_queue.stats(),
+                              ("enqueued", "coalesced", "waits", "refused", "flushed",
+                               "batches", "skipped", "flush_errors"),
+                              {"pending": "Stat lines waiting to be written",
+                               "lag_seconds": "Age of the oldest stat line waiting",
+                               "enqueued": "Stat writes queued",
+                               "coalesced": "Stat writes that replaced a waiting one",
+                               "waits": "Stat writes that waited for room in the queue",
+                               "refused": "Stat writes refused because the queue was full",
+                               "flushed": "Stat lines written to the database",
+                               "batches": "Batches written to the database",
+                               "skipped": "Flushed lines of missing players or games",
+                               "flush_errors": "Failed flushes, retried later",
+                               "last_batch_rows": "Lines in the last batch",
+                               "last_batch_seconds": "Duration of the last batch",
+                               "last_batch_lag_seconds":
+                                   "Age of the oldest line of the last batch when written"})
+    return "\n".join(lines) + "\n"
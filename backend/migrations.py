@@ -0,0 +1,436 @@
+# Versioned schema migrations and the indexes of the report queries
+#
+#   flask --app app migrate           apply pending migrations
+#   flask --app app migrate --status  list migrations and when they were applied
+#   flask --app app check-indexes     check the report queries use their indexes
+#
+# Tables are created by SQLAlchemy (database.create_tables); everything
+# else the schema needs - triggers, aggregate tables' contents, indexes - is a
+# numbered migration. Each migration runs in one transaction together with
+# the schema_migrations row recording it, so it is applied exactly once per
+# database (or per schema, for the benchmark schemas).
+import json
+from datetime import date
+
+from sqlalchemy.dialects import postgresql
+
+import database as db
+
+# Key of the advisory lock held while migrating, so that several workers
+# starting at once apply each migration only once
+migration_lock_key = 7716019
+
+
+#############
+## INDEXES ##
+#############
+# B-tree indexes shaped after the queries that use them. Columns after
+# INCLUDE are stored in the index leaves, so those queries are answered by
+# index-only scans without visiting the table.
+
+# Single-column hash indexes created at startup by earlier versions
+hash_indexes = ("player_team_index", "home_team_index", "away_team_index")
+
+# (name, statement, queries using it)
+report_indexes = [
+    ("player_team_index",
+     """CREATE INDEX IF NOT EXISTS player_team_index
+        ON player (team_id, player_id) INCLUDE (first_name, last_name)""",
+     "roster and stats leaders (players of a team in player_id order), "
+     "stats filtered by team"),
+    ("game_home_team_index",
+     """CREATE INDEX IF NOT EXISTS game_home_team_index
+        ON game (home_team_id, date) INCLUDE (away_team_id, home_score, away_score)""",
+     "past games of a team at home, by date"),
+    ("game_away_team_index",
+     """CREATE INDEX IF NOT EXISTS game_away_team_index
+        ON game (away_team_id, date) INCLUDE (home_team_id, home_score, away_score)""",
+     "past games of a team away, by date"),
+    ("game_date_index",
+     """CREATE INDEX IF NOT EXISTS game_date_index ON game (date, game_id)""",
+     "stats filtered by a date range"),
+    ("stats_game_index",
+     """CREATE INDEX IF NOT EXISTS stats_game_index ON stats (game_id, player_id)""",
+     "stats filtered by game, box scores"),
+]
+
+# Stats are read by player in (player_id, game_id) order, which is the
+# primary key, so the stat columns are included in the primary key's index
+# rather than in a second index every stats write would have to update
+stats_covering_key_query = """
+ALTER TABLE stats
+    DROP CONSTRAINT stats_pkey,
+    ADD CONSTRAINT stats_pkey PRIMARY KEY (player_id, game_id)
+        INCLUDE (points, assists, rebounds, blocks, steals)
+"""
+
+
+def create_report_indexes(cursor):
+    '''
+    Replace the hash indexes with the report indexes
+    '''
+    for name in hash_indexes:
+        cursor.execute("DROP INDEX IF EXISTS %s" % name)
+    cursor.execute(stats_covering_key_query)
+    for (name, statement, used_by) in report_indexes:
+        cursor.execute(statement)
+    # Give the planner statistics for the new indexes right away
+    cursor.execute("ANALYZE player, game, stats")
+
+
+################
+## Partitions ##
+################
+# game and stats are partitioned by LIST (season): reports filter on one
+# season, so they only read that season's partitions however many seasons
+# are stored. Rows of seasons without their own partition go to the
+# default partitions.
+
+partitioned_tables_query = """
+CREATE TABLE game (
+    game_id integer NOT NULL DEFAULT nextval('%s'::regclass),
+    season integer NOT NULL,
+    date date,
+    time time without time zone,
+    location varchar(100),
+    home_team_id integer REFERENCES team (team_id),
+    home_score integer,
+    away_team_id integer REFERENCES team (team_id),
+    away_score integer,
+    CONSTRAINT game_pkey PRIMARY KEY (game_id, season)
+) PARTITION BY LIST (season);
+
+CREATE TABLE stats (
+    player_id integer NOT NULL REFERENCES player (player_id),
+    game_id integer NOT NULL,
+    season integer NOT NULL,
+    points integer,
+    assists integer,
+    rebounds integer,
+    blocks integer,
+    steals integer,
+    CONSTRAINT stats_pkey PRIMARY KEY (player_id, game_id, season)
+        INCLUDE (points, assists, rebounds, blocks, steals),
+    FOREIGN KEY (game_id, season) REFERENCES game (game_id, season)
+) PARTITION BY LIST (season);
+
+CREATE TABLE game_default PARTITION OF game DEFAULT;
+CREATE TABLE stats_default PARTITION OF stats DEFAULT;
+"""
+
+copy_games_query = """
+INSERT INTO game (game_id, season, date, time, location, home_team_id,
+                  home_score, away_team_id, away_score)
+SELECT game_id, season_of(date), date, time, location, home_team_id,
+    home_score, away_team_id, away_score
+FROM game_unpartitioned
+"""
+
+copy_stats_query = """
+INSERT INTO stats (player_id, game_id, season, points, assists, rebounds, blocks, steals)
+SELECT s.player_id, s.game_id, g.season, s.points, s.assists, s.rebounds,
+    s.blocks, s.steals
+FROM stats_unpartitioned s
+    JOIN game g ON g.game_id = s.game_id
+"""
+
+
+def partition_by_season(cursor):
+    '''
+    Rebuild game and stats as tables partitioned by season, with a
+    partition for each season already played, and keep the aggregate
+    tables per season
+    '''
+    cursor.execute(db.season_functions_query)
+
+    # The triggers are installed again on the new tables below
+    cursor.execute("DROP TRIGGER IF EXISTS stats_totals ON stats")
+    cursor.execute("DROP TRIGGER IF EXISTS game_standings ON game")
+    cursor.execute("DROP FUNCTION IF EXISTS apply_game_to_standings(int, int, int, int, int)")
+    cursor.execute("DROP FUNCTION IF EXISTS "
+                   "apply_stats_to_totals(int, int, int, int, int, int, int)")
+
+    # Move the old tables (and the names of their indexes) out of the way
+    cursor.execute("ALTER TABLE stats RENAME TO stats_unpartitioned")
+    cursor.execute("ALTER TABLE game RENAME TO game_unpartitioned")
+    cursor.execute("ALTER INDEX stats_pkey RENAME TO stats_unpartitioned_pkey")
+    cursor.execute("ALTER INDEX game_pkey RENAME TO game_unpartitioned_pkey")
+    for (name, statement, used_by) in report_indexes:
+        if name != "player_team_index":
+            cursor.execute("DROP INDEX IF EXISTS %s" % name)
+
+    # game_id keeps its sequence, so new games go on numbering from the last one
+    cursor.execute("SELECT pg_get_serial_sequence('game_unpartitioned', 'game_id')")
+    (sequence,) = cursor.fetchone()
+    cursor.execute("ALTER SEQUENCE %s OWNED BY NONE" % sequence)
+    cursor.execute(partitioned_tables_query % sequence)
+    cursor.execute("ALTER SEQUENCE %s OWNED BY game.game_id" % sequence)
+
+    cursor.execute("SELECT DISTINCT season_of(date) FROM game_unpartitioned")
+    db.create_season_partitions(cursor, {season for (season,) in cursor.fetchall()})
+    cursor.execute(copy_games_query)
+    cursor.execute(copy_stats_query)
+    cursor.execute("DROP TABLE stats_unpartitioned")
+    cursor.execute("DROP TABLE game_unpartitioned")
+    for (name, statement, used_by) in report_indexes:
+        cursor.execute(statement)
+
+    # One aggregate row per team (player) and season, rebuilt
+    # when the triggers are installed
+    for (table, key) in (("team_standings", "team_id"),
+                         ("player_season_totals", "player_id")):
+        cursor.execute("DELETE FROM %s" % table)
+        cursor.execute("ALTER TABLE %s ADD COLUMN IF NOT EXISTS season integer NOT NULL"
+                       % table)
+        cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s_pkey, "
+                       "ADD CONSTRAINT %s_pkey PRIMARY KEY (%s, season)"
+                       % (table, table, table, key))
+    db.create_aggregate_triggers(cursor)
+    cursor.execute("ANALYZE game, stats, team_standings, player_season_totals")
+
+
+################
+## Migrations ##
+################
+
+# (version, name, function applying it to a cursor), in order
+migrations = [
+    (1, "aggregate triggers", db.create_aggregate_triggers),
+    (2, "report indexes", create_report_indexes),
+    (3, "season partitions", partition_by_season),
+    (4, "recent form triggers", db.create_form_triggers),
+    (5, "unique game ids", db.create_game_id_guard),
+]
+
+
+def applied_migrations(cursor):
+    '''
+    {version: applied_at} of the migrations already applied
+    '''
+    cursor.execute("SELECT version, applied_at FROM schema_migrations")
+    return dict(cursor.fetchall())
+
+
+def pending_migrations():
+    '''
+    Migrations not applied yet, as (version, name, function)
+    '''
+    with db.pooled_cursor() as cursor:
+        applied = applied_migrations(cursor)
+    return [migration for migration in migrations if migration[0] not in applied]
+
+
+def migration_status():
+    '''
+    (version, name, applied_at or None) of every migration
+    '''
+    with db.pooled_cursor() as cursor:
+        applied = applied_migrations(cursor)
+    return [(version, name, applied.get(version))
+            for (version, name, apply) in migrations]
+
+
+def migrate():
+    '''
+    Apply pending migrations in order and return the (version, name)
+    of those applied
+    '''
+    db.create_tables()
+    applied_now = []
+    conn = db.connect_database()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (migration_lock_key,))
+        try:
+            applied = applied_migrations(cursor)
+            conn.commit()
+            for (version, name, apply) in migrations:
+                if version in applied:
+                    continue
+                try:
+                    apply(cursor)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, name, applied_at) "
+                        "VALUES (%s, %s, now())", (version, name))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied_now.append((version, name))
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (migration_lock_key,))
+            conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+    # Migrations may rebuild the aggregate tables, so cached reports are stale
+    if applied_now:
+        for table in ("game", "stats"):
+            db.notify_write(table)
+    return applied_now
+
+
+##################
+## Index checks ##
+##################
+
+def sample_ids(cursor):
+    '''
+    A team, player and game to plan the report queries for,
+    and the current season
+    '''
+    cursor.execute("SELECT MIN(team_id) FROM team")
+    (team_id,) = cursor.fetchone()
+    cursor.execute("SELECT MIN(player_id) FROM player")
+    (player_id,) = cursor.fetchone()
+    cursor.execute("SELECT MIN(game_id) FROM game")
+    (game_id,) = cursor.fetchone()
+    cursor.execute("SELECT current_season()")
+    (season,) = cursor.fetchone()
+    return (team_id or 1, player_id or 1, game_id or 1, season)
+
+
+def compile_select(statement):
+    '''
+    SQL text of a Core select, with its parameters inlined
+    '''
+    return str(statement.compile(dialect=postgresql.dialect(),
+                                 compile_kwargs={"literal_binds": True}))
+
+
+def report_index_checks(team_id, player_id, game_id, season):
+    '''
+    (query, SQL, parameters, indexes its plan must use, season whose
+    partitions are the only ones it may read) for every report query
+    and filtered read the report indexes are made for. The reports are
+    planned for the current season, as when no season is requested.
+    '''
+    dashboard_indexes = ("team_standings_pkey", "game_home_team_index",
+                         "game_away_team_index", "player_team_index",
+                         "player_season_totals_pkey")
+    return [
+        ("get_record", db.record_select, (team_id, None),
+         ("team_standings_pkey",), season),
+        ("get_past_games", db.past_games_select, (team_id, None),
+         ("game_home_team_index", "game_away_team_index"), season),
+        ("get_roster", db.roster_select, (team_id, None),
+         ("player_team_index", "player_season_totals_pkey"), season),
+        ("get_stats_leaders", db.stats_leaders_select, (team_id, None, 1),
+         ("player_team_index", "player_season_totals_pkey"), season),
+        ("team_dashboard", db.team_dashboard_select, (team_id, None, 1),
+         dashboard_indexes, season),
+        ("standings", db.league_standings_select, (None,),
+         ("team_standings_pkey",), season),
+        ("team game log", db.team_game_log_select, (team_id, None, 20, None, None),
+         ("game_home_team_index", "game_away_team_index"), season),
+        ("player game log", db.player_game_log_select, (player_id, None, 20, None, None),
+         ("stats_pkey",), season),
+        ("team form", db.team_form_select, (team_id, None),
+         ("team_form_pkey",), season),
+        ("player form", db.player_form_select, (player_id, None),
+         ("player_form_pkey", "player_season_totals_pkey"), season),
+        ("stats by player", compile_select(db.stats_table_select(player_id=player_id)),
+         (), ("stats_pkey",), None),
+        ("stats by game", compile_select(db.stats_table_select(game_id=game_id)),
+         (), ("stats_game_index",), None),
+        ("stats by team", compile_select(db.stats_table_select(team_id=team_id)),
+         (), ("player_team_index", "stats_pkey"), None),
+        ("stats by date", compile_select(db.stats_table_select(
+            date_from=date(season, 11, 1), date_to=date(season, 11, 30))),
+         (), ("game_date_index",), season),
+        ("stats by season", compile_select(db.stats_table_select(
+            player_id=player_id, season=season)),
+         (), ("stats_pkey",), season),
+    ]
+
+
+def plan_scans(plan):
+    '''
+    (node type, index name, relation name) of every scan that was run in
+    an EXPLAIN ANALYZE plan. Partitions pruned while executing the query
+    appear in the plan, but are never run. Bitmap index scans have no
+    relation name, their heap scan has it.
+    '''
+    scans = []
+    if plan.get("Actual Loops") == 0:
+        return scans
+    if "Relation Name" in plan or "Index Name" in plan:
+        scans.append((plan["Node Type"], plan.get("Index Name"), plan.get("Relation Name")))
+    for child in plan.get("Plans", []):
+        scans += plan_scans(child)
+    return scans
+
+
+def explain(cursor, sql, params):
+    '''
+    Scans run by a query. Queries with $n parameters are
+    run as prepared statements with those parameters.
+    '''
+    if params:
+        cursor.execute("PREPARE check_indexes AS " + sql)
+        cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) EXECUTE check_indexes (%s)"
+                       % ", ".join(["%s"] * len(params)), params)
+    else:
+        cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql)
+    (plan,) = cursor.fetchone()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    if params:
+        cursor.execute("DEALLOCATE check_indexes")
+    return plan_scans(plan[0]["Plan"])
+
+
+def partition_indexes(cursor):
+    '''
+    {index of a partition: index of the partitioned table it belongs to}
+    '''
+    cursor.execute("""
+        SELECT c.relname, p.relname
+        FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+        WHERE c.relkind = 'i' AND pg_table_is_visible(c.oid)
+    """)
+    return dict(cursor.fetchall())
+
+
+def partition_season(relation):
+    '''
+    Season of a game or stats partition, "default" for the default
+    partitions and None for other tables
+    '''
+    (table, _, suffix) = (relation or "").rpartition("_")
+    if table not in ("game", "stats"):
+        return None
+    return "default" if suffix == "default" else int(suffix)
+
+
+def check_report_indexes():
+    '''
+    EXPLAIN ANALYZE every report query and return (query, expected
+    indexes, scans run, missing indexes or partitions not pruned).
+    The queries only read. Sequential scans are disabled while
+    planning: on a small league a sequential scan is the cheapest plan
+    for any query, and what is checked is that each query has a
+    matching index to use once the tables grow.
+    '''
+    results = []
+    with db.pooled_cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        parents = partition_indexes(cursor)
+        checks = report_index_checks(*sample_ids(cursor))
+        for (query, sql, params, expected, season) in checks:
+            scans = [(node, parents.get(index, index), relation)
+                     for (node, index, relation) in explain(cursor, sql, params)]
+            used = set(index for (node, index, relation) in scans)
+            missing = [index for index in expected if index not in used]
+            # Partitions of other seasons must have been pruned
+            if season is not None:
+                missing += sorted(set(
+                    "pruning of " + relation for (node, index, relation) in scans
+                    if partition_season(relation) not in (None, season)))
+            results.append((query, expected, scans, missing))
+        # Only planner settings were changed, and they are not kept
+        cursor.connection.rollback()
+    return results
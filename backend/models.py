@@ -1,6 +1,8 @@
 # Specify Database Models / Schema
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, Date, Time, ForeignKey
+from sqlalchemy import (Column, Integer, BigInteger, String, Date, Time, DateTime, ForeignKey,
+                        ForeignKeyConstraint)
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -22,10 +24,19 @@ class Player(Base):
     position = Column(String(3))
     jersey_number = Column(Integer)
 
+class Season(Base):
+    __tablename__='season'
+
+    # Year the season starts in. game and stats have one partition per season.
+    season = Column(Integer, primary_key=True)
+
+# game and stats are partitioned by season (see migrations.py), so the
+# season is part of their primary keys
 class Game(Base):
     __tablename__='game'
 
-    game_id = Column(Integer, primary_key=True)
+    game_id = Column(Integer, primary_key=True, autoincrement=True)
+    season = Column(Integer, primary_key=True)
     date = Column(Date)
     time = Column(Time)
     location = Column(String(100))
@@ -34,13 +45,92 @@ class Game(Base):
     away_team_id = Column(Integer, ForeignKey('team.team_id'))
     away_score = Column(Integer)
 
+# Each game_id once: the primary key of game alone lets two seasons
+# share one (see database.create_game_id_guard)
+class GameId(Base):
+    __tablename__='game_ids'
+
+    game_id = Column(Integer, primary_key=True, autoincrement=False)
+
 class Stats(Base):
     __tablename__='stats'
+    __table_args__ = (
+        ForeignKeyConstraint(['game_id', 'season'], ['game.game_id', 'game.season']),
+    )
 
     player_id = Column(Integer, ForeignKey('player.player_id'), primary_key=True)
-    game_id = Column(Integer, ForeignKey('game.game_id'), primary_key=True)
+    game_id = Column(Integer, primary_key=True, autoincrement=False)
+    season = Column(Integer, primary_key=True)
     points = Column(Integer)
     assists = Column(Integer)
     rebounds = Column(Integer)
     blocks = Column(Integer)
-    steals = Column(Integer)
\ No newline at end of file
+    steals = Column(Integer)
+
+class TeamStandings(Base):
+    __tablename__='team_standings'
+
+    team_id = Column(Integer, ForeignKey('team.team_id'), primary_key=True)
+    season = Column(Integer, primary_key=True)
+    wins = Column(Integer, nullable=False, default=0)
+    losses = Column(Integer, nullable=False, default=0)
+    home_wins = Column(Integer, nullable=False, default=0)
+    home_losses = Column(Integer, nullable=False, default=0)
+    away_wins = Column(Integer, nullable=False, default=0)
+    away_losses = Column(Integer, nullable=False, default=0)
+    points_for = Column(Integer, nullable=False, default=0)
+    points_against = Column(Integer, nullable=False, default=0)
+
+class PlayerSeasonTotals(Base):
+    __tablename__='player_season_totals'
+
+    player_id = Column(Integer, ForeignKey('player.player_id'), primary_key=True)
+    season = Column(Integer, primary_key=True)
+    games_played = Column(Integer, nullable=False, default=0)
+    points = Column(Integer, nullable=False, default=0)
+    assists = Column(Integer, nullable=False, default=0)
+    rebounds = Column(Integer, nullable=False, default=0)
+    blocks = Column(Integer, nullable=False, default=0)
+    steals = Column(Integer, nullable=False, default=0)
+
+# Totals of a team's last database.form_games games of a season
+class TeamForm(Base):
+    __tablename__='team_form'
+
+    team_id = Column(Integer, ForeignKey('team.team_id'), primary_key=True)
+    season = Column(Integer, primary_key=True)
+    games = Column(Integer, nullable=False, default=0)
+    wins = Column(Integer, nullable=False, default=0)
+    points_for = Column(Integer, nullable=False, default=0)
+    points_against = Column(Integer, nullable=False, default=0)
+    # Wins (> 0) or losses (< 0) in a row up to the latest game
+    streak = Column(Integer, nullable=False, default=0)
+
+# A player's stat lines of their last database.form_games games of a
+# season, latest game first
+class PlayerForm(Base):
+    __tablename__='player_form'
+
+    player_id = Column(Integer, ForeignKey('player.player_id'), primary_key=True)
+    season = Column(Integer, primary_key=True)
+    game_ids = Column(ARRAY(Integer), nullable=False)
+    game_dates = Column(ARRAY(Date), nullable=False)
+    points = Column(ARRAY(Integer), nullable=False)
+    assists = Column(ARRAY(Integer), nullable=False)
+    rebounds = Column(ARRAY(Integer), nullable=False)
+    blocks = Column(ARRAY(Integer), nullable=False)
+    steals = Column(ARRAY(Integer), nullable=False)
+
+class ImportProgress(Base):
+    __tablename__='import_progress'
+
+    source = Column(String(500), primary_key=True)
+    rows_done = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime)
+
+class SchemaMigration(Base):
+    __tablename__='schema_migrations'
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String(100), nullable=False)
+    applied_at = Column(DateTime)
@@ -0,0 +1,35 @@
+# JSON encoding of responses
+#
+# orjson (optional, pip install orjson) encodes several times faster than
+# the json module. When it is installed, responses are encoded with it and
+# the values it does not encode natively (dates, Decimals) are converted the
+# same way Flask converts them, so payloads keep their format. Unlike the
+# json module, orjson writes non-ASCII characters as UTF-8 instead of
+# escaping them.
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Compact separators are what Flask uses outside of debug mode
+compact_separators = (",", ":")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    '''
+    Flask JSON provider encoding with orjson when it is installed
+    '''
+    def orjson_options(self):
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps(self, obj, **kwargs):
+        # Pretty printing (debug mode) and other options use the json module
+        if orjson is None or kwargs not in ({}, {"separators": compact_separators}):
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default,
+                            option=self.orjson_options()).decode()
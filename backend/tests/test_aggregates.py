@@ -0,0 +1,102 @@
+# team_standings, player_season_totals, team_form and player_form are kept
+# up to date by triggers; after any write they must equal a rebuild from
+# the games and stat lines
+import database as db
+
+aggregate_tables = ("team_standings", "player_season_totals", "team_form", "player_form")
+
+
+def aggregate_rows():
+    '''
+    Rows of each aggregate table. A team or player whose games were all
+    removed keeps an all-zero row, which a rebuild does not create.
+    '''
+    rows = {}
+    with db.pooled_cursor() as cursor:
+        for table in aggregate_tables:
+            cursor.execute("SELECT * FROM %s ORDER BY 1, 2" % table)
+            rows[table] = [row for row in cursor.fetchall()
+                           if table == "player_form" or any(row[2:])]
+    return rows
+
+
+def assert_consistent():
+    incremental = aggregate_rows()
+    db.rebuild_team_standings()
+    db.rebuild_player_totals()
+    db.rebuild_form()
+    rebuilt = aggregate_rows()
+    for table in aggregate_tables:
+        assert incremental[table] == rebuilt[table], table
+
+
+def player_totals(player_id, season):
+    with db.pooled_cursor() as cursor:
+        cursor.execute("SELECT games_played, points FROM player_season_totals "
+                       "WHERE player_id = %s AND season = %s", (player_id, season))
+        return cursor.fetchone() or (0, 0)
+
+
+def stat_line(player_id, game_id, points):
+    return {"player_id": player_id, "game_id": game_id, "points": points,
+            "assists": 1, "rebounds": 2, "blocks": 0, "steals": 1}
+
+
+def test_migrated_league_is_consistent(league):
+    assert_consistent()
+
+
+def test_add_edit_delete_stats(client, league):
+    # A player of a team that did not play the game has no line for it yet
+    (game_id, season, _, _, _, home, _, away, _) = league["game"][-1]
+    player_id = next(row[0] for row in league["player"] if row[1] not in (home, away))
+    (games, points) = player_totals(player_id, season)
+
+    response = client.post('/stats/add_stats', json=stat_line(player_id, game_id, 30))
+    assert response.get_json()["result"] == "inserted"
+    assert player_totals(player_id, season) == (games + 1, points + 30)
+    assert_consistent()
+
+    response = client.put('/stats/edit_stats', json=stat_line(player_id, game_id, 12))
+    assert response.get_json()["result"] == "updated"
+    assert player_totals(player_id, season) == (games + 1, points + 12)
+    assert_consistent()
+
+    response = client.delete('/stats/delete_stats',
+                             json={"player_id": player_id, "game_id": game_id})
+    assert response.status_code == 200
+    assert player_totals(player_id, season) == (games, points)
+    assert_consistent()
+
+    # Editing a line that is not recorded does not add it
+    response = client.put('/stats/edit_stats', json=stat_line(player_id, game_id, 5))
+    assert response.status_code == 404
+    assert player_totals(player_id, season) == (games, points)
+
+
+def test_bulk_add_with_score(client, league):
+    # Several new lines of one player in one statement, older games
+    # included, and a new final score
+    (game_id, _, _, _, _, home, _, away, _) = league["game"][-2]
+    player_id = next(row[0] for row in league["player"] if row[1] not in (home, away))
+    played = {row[1] for row in league["stats"] if row[0] == player_id}
+    game_ids = [row[0] for row in league["game"] if row[0] not in played][-12:]
+    lines = [stat_line(player_id, line_game_id, 10 + i) for (i, line_game_id) in enumerate(game_ids)]
+
+    response = client.post('/stats/bulk_add', json={
+        "stats": lines, "upsert": True,
+        "game": {"game_id": game_id, "home_score": 80, "away_score": 140}})
+    assert response.status_code == 200
+    assert response.get_json()["inserted"] == len(lines)
+    assert_consistent()
+
+
+def test_game_score_and_date_changes(league):
+    (game_id, _, _, _, _, home, _, away, _) = league["game"][len(league["game"]) // 2]
+    with db.pooled_cursor() as cursor:
+        cursor.execute("UPDATE game SET home_score = 150, away_score = 90 WHERE game_id = %s",
+                       (game_id,))
+        cursor.execute("UPDATE game SET date = date + 3 WHERE game_id = %s", (game_id,))
+        cursor.execute("UPDATE game SET home_score = NULL WHERE game_id = %s", (game_id + 1,))
+    db.notify_write("game")
+    assert_consistent()
@@ -0,0 +1,64 @@
+# Advanced metrics computed on NumPy arrays, and the season arrays they
+# are computed from
+import pytest
+
+import database as db
+
+np = pytest.importorskip("numpy")
+import analytics  # noqa: E402
+
+
+def test_team_metrics():
+    teams = (np.array([1, 2, 3]), ["A", "B", "C"])
+    # (home_team_id, away_team_id, home_score, away_score)
+    games = np.array([[1, 2, 100, 90], [2, 3, 80, 95], [3, 1, 70, 75]])
+    report = {team["team_id"]: team for team in analytics.team_metrics(teams, games)}
+
+    assert [team["team_id"] for team in analytics.team_metrics(teams, games)] == [1, 3, 2]
+    assert (report[1]["games"], report[1]["wins"], report[1]["losses"]) == (2, 2, 0)
+    assert (report[2]["wins"], report[3]["wins"]) == (0, 1)
+    assert report[1]["points_for"] == 87.5
+    assert report[1]["pace"] == 167.5
+
+
+def test_player_metrics_qualified_first():
+    # Players 10 and 11 of team 1, 12 of team 2, 13 without a team
+    players = (np.array([10, 11, 12, 13]), np.array([1, 1, 2, -1]), ["a", "b", "c", "d"])
+    # (player_id, team_id, points, assists, rebounds, blocks, steals)
+    lines = np.array([[10, 1, 10, 0, 0, 0, 0], [10, 1, 20, 0, 0, 0, 0],
+                      [11, 1, 40, 0, 0, 0, 0],
+                      [12, 2, 5, 1, 1, 0, 0], [12, 2, 5, 1, 1, 0, 0]])
+    report = analytics.player_metrics(players, lines, min_games=2)
+
+    # Player 11 scores the most per game but played a single game
+    assert [player["player_id"] for player in report] == [10, 12, 11]
+    assert [player["qualified"] for player in report] == [True, True, False]
+    assert report[0]["per_game"]["points"] == 15.0
+    assert report[0]["scoring_share"] == 0.429
+    assert [player["player_id"] for player in analytics.player_metrics(players, lines, 2)] == [12]
+
+
+def test_games_without_teams_are_left_out(client, league):
+    # A finished game whose away team was never recorded
+    with db.pooled_cursor() as cursor:
+        cursor.execute("SELECT current_season()")
+        (season,) = cursor.fetchone()
+        cursor.execute("SELECT MAX(date) FROM game WHERE season = %s", (season,))
+        (date,) = cursor.fetchone()
+        cursor.execute("INSERT INTO game (season, date, home_team_id, home_score, away_score) "
+                       "VALUES (%s, %s, %s, 99, 98) RETURNING game_id",
+                       (season, date, league["team"][0][0]))
+        (game_id,) = cursor.fetchone()
+        cursor.execute("SELECT COUNT(*) FROM game WHERE season = %s AND home_team_id IS NOT NULL "
+                       "AND away_team_id IS NOT NULL AND home_score IS NOT NULL "
+                       "AND away_score IS NOT NULL", (season,))
+        (finished,) = cursor.fetchone()
+    db.notify_write("game")
+    try:
+        response = client.get('/report/advanced/teams')
+        assert response.status_code == 200
+        assert sum(team["games"] for team in response.get_json()) == 2 * finished
+    finally:
+        with db.pooled_cursor() as cursor:
+            cursor.execute("DELETE FROM game WHERE game_id = %s", (game_id,))
+        db.notify_write("game")
@@ -0,0 +1,28 @@
+# An integer query parameter that does not parse is answered with 400
+# instead of being dropped, which would widen the result. The requests
+# are refused before any query, so no database is needed.
+import pytest
+
+
+@pytest.fixture
+def api():
+    import app
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize("path, name", [
+    ('/stats/get_stats?player_id=x', 'player_id'),
+    ('/stats/get_stats?game_id=1&team_id=2a', 'team_id'),
+    ('/stats/get_stats?season=', 'season'),
+    ('/game/get_games?season=abc', 'season'),
+    ('/report/get_roster?team_id=1&season=x', 'season'),
+    ('/report/get_record?team_id=abc', 'team_id'),
+    ('/report/standings?season=2024x', 'season'),
+    ('/report/league_leaders?top=five', 'top'),
+    ('/report/team_game_log?team_id=1&season=q', 'season'),
+    ('/events/stream?game_id=1&game_id=z', 'game_id'),
+])
+def test_invalid_integer(api, path, name):
+    response = api.get(path)
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "%s must be an integer" % name
@@ -0,0 +1,80 @@
+# The ASGI report routes answer like the Flask routes, from async queries
+import asyncio
+import json
+
+import asyncpg
+import pytest
+
+import app as flask_app
+import asgi
+import cache
+import database as db
+
+
+async def call(path, query_string="", headers=()):
+    '''
+    (status, headers, body) of a GET sent to the ASGI application
+    '''
+    messages = []
+
+    async def receive():
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi.application({
+        'type': 'http', 'method': 'GET', 'path': path,
+        'query_string': query_string.encode(),
+        # ASGI sends header names in lower case
+        'headers': [(name.lower().encode(), value.encode()) for (name, value) in headers]
+    }, receive, send)
+    (start, body) = messages[:2]
+    return (start['status'], {name.decode(): value.decode() for (name, value) in start['headers']},
+            body['body'])
+
+
+@pytest.mark.parametrize("path, query_string, name", [
+    ('/report/get_record', 'team_id=abc', 'team_id'),
+    ('/report/get_roster', 'team_id=1&season=x', 'season'),
+    ('/report/league_leaders', 'top=five', 'top'),
+    ('/events/stream', 'game_id=1&team_id=x', 'team_id'),
+])
+def test_invalid_integer(path, query_string, name):
+    # Refused before any query, so no database is needed
+    (status, _, body) = asyncio.run(call(path, query_string))
+    assert status == 400
+    assert json.loads(body) == {"message": "%s must be an integer" % name}
+
+
+def test_reports_match_the_flask_routes(client, league, monkeypatch):
+    # Every answer comes from its own query
+    monkeypatch.setattr(asgi, "report_cache", cache.NullCache())
+    monkeypatch.setattr(flask_app, "report_cache", cache.NullCache())
+    team_id = league["team"][0][0]
+    # The pool reads the test schema, as db.engine does
+    with db.pooled_cursor() as cursor:
+        cursor.execute("SHOW search_path")
+        (search_path,) = cursor.fetchone()
+
+    async def compare():
+        asgi.async_pool = await asyncpg.create_pool(
+            asgi.asyncpg_dsn(db.engine.url.render_as_string(hide_password=False)),
+            min_size=1, max_size=2, server_settings={"search_path": search_path})
+        try:
+            for path in asgi.report_routes:
+                for season in ("", "&season=all"):
+                    query_string = "team_id=%d&top=2%s" % (team_id, season)
+                    (status, headers, body) = await call(path, query_string)
+                    expected = client.get("%s?%s" % (path, query_string))
+                    assert status == 200, path
+                    assert json.loads(body) == expected.get_json(), path
+                    assert headers['ETag'] == expected.headers['ETag'], path
+
+                    (status, _, body) = await call(path, query_string,
+                                                   [('If-None-Match', headers['ETag'])])
+                    assert (status, body) == (304, b""), path
+        finally:
+            await asgi.close_async_pool()
+
+    asyncio.run(compare())
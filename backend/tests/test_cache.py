@@ -0,0 +1,94 @@
+# The report cache serves a report until a write bumps the data version
+# of a table (and team) it depends on. No database is needed.
+from decimal import Decimal
+
+import pytest
+
+import cache
+import versions
+
+
+class Report:
+    '''
+    compute function counting its calls
+    '''
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+@pytest.fixture
+def data_versions():
+    return versions.DataVersions(versions.LocalCounters())
+
+
+def test_writes_invalidate_only_their_teams(data_versions):
+    report_cache = cache.ReportCache(cache.LRUCache(), data_versions)
+    (team_1, team_2) = (Report([1]), Report([2]))
+
+    def get_both():
+        return (report_cache.get_or_compute("/roster?team_id=1", 1, ("stats",), team_1),
+                report_cache.get_or_compute("/roster?team_id=2", 2, ("stats",), team_2))
+
+    assert get_both() == ([1], [2])
+    assert get_both() == ([1], [2])
+    assert (team_1.calls, team_2.calls) == (1, 1)
+
+    data_versions.bump("stats", [1])
+    data_versions.bump("game", None)
+    get_both()
+    assert (team_1.calls, team_2.calls) == (2, 1)
+
+    # A write that may touch any team invalidates every team
+    data_versions.bump("stats", None)
+    get_both()
+    assert (team_1.calls, team_2.calls) == (3, 2)
+    assert report_cache.stats()["hits"] == 3
+    assert report_cache.stats()["misses"] == 5
+
+
+def test_lru_evicts_the_least_recently_used(monkeypatch):
+    lru = cache.LRUCache(max_entries=2, ttl=10)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+    assert (lru.get("a"), lru.get("b"), lru.get("c")) == (1, None, 3)
+
+    now = cache.time.monotonic()
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now + 11)
+    assert lru.get("a") is None
+    assert (lru.evictions, lru.size()) == (2, 1)
+
+
+def test_shared_cache_sends_decimals_as_text():
+    store = cache.LocalKeyValueStore()
+    shared = cache.SharedCache(store, ttl=10)
+    shared.set("key", [{"ppg": Decimal("12.5")}])
+    assert shared.get("key") == [{"ppg": "12.5"}]
+    assert shared.size() == 1
+
+
+def test_shared_versions_agree_across_workers():
+    # Two workers' versions on the same key-value server
+    store = cache.LocalKeyValueStore()
+    first = versions.DataVersions(store, shared=True)
+    second = versions.DataVersions(store, shared=True)
+    assert first.etag("/standings", ("game",)) == second.etag("/standings", ("game",))
+
+    etag = first.etag("/standings", ("game",))
+    second.bump("game", [3])
+    assert first.etag("/standings", ("game",)) != etag
+    assert first.etag("/standings?season=2023", ("game",)) != first.etag("/standings", ("game",))
+
+
+def test_null_cache_always_computes():
+    report = Report({"wins": 1})
+    null_cache = cache.NullCache()
+    for _ in range(2):
+        assert null_cache.get_or_compute("/record", 1, ("game",), report) == {"wins": 1}
+    assert report.calls == 2
@@ -0,0 +1,48 @@
+# ETags move with the writes to the data a report reads, and only with those
+import database as db
+
+
+def roster_etag(client, team_id):
+    response = client.get('/report/get_roster', query_string={"team_id": team_id})
+    assert response.status_code == 200
+    return response.headers['ETag']
+
+
+def edit_team_line(client, league, team_id, points):
+    '''
+    Edit a stat line of one of the team's players
+    '''
+    players = {row[0] for row in league["player"] if row[1] == team_id}
+    (player_id, game_id) = next(row[:2] for row in league["stats"] if row[0] in players)
+    response = client.put('/stats/edit_stats', json={
+        "player_id": player_id, "game_id": game_id, "points": points,
+        "assists": 0, "rebounds": 0, "blocks": 0, "steals": 0})
+    assert response.status_code == 200
+
+
+def test_not_modified_until_the_team_is_written(client, league):
+    (team_id, other_team_id) = (league["team"][0][0], league["team"][1][0])
+    etag = roster_etag(client, team_id)
+    response = client.get('/report/get_roster', query_string={"team_id": team_id},
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # A write to another team leaves the report as it was
+    edit_team_line(client, league, other_team_id, 7)
+    assert roster_etag(client, team_id) == etag
+
+    edit_team_line(client, league, team_id, 9)
+    response = client.get('/report/get_roster', query_string={"team_id": team_id},
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_team_id_is_parsed(client, league):
+    team_id = league["team"][0][0]
+    # Spelled with a leading zero, the report still moves with the team's writes
+    path = '/report/get_record?team_id=0%d' % team_id
+    etag = client.get(path).headers['ETag']
+    db.notify_write("game", [team_id])
+    assert client.get(path).headers['ETag'] != etag
+    assert client.get('/report/get_record?team_id=abc').status_code == 400
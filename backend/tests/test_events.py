@@ -0,0 +1,88 @@
+# The broker delivers each event to the subscriptions of its game or teams,
+# and a reset to every subscription
+import threading
+
+import events
+
+
+def stat_event(game_id, team_ids):
+    return {"id": None, "event": "stats", "game_id": game_id, "team_ids": team_ids,
+            "data": {"game_id": game_id, "lines": []}}
+
+
+def queued(subscription):
+    '''
+    Events waiting in the subscription's queue
+    '''
+    waiting = []
+    while True:
+        event = subscription.get(timeout=0)
+        if event is None:
+            return waiting
+        waiting.append(event)
+
+
+def test_events_reach_the_subscriptions_of_their_game_or_teams():
+    broker = events.Broker()
+    by_game = broker.subscribe(events.Subscription(game_ids=[1]))
+    by_team = broker.subscribe(events.Subscription(team_ids=[7]))
+    everything = broker.subscribe(events.Subscription())
+
+    broker.publish([stat_event(1, [3, 4]), stat_event(2, [7, 8]), stat_event(3, [5, 6])])
+    assert [event["game_id"] for event in queued(by_game)] == [1]
+    assert [event["game_id"] for event in queued(by_team)] == [2]
+    assert [event["game_id"] for event in queued(everything)] == [1, 2, 3]
+
+
+def test_published_reset_reaches_filtered_subscriptions():
+    # The postgres bus publishes a copy of reset_event after reconnecting
+    broker = events.Broker()
+    subscriptions = [broker.subscribe(events.Subscription(game_ids=[1])),
+                     broker.subscribe(events.Subscription(team_ids=[7])),
+                     broker.subscribe(events.Subscription())]
+    broker.publish([dict(events.reset_event)])
+    for subscription in subscriptions:
+        assert [event["event"] for event in queued(subscription)] == ["reset"]
+
+
+def test_reconnect_catches_up_or_resets():
+    broker = events.Broker()
+    broker.publish([stat_event(1, [3, 4]), stat_event(2, [7, 8]), stat_event(1, [3, 4])])
+    first_id = broker.history[0]["id"]
+
+    caught_up = broker.subscribe(events.Subscription(game_ids=[1]), first_id)
+    assert [event["id"] for event in queued(caught_up)] == [broker.history[2]["id"]]
+    unknown = broker.subscribe(events.Subscription(game_ids=[1]), "gone-1")
+    assert [event["event"] for event in queued(unknown)] == ["reset"]
+
+
+def test_overflow_replaces_the_queue_with_a_reset(monkeypatch):
+    monkeypatch.setattr(events, "queue_size", 3)
+    broker = events.Broker()
+    subscription = broker.subscribe(events.Subscription())
+    broker.publish([stat_event(game_id, []) for game_id in range(5)])
+    # Three events fill the queue, the fourth overflows it, the fifth fits
+    assert [event["event"] for event in queued(subscription)] == ["reset", "stats"]
+    assert subscription.overflows == 1
+
+
+def test_concurrent_publishers_overflowing_a_queue(monkeypatch):
+    monkeypatch.setattr(events, "queue_size", 2)
+    broker = events.Broker()
+    subscription = broker.subscribe(events.Subscription())
+    errors = []
+
+    def publish():
+        try:
+            for game_id in range(500):
+                broker.publish([stat_event(game_id, [])])
+        except Exception as error:
+            errors.append(error)
+    threads = [threading.Thread(target=publish) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert subscription.overflows > 0
+    assert len(queued(subscription)) <= 2
@@ -0,0 +1,72 @@
+# The importer resolves natural keys into ids, skips rows that already
+# exist and resumes after the rows a previous run committed
+import csv
+
+import database as db
+import importer
+
+
+def write_csv(path, columns, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    return str(path)
+
+
+def test_batches_skip_imported_rows():
+    rows = iter(range(7))
+    assert list(importer.batches(rows, 3, 2)) == [[2, 3, 4], [5, 6]]
+    assert list(importer.batches(iter([]), 3, 0)) == []
+
+
+def test_read_csv(tmp_path):
+    path = write_csv(tmp_path / "teams.csv", ["name", "coach"], [["A", "X"], ["B", ""]])
+    assert list(importer.read_rows(path, 10)) == [{"name": "A", "coach": "X"},
+                                                 {"name": "B", "coach": ""}]
+
+
+def count(query, params=()):
+    with db.pooled_cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+
+
+def test_import_and_resume(tmp_path, league):
+    db.create_tables()
+    # A game of the league's first season, so the current season stays the same
+    day = min(row[2] for row in league["game"]).isoformat()
+    files = {
+        "team": write_csv(tmp_path / "teams.csv", importer.staging_columns["team"],
+                          [["Import Home", "Coach H"], ["Import Away", "Coach A"],
+                           ["Import Home", "Coach H"]]),
+        "player": write_csv(tmp_path / "players.csv", importer.staging_columns["player"],
+                            [["Import Home", "Ann", "Import", "G", 1],
+                             ["Import Away", "Bob", "Import", "F", 2]]),
+        "game": write_csv(tmp_path / "games.csv", importer.staging_columns["game"],
+                          [[day, "19:00:00", "Import Arena", "Import Home", 99,
+                            "Import Away", 90]]),
+        "stats": write_csv(tmp_path / "stats.csv", importer.staging_columns["stats"],
+                           [[day, "Import Home", "Import Away", "Ann", "Import", 1,
+                             30, 5, 4, 1, 2],
+                            [day, "Import Home", "Import Away", "Bob", "Import", 2,
+                             20, 3, 9, 0, 1]])
+    }
+    try:
+        # Batches of one row, the duplicate team is skipped
+        assert [importer.import_file(kind, files[kind], 1) for kind in importer.staging_columns] \
+            == [2, 2, 1, 2]
+        assert count("SELECT SUM(points) FROM stats s JOIN player p ON p.player_id = s.player_id "
+                     "WHERE p.last_name = 'Import'") == 50
+
+        # Nothing is left to read on a second run, and a restart inserts nothing new
+        assert importer.import_file("stats", files["stats"], 1) == 0
+        assert importer.get_rows_done("stats:%s" % files["stats"]) == 2
+        assert importer.import_file("stats", files["stats"], 10, restart=True) == 0
+    finally:
+        # The teams and players stay, with empty totals
+        with db.pooled_cursor() as cursor:
+            cursor.execute("DELETE FROM stats WHERE player_id IN "
+                           "(SELECT player_id FROM player WHERE last_name = 'Import')")
+            cursor.execute("DELETE FROM game WHERE location = 'Import Arena'")
+        db.notify_write("game")
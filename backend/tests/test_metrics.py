@@ -0,0 +1,78 @@
+# Request profiles add up into the Prometheus series served at /metrics
+import re
+
+import app as flask_app
+import cache
+import events
+import metrics
+
+
+def profile(seconds, queries=1):
+    return {"seconds": seconds, "queries": queries, "db_seconds": seconds / 2,
+            "acquire_seconds": 0.0, "serialize_seconds": 0.001}
+
+
+def sample(lines, name, **labels):
+    '''
+    Value of the sample of a metric with exactly the given labels
+    '''
+    text = ",".join('%s="%s"' % (key, value) for (key, value) in labels.items())
+    prefix = "%s{%s} " % (name, text) if labels else name + " "
+    (value,) = [line[len(prefix):] for line in lines if line.startswith(prefix)]
+    return float(value)
+
+
+def test_request_histogram():
+    request_metrics = metrics.RequestMetrics()
+    for seconds in (0.004, 0.03, 0.03, 7.0):
+        request_metrics.observe("GET", "/report/standings", 200, profile(seconds))
+    request_metrics.observe("GET", "/report/standings", 304, profile(0.001, 0))
+    lines = request_metrics.render()
+
+    series = {"method": "GET", "endpoint": "/report/standings", "status": "200"}
+    # Buckets are cumulative, and only +Inf counts the 7 s request
+    assert sample(lines, "blm_http_request_duration_seconds_bucket", **series, le="0.005") == 1
+    assert sample(lines, "blm_http_request_duration_seconds_bucket", **series, le="0.05") == 3
+    assert sample(lines, "blm_http_request_duration_seconds_bucket", **series, le="5.0") == 3
+    assert sample(lines, "blm_http_request_duration_seconds_bucket", **series, le="+Inf") == 4
+    assert sample(lines, "blm_http_request_duration_seconds_count", **series) == 4
+    assert sample(lines, "blm_http_request_queries_total", **series) == 4
+    assert sample(lines, "blm_http_request_queries_total", **dict(series, status="304")) == 0
+
+
+def test_label_values_are_escaped():
+    request_metrics = metrics.RequestMetrics()
+    request_metrics.observe("GET", '/a"b\\c', 200, profile(0.01))
+    assert 'endpoint="/a\\"b\\\\c"' in "\n".join(request_metrics.render())
+
+
+def test_render_stats_types():
+    lines = metrics.render_stats("blm_test", {"hits": 3, "entries": 2, "missing": None},
+                                 ("hits",), {"entries": "Entries held"})
+    assert lines == ["# HELP blm_test_entries Entries held", "# TYPE blm_test_entries gauge",
+                     "blm_test_entries 2",
+                     "# HELP blm_test_hits_total hits", "# TYPE blm_test_hits_total counter",
+                     "blm_test_hits_total 3"]
+
+
+def test_metrics_page_is_valid_text_format():
+    broker = events.Broker()
+    page = metrics.render_metrics(metrics.RequestMetrics(), cache.NullCache(),
+                                  event_broker=broker)
+    lines = page.splitlines()
+    assert sample(lines, "blm_report_cache_hits_total") == 0
+    assert sample(lines, "blm_events_subscribers") == 0
+    # Every line is a comment or a sample with a number
+    sample_line = re.compile(r'^[a-z_]+(\{[^}]*\})? -?[0-9.e+-]+$|^[a-z_]+(\{[^}]*\})? (nan|inf)$')
+    assert all(line.startswith("# ") or sample_line.match(line) for line in lines)
+
+
+def test_requests_are_profiled(client, league, monkeypatch):
+    # The report is computed, not answered from an earlier test's entry
+    monkeypatch.setattr(flask_app, "report_cache", cache.NullCache())
+    team_id = league["team"][0][0]
+    client.get('/report/get_record?team_id=%d&season=all' % team_id)
+    lines = client.get('/metrics').get_data(as_text=True).splitlines()
+    series = {"method": "GET", "endpoint": "/report/get_record", "status": "200"}
+    assert sample(lines, "blm_http_request_duration_seconds_count", **series) >= 1
+    assert sample(lines, "blm_http_request_queries_total", **series) >= 1
@@ -0,0 +1,67 @@
+# Keyset pagination: following the cursors returns every row once, in order
+import database as db
+
+
+def walk(client, path, params):
+    '''
+    Rows of every page of a /stats/get_stats request, following X-Next-Cursor
+    '''
+    rows = []
+    pages = 0
+    while True:
+        response = client.get(path, query_string=params)
+        assert response.status_code == 200
+        rows += response.get_json()
+        pages += 1
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor is None:
+            return (rows, pages)
+        assert 'rel="next"' in response.headers['Link']
+        params = dict(params, cursor=cursor)
+
+
+def query_keys(sql, params=()):
+    with db.pooled_cursor() as cursor:
+        cursor.execute(sql, params)
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+def test_stats_pages_cover_every_line(client, league):
+    (rows, pages) = walk(client, '/stats/get_stats', {"limit": 50})
+    keys = [(row["player_id"], row["game_id"]) for row in rows]
+    assert keys == query_keys("SELECT player_id, game_id FROM stats ORDER BY 1, 2")
+    assert pages == len(keys) // 50 + 1
+
+
+def test_stats_pages_descending_for_one_player(client, league):
+    player_id = league["player"][0][0]
+    (rows, pages) = walk(client, '/stats/get_stats',
+                         {"player_id": player_id, "sort": "desc", "limit": 7})
+    keys = [(row["player_id"], row["game_id"]) for row in rows]
+    assert keys == query_keys("SELECT player_id, game_id FROM stats WHERE player_id = %s "
+                              "ORDER BY 1 DESC, 2 DESC", (player_id,))
+    assert pages > 1
+
+
+def test_invalid_cursor(client, league):
+    assert client.get('/stats/get_stats?cursor=not-a-cursor').status_code == 400
+    assert client.get('/report/team_game_log?team_id=1&cursor=x').status_code == 400
+
+
+def test_team_game_log_pages(client, league):
+    team_id = league["team"][0][0]
+    games = []
+    params = {"team_id": team_id, "limit": 3}
+    while True:
+        payload = client.get('/report/team_game_log', query_string=params).get_json()
+        assert len(payload["games"]) <= 3
+        games += [game["game_id"] for game in payload["games"]]
+        if payload["next_cursor"] is None:
+            break
+        params = dict(params, cursor=payload["next_cursor"])
+    expected = query_keys(
+        "SELECT game_id FROM game WHERE %s IN (home_team_id, away_team_id) "
+        "AND season = current_season() AND home_score IS NOT NULL "
+        "AND away_score IS NOT NULL AND date IS NOT NULL "
+        "ORDER BY date DESC, game_id DESC", (team_id,))
+    assert games == [game_id for (game_id,) in expected]
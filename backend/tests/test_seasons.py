@@ -0,0 +1,70 @@
+# Reports cover the current season unless asked for another one, or for
+# every season with season=all
+import database as db
+
+
+def seasons():
+    with db.pooled_cursor() as cursor:
+        cursor.execute("SELECT DISTINCT season FROM game ORDER BY season")
+        return [season for (season,) in cursor.fetchall()]
+
+
+def report(client, path, **params):
+    response = client.get(path, query_string=params)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_all_seasons_record_adds_up_the_seasons(client, league):
+    assert len(seasons()) == 2
+    for (team_id, _, _) in league["team"]:
+        records = [report(client, '/report/get_record', team_id=team_id, season=season)
+                   for season in seasons()]
+        record = report(client, '/report/get_record', team_id=team_id, season="all")
+        assert record == {key: sum(season[key] for season in records) for key in record}
+        # The current season is still the default
+        assert report(client, '/report/get_record', team_id=team_id) == records[-1]
+
+
+def test_all_seasons_roster_and_past_games(client, league):
+    team_id = league["team"][0][0]
+    roster = report(client, '/report/get_roster', team_id=team_id, season="all")
+    with db.pooled_cursor() as cursor:
+        cursor.execute("SELECT ROUND(AVG(s.points), 1)::text FROM player p "
+                       "LEFT JOIN stats s ON s.player_id = p.player_id "
+                       "WHERE p.team_id = %s GROUP BY p.player_id ORDER BY p.player_id",
+                       (team_id,))
+        assert [player["ppg"] for player in roster] == [ppg for (ppg,) in cursor.fetchall()]
+        cursor.execute("SELECT COUNT(*) FROM game WHERE %s IN (home_team_id, away_team_id)",
+                       (team_id,))
+        (games,) = cursor.fetchone()
+    past_games = report(client, '/report/get_past_games', team_id=team_id, season="all")
+    assert len(past_games) == games
+
+    dashboard = report(client, '/report/team_dashboard', team_id=team_id, season="all")
+    assert dashboard["roster"] == roster
+    assert len(dashboard["past_games"]) == games
+
+
+def test_all_seasons_league_reports(client, league):
+    standings = report(client, '/report/standings', season="all")
+    by_season = [report(client, '/report/standings', season=season) for season in seasons()]
+    wins = {team["team_id"]: team["wins"] for team in standings}
+    assert wins == {team["team_id"]: sum(season_team["wins"] for season in by_season
+                                         for season_team in season
+                                         if season_team["team_id"] == team["team_id"])
+                    for team in standings}
+    assert report(client, '/report/league_leaders', season="all", top=2)
+
+
+def test_all_seasons_game_log(client, league):
+    team_id = league["team"][0][0]
+    log = report(client, '/report/team_game_log', team_id=team_id, season="all", limit=100)
+    current = report(client, '/report/team_game_log', team_id=team_id, limit=100)
+    assert len(log["games"]) > len(current["games"])
+    assert log["form"] == current["form"]
+
+
+def test_advanced_metrics_take_one_season(client, league):
+    response = client.get('/report/advanced/teams?season=all')
+    assert response.status_code in (400, 501)
@@ -0,0 +1,63 @@
+# ?format=ndjson and ?format=stream export the same rows as the plain
+# JSON endpoints, a batch of rows per chunk
+import json
+
+import pytest
+
+import database as db
+
+
+def sorted_rows(rows, key):
+    return sorted(rows, key=lambda row: row[key])
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("format=ndjson", '{"a":1}\n{"a":2}\n{"a":3}\n'),
+    ("format=stream", '[{"a":1},{"a":2},{"a":3}]'),
+])
+def test_rows_are_sent_in_batches(monkeypatch, query, expected):
+    import app
+    monkeypatch.setattr(db, "stream_batch_size", 2)
+    with app.app.test_request_context('/?' + query):
+        response = app.stream_response(iter([{"a": 1}, {"a": 2}, {"a": 3}]))
+        chunks = list(response.response)
+    assert "".join(chunks) == expected
+    # Two rows, then the last one
+    assert len([chunk for chunk in chunks if '"a"' in chunk]) == 2
+
+
+def test_empty_stream_is_an_empty_array():
+    import app
+    with app.app.test_request_context('/?format=stream'):
+        response = app.stream_response(iter([]))
+        assert json.loads("".join(response.response)) == []
+
+
+@pytest.mark.parametrize("path, key", [
+    ('/player/get_players', 'player_id'),
+    ('/team/get_teams', 'team_id'),
+    ('/game/get_games', 'game_id'),
+])
+def test_exports_match_the_endpoints(client, league, path, key):
+    rows = sorted_rows(client.get(path).get_json(), key)
+
+    response = client.get(path + '?format=ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert sorted_rows([json.loads(line) for line in lines], key) == rows
+
+    response = client.get(path + '?format=stream')
+    assert sorted_rows(response.get_json(), key) == rows
+
+
+def test_stats_export_is_not_paginated(client, league):
+    team_id = league["team"][0][0]
+    response = client.get('/stats/get_stats', query_string={
+        "team_id": team_id, "limit": 5, "format": "ndjson"})
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert 'X-Next-Cursor' not in response.headers
+    with db.pooled_cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM stats s JOIN player p ON p.player_id = s.player_id "
+                       "WHERE p.team_id = %s", (team_id,))
+        (count,) = cursor.fetchone()
+    assert len(lines) == count > 5
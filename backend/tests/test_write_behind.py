@@ -0,0 +1,103 @@
+# The write-behind queue coalesces writes of a line, writes them to the
+# database in batches and pushes back when it is full
+import threading
+import time
+
+import pytest
+
+import database as db
+import write_behind
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    '''
+    Build queues on a file of their own, closed at the end of the test.
+    The flusher only runs when woken, unless flush_interval is given.
+    '''
+    queues = []
+
+    def make(**settings):
+        settings = dict({"batch_size": 100, "flush_interval": 60, "max_pending": 100,
+                         "enqueue_timeout": 1}, **settings)
+        queue = write_behind.WriteBehindQueue(str(tmp_path / "queue.sqlite3"), **settings)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.close()
+
+
+def stat_row(line, points):
+    return tuple(line[:2]) + (points, 1, 2, 3, 4)
+
+
+def stored_points(player_id, game_id):
+    with db.pooled_cursor() as cursor:
+        cursor.execute("SELECT points FROM stats WHERE player_id = %s AND game_id = %s",
+                       (player_id, game_id))
+        row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+
+def test_full_queue_refuses_new_lines(monkeypatch, make_queue):
+    # Nothing can be flushed, so the queue stays full. monkeypatch is
+    # undone after make_queue closes the queue, so the lines left are
+    # not written to the configured database at the end either.
+    def unavailable(rows, deletes):
+        raise RuntimeError("database unavailable")
+    monkeypatch.setattr(db, "write_stats_batch", unavailable)
+    queue = make_queue(max_pending=2, enqueue_timeout=0.2, flush_interval=0.05)
+
+    queue.enqueue((1, 1, 10, 0, 0, 0, 0))
+    queue.enqueue((2, 1, 10, 0, 0, 0, 0))
+    with pytest.raises(write_behind.QueueFull):
+        queue.enqueue((3, 1, 10, 0, 0, 0, 0))
+    # Replacing a waiting line takes no room
+    queue.enqueue((1, 1, 12, 0, 0, 0, 0))
+    stats = queue.stats()
+    assert (stats["pending"], stats["refused"], stats["coalesced"]) == (2, 1, 1)
+
+
+def test_coalesced_writes_are_flushed_at_close(make_queue, league):
+    (first, second) = league["stats"][:2]
+    queue = make_queue()
+    for points in (1, 2, 3):
+        queue.enqueue(stat_row(first, points))
+    queue.enqueue(stat_row(second, 9))
+    queue.enqueue(second[:2], deleted=True)
+    queue.close()
+
+    stats = queue.stats()
+    assert (stats["enqueued"], stats["coalesced"], stats["flushed"]) == (5, 3, 2)
+    assert stats["pending"] == 0
+    assert stored_points(*first[:2]) == 3
+    assert stored_points(*second[:2]) is None
+
+
+def test_line_written_during_a_flush_stays_queued(make_queue, league, monkeypatch):
+    line = league["stats"][2]
+    queue = make_queue()
+    # No flusher thread: the test flushes the batch itself
+    queue.thread = threading.Thread(target=lambda: None)
+    queue.thread.start()
+    write_stats_batch = db.write_stats_batch
+
+    def write_again_meanwhile(rows, deletes):
+        queue.enqueue(stat_row(line, 20))
+        return write_stats_batch(rows, deletes)
+    monkeypatch.setattr(db, "write_stats_batch", write_again_meanwhile)
+
+    queue.enqueue(stat_row(line, 10))
+    time.sleep(0.3)
+    assert queue.flush_batch() == 1
+    monkeypatch.setattr(db, "write_stats_batch", write_stats_batch)
+
+    stats = queue.stats()
+    assert stats["pending"] == 1
+    # The waiting write came during the flush, not 0.3 s ago
+    assert stats["lag_seconds"] < 0.3
+    assert stored_points(*line[:2]) == 10
+    queue.flush()
+    assert stored_points(*line[:2]) == 20
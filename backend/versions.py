@@ -0,0 +1,108 @@
+# Data version counters used for cache keys and ETags
+#
+# Every write bumps a counter for the table and one per affected team
+# (or an "all teams" counter when the write may touch any team). A
+# response built from some tables stays valid for as long as their
+# counters do not move, which can be checked without running any query.
+import hashlib
+import threading
+import time
+import uuid
+
+import cache
+
+
+class LocalCounters:
+    '''
+    Counters kept in this process
+    '''
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.values.get(key)
+
+    def incr(self, key):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + 1
+            return self.values[key]
+
+
+class DataVersions:
+    '''
+    Per-table and per-team version counters stored in a client with
+    get/incr (LocalCounters, or the shared key-value server)
+    '''
+    def __init__(self, client, shared=False, max_age=None, prefix="blm:version:"):
+        self.client = client
+        self.prefix = prefix
+        # Counters of a single process reset on restart and do not see
+        # writes made by other workers, so their tokens also change every
+        # max_age seconds to bound how long a stale version can be served
+        self.max_age = max_age
+        if shared:
+            epoch = client.get(prefix + "epoch")
+            if epoch is None:
+                epoch = client.incr(prefix + "epoch")
+            self.epoch = str(int(epoch))
+        else:
+            self.epoch = uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+        self.bumps = 0
+
+    def get(self, table, team_id=None):
+        '''
+        Current version of a table, or of one team's rows in it
+        '''
+        name = table if team_id is None else "%s:%s" % (table, team_id)
+        value = self.client.get(self.prefix + name)
+        return int(value) if value is not None else 0
+
+    def bump(self, table, team_ids=None):
+        '''
+        Record a write to table for the given teams (None means any team).
+        Used as a database write listener.
+        '''
+        self.client.incr(self.prefix + table)
+        if team_ids is None:
+            self.client.incr(self.prefix + "%s:all" % table)
+        else:
+            for team_id in set(team_ids):
+                self.client.incr(self.prefix + "%s:%s" % (table, team_id))
+        with self.lock:
+            self.bumps += 1
+
+    def token(self, tables, team_id=None):
+        '''
+        String that changes whenever the given tables change (for one
+        team, or for any team if team_id is None)
+        '''
+        versions = [self.epoch]
+        for table in tables:
+            if team_id is None:
+                versions.append(self.get(table))
+            else:
+                versions.append(self.get(table, team_id))
+                versions.append(self.get(table, "all"))
+        if self.max_age:
+            versions.append(int(time.time() // self.max_age))
+        return ".".join(str(version) for version in versions)
+
+    def etag(self, request_key, tables, team_id=None):
+        '''
+        Strong ETag for a response to request_key built from the tables
+        '''
+        token = self.token(tables, team_id)
+        return hashlib.sha1(("%s|%s" % (request_key, token)).encode()).hexdigest()
+
+
+def create_data_versions():
+    '''
+    Keep the counters in the shared key-value server when the report
+    cache is shared, otherwise in this process
+    '''
+    if cache.cache_mode == "shared":
+        return DataVersions(cache.get_shared_client(), shared=True)
+    return DataVersions(LocalCounters(), max_age=cache.cache_ttl)
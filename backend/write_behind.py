@@ -0,0 +1,336 @@
+# Write-behind queue for /stats/add_stats, /stats/edit_stats and
+# /stats/delete_stats (WRITE_BEHIND=1)
+#
+# A write is acknowledged once it is committed to a SQLite file on the
+# worker's disk instead of after its own PostgreSQL transaction. The queue
+# holds one row per (player_id, game_id), so repeated edits of a stat line
+# before it is flushed replace each other and only the last one is sent.
+# A background thread flushes the queue in batches of up to
+# WRITE_BEHIND_BATCH_SIZE lines, one transaction per batch
+# (database.write_stats_batch), at least every WRITE_BEHIND_INTERVAL
+# seconds and as soon as a full batch is waiting.
+#
+# Lines are only removed from the file once their batch has committed, so
+# writes queued before a crash are flushed after the restart. A batch
+# that committed just before a crash is applied again, which gives the
+# same rows. Once WRITE_BEHIND_MAX_PENDING lines are waiting, new lines
+# wait for room up to WRITE_BEHIND_TIMEOUT seconds and are then refused.
+# Workers may share the file: one flushes at a time.
+import atexit
+from contextlib import contextmanager
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import database as db
+
+# Workers sharing the queue file take turns flushing it through a lock
+# file: flock on Unix, msvcrt.locking on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+enabled = os.getenv("WRITE_BEHIND", "0") == "1"
+queue_path = os.getenv("WRITE_BEHIND_PATH", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "write_behind.sqlite3"))
+batch_size = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+flush_interval = float(os.getenv("WRITE_BEHIND_INTERVAL", "0.5"))
+max_pending = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+enqueue_timeout = float(os.getenv("WRITE_BEHIND_TIMEOUT", "5"))
+
+write_behind_log = logging.getLogger("blm.write_behind")
+
+create_queue_table = """
+CREATE TABLE IF NOT EXISTS pending_stats (
+    player_id INTEGER NOT NULL,
+    game_id INTEGER NOT NULL,
+    deleted INTEGER NOT NULL,
+    points INTEGER,
+    assists INTEGER,
+    rebounds INTEGER,
+    blocks INTEGER,
+    steals INTEGER,
+    -- Order of the latest write of the line, and when its first
+    -- unflushed write was queued
+    seq INTEGER NOT NULL,
+    enqueued_at REAL NOT NULL,
+    PRIMARY KEY (player_id, game_id)
+)
+"""
+
+enqueue_query = """
+INSERT INTO pending_stats (player_id, game_id, deleted, points, assists,
+    rebounds, blocks, steals, seq, enqueued_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?,
+    (SELECT COALESCE(MAX(seq), 0) + 1 FROM pending_stats), ?)
+ON CONFLICT (player_id, game_id) DO UPDATE SET
+    deleted = excluded.deleted,
+    points = excluded.points,
+    assists = excluded.assists,
+    rebounds = excluded.rebounds,
+    blocks = excluded.blocks,
+    steals = excluded.steals,
+    seq = excluded.seq
+"""
+
+
+@contextmanager
+def file_lock(path):
+    '''
+    Hold an exclusive lock on the file at path, shared by every process
+    '''
+    with open(path, "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+            return
+        while True:
+            try:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                # LK_LOCK gives up after 10 seconds, keep waiting
+                pass
+        try:
+            yield
+        finally:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class QueueFull(Exception):
+    '''
+    Raised when a write found no room in the queue in time
+    '''
+
+
+class WriteBehindQueue:
+    '''
+    Durable queue of stat line writes and the thread that flushes it
+    '''
+    def __init__(self, path, batch_size=500, flush_interval=0.5,
+                 max_pending=10000, enqueue_timeout=5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.enqueue_timeout = enqueue_timeout
+        # One SQLite connection per thread
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.wake = False
+        self.stopping = False
+        self.thread = None
+        self.counters = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "waits": 0,
+            "refused": 0,
+            "flushed": 0,
+            "batches": 0,
+            "skipped": 0,
+            "flush_errors": 0
+        }
+        self.last_batch = {"rows": None, "seconds": None, "lag_seconds": None}
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Transactions are started explicitly
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # A queued write survives a power loss, not only a crash
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(create_queue_table)
+            conn.execute("CREATE INDEX IF NOT EXISTS pending_stats_seq ON pending_stats (seq)")
+            self.local.conn = conn
+        return conn
+
+    def count(self, name, amount=1):
+        with self.condition:
+            self.counters[name] += amount
+
+    ## Writes ##
+
+    def enqueue(self, row, deleted=False):
+        '''
+        Queue the upsert of a (player_id, game_id, *stat_columns) row, or
+        the delete of its (player_id, game_id) key. Returns once the
+        write is on disk; raises QueueFull when the queue stayed full
+        for enqueue_timeout seconds.
+        '''
+        self.start()
+        values = tuple(row[:2]) + (int(deleted),) + (
+            tuple(row[2:]) if not deleted else (None,) * len(db.stat_columns))
+        conn = self.connection()
+        deadline = time.monotonic() + self.enqueue_timeout
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                (pending,) = conn.execute("SELECT count(*) FROM pending_stats").fetchone()
+                coalesced = conn.execute(
+                    "SELECT 1 FROM pending_stats WHERE player_id = ? AND game_id = ?",
+                    row[:2]).fetchone() is not None
+                # Replacing a queued line takes no room
+                if coalesced or pending < self.max_pending:
+                    conn.execute(enqueue_query, values + (time.time(),))
+                    conn.execute("COMMIT")
+                    break
+                conn.execute("ROLLBACK")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            # Backpressure: wait for the flusher to make room
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.count("refused")
+                raise QueueFull("%d stat lines are waiting to be written" % pending)
+            self.count("waits")
+            with self.condition:
+                self.wake = True
+                self.condition.notify_all()
+                self.condition.wait(min(remaining, self.flush_interval))
+
+        with self.condition:
+            self.counters["enqueued"] += 1
+            self.counters["coalesced"] += coalesced
+            # Size trigger: a full batch is flushed without waiting
+            if pending + 1 >= self.batch_size:
+                self.wake = True
+                self.condition.notify_all()
+
+    ## Flushing ##
+
+    def flush_batch(self):
+        '''
+        Write the oldest batch_size queued lines to the database in one
+        transaction and remove them from the queue. Returns the number of
+        lines flushed.
+        '''
+        conn = self.connection()
+        # Only one thread or worker flushes at a time, so a line is never
+        # overwritten by an older write of it from another batch
+        with file_lock(self.path + ".lock"):
+            read_at = time.time()
+            queued = conn.execute(
+                "SELECT player_id, game_id, deleted, points, assists, rebounds, blocks, "
+                "steals, seq, enqueued_at FROM pending_stats ORDER BY seq LIMIT ?",
+                (self.batch_size,)).fetchall()
+            if not queued:
+                return 0
+            start = time.perf_counter()
+            upserts = [line[:2] + line[3:8] for line in queued if not line[2]]
+            deletes = [line[:2] for line in queued if line[2]]
+            (_, _, skipped) = db.write_stats_batch(upserts, deletes)
+            # Lines written again during the flush keep their newer write
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("DELETE FROM pending_stats WHERE player_id = ? AND game_id = ? "
+                             "AND seq = ?", [(line[0], line[1], line[8]) for line in queued])
+            # Their waiting write came after the batch was read, so their lag
+            # starts there, not at the write that was just flushed
+            conn.executemany("UPDATE pending_stats SET enqueued_at = MAX(enqueued_at, ?) "
+                             "WHERE player_id = ? AND game_id = ?",
+                             [(read_at, line[0], line[1]) for line in queued])
+            conn.execute("COMMIT")
+
+        if skipped:
+            write_behind_log.warning("skipped stat lines of missing players or games: %s",
+                                     skipped)
+        with self.condition:
+            self.counters["flushed"] += len(queued)
+            self.counters["batches"] += 1
+            self.counters["skipped"] += len(skipped)
+            self.last_batch = {
+                "rows": len(queued),
+                "seconds": round(time.perf_counter() - start, 6),
+                "lag_seconds": round(time.time() - min(line[9] for line in queued), 6)
+            }
+            # Wake writers waiting for room
+            self.condition.notify_all()
+        return len(queued)
+
+    def flush(self):
+        '''
+        Flush batches until the queue is empty
+        '''
+        flushed = 0
+        while True:
+            batch = self.flush_batch()
+            flushed += batch
+            if batch < self.batch_size:
+                return flushed
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.wake and not self.stopping:
+                    self.condition.wait(self.flush_interval)
+                self.wake = False
+                stopping = self.stopping
+            if stopping:
+                return
+            try:
+                self.flush()
+            except Exception:
+                # The lines stay queued and are retried on the next wake
+                self.count("flush_errors")
+                write_behind_log.exception("flushing queued stat lines failed")
+                time.sleep(self.flush_interval)
+
+    def start(self):
+        '''
+        Start the flusher thread, once per process. Lines left in the
+        file by a previous run are flushed first.
+        '''
+        if self.thread is not None:
+            return
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="write-behind",
+                                               daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def close(self):
+        '''
+        Stop the flusher and write every queued line (at shutdown)
+        '''
+        # Closed once: not again at exit
+        atexit.unregister(self.close)
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.flush()
+        except Exception:
+            write_behind_log.exception("lines left in %s are flushed on the next start",
+                                       self.path)
+
+    ## Metrics ##
+
+    def stats(self):
+        (pending, oldest) = self.connection().execute(
+            "SELECT count(*), MIN(enqueued_at) FROM pending_stats").fetchone()
+        with self.condition:
+            stats = dict(self.counters)
+            stats.update({"last_batch_" + name: value
+                          for (name, value) in self.last_batch.items()})
+        stats["pending"] = pending
+        stats["lag_seconds"] = round(time.time() - oldest, 6) if oldest is not None else 0
+        return stats
+
+
+def create_write_queue():
+    '''
+    Build the queue described by the WRITE_BEHIND_* settings,
+    or None when stat writes go straight to the database
+    '''
+    if not enabled:
+        return None
+    return WriteBehindQueue(queue_path, batch_size, flush_interval,
+                            max_pending, enqueue_timeout)
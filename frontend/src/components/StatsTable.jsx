@@ -15,26 +15,64 @@ import {
   randomId,
 } from '@mui/x-data-grid-generator';
 
+// Stat lines fetched per request
+const STATS_PAGE_SIZE = 200;
+
 export default function StatsCrudTable() {
   const [rows, setRows] = React.useState([]);
   const [rowModesModel, setRowModesModel] = React.useState({});
   const [playerOptions, setPlayerOptions] = React.useState([]);
   const [gameOptions, setGameOptions] = React.useState([]);
 
-    // Function to fetch the initial data from the server using Axios
-    const fetchInitialData = async () => {
+    // Cursor of the next page of stat lines, null once every page is loaded
+    const [nextCursor, setNextCursor] = React.useState(null);
+    const loadingPage = React.useRef(false);
+    // Bumped when the table is fetched again, so older pages are dropped
+    const generation = React.useRef(0);
+    const sameLine = (row, line) =>
+      row.player_id === line.player_id && row.game_id === line.game_id;
+
+    // Function to fetch one page of stat lines: the first page replaces the
+    // table, the next ones (given their cursor) are added to it
+    const fetchStatsPage = async (cursor) => {
+      if (cursor && loadingPage.current) {
+        return;
+      }
+      const current = cursor ? generation.current : ++generation.current;
+      loadingPage.current = true;
       try {
-        const response = await axios.get('/stats/get_stats'); // Use Axios for the GET request
-        if (response.status === 200) {
-          const data = response.data;
-          // Assign unique IDs to each row using randomId()
-          const rowsWithIds = data.map((row) => ({ id: randomId(), ...row }));
-          setRows(rowsWithIds);
-        } else {
+        const response = await axios.get('/stats/get_stats', {
+          params: cursor ? { cursor, limit: STATS_PAGE_SIZE } : { limit: STATS_PAGE_SIZE },
+        }); // Use Axios for the GET request
+        if (response.status !== 200) {
           console.error('Failed to fetch initial data');
+          return;
         }
+        if (current !== generation.current) {
+          return;
+        }
+        // Assign unique IDs to each row using randomId()
+        const rowsWithIds = response.data.map((row) => ({ id: randomId(), ...row }));
+        setRows((currentRows) => (cursor
+          // Lines pushed by live events may already be in the table
+          ? [...currentRows, ...rowsWithIds.filter(
+              (line) => !currentRows.some((row) => sameLine(row, line)))]
+          : rowsWithIds));
+        setNextCursor(response.headers['x-next-cursor'] || null);
       } catch (error) {
         console.error('Error fetching initial data:', error);
+      } finally {
+        loadingPage.current = false;
+      }
+    };
+
+    const fetchInitialData = () => fetchStatsPage(null);
+
+    // Stats are paginated: the next page is only loaded when the grid gets
+    // near the end of the lines loaded so far
+    const handlePaginationModelChange = ({ page, pageSize }) => {
+      if (nextCursor && (page + 2) * pageSize >= rows.length) {
+        fetchStatsPage(nextCursor);
       }
     };
 
@@ -80,6 +118,38 @@ export default function StatsCrudTable() {
       fetchGameData();
     }, []);
 
+    // Live updates: the server pushes the stat lines other users write or delete
+    React.useEffect(() => {
+      const source = new EventSource('/events/stream');
+
+      source.addEventListener('stats', (event) => {
+        const { lines } = JSON.parse(event.data);
+        setRows((currentRows) => {
+          let updated = currentRows;
+          lines.forEach(({ team_id, result, ...line }) => {
+            if (updated.some((row) => sameLine(row, line))) {
+              updated = updated.map((row) => (sameLine(row, line) ? { ...row, ...line } : row));
+            } else {
+              updated = [...updated, { id: randomId(), ...line }];
+            }
+          });
+          return updated;
+        });
+      });
+      source.addEventListener('stats_deleted', (event) => {
+        const { lines } = JSON.parse(event.data);
+        setRows((currentRows) =>
+          currentRows.filter((row) => !lines.some((line) => sameLine(row, line)))
+        );
+      });
+      // Sent when events were missed: the table is fetched again
+      source.addEventListener('reset', () => {
+        fetchInitialData();
+      });
+
+      return () => source.close();
+    }, []);
+
   const handleRowEditStop = (params, event) => {
     if (params.reason === GridRowEditStopReasons.rowFocusOut) {
       event.defaultMuiPrevented = true;
@@ -290,6 +360,7 @@ export default function StatsCrudTable() {
           rowModesModel={rowModesModel}
           onRowModesModelChange={handleRowModesModelChange}
           onRowEditStop={handleRowEditStop}
+          onPaginationModelChange={handlePaginationModelChange}
           processRowUpdate={processRowUpdate}
           onProcessRowUpdateError={(error) => {
             // Handle the error here, e.g., display a message to the user or log it.
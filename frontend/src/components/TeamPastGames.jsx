@@ -8,7 +8,7 @@ import {
   randomId,
 } from '@mui/x-data-grid-generator';
 
-export default function TeamPastGames({selectedTeam}) {
+export default function TeamPastGames({selectedTeam, pastGames}) {
   const [rows, setRows] = useState([]);
 
   // Function to fetch team past game results from API
@@ -33,8 +33,13 @@ export default function TeamPastGames({selectedTeam}) {
   };
 
   useEffect(() => {
-    fetchPastGames()
-  }, [selectedTeam]);
+    // Rows passed in by the report page come from the team dashboard
+    if (pastGames) {
+      setRows(pastGames.map((row) => ({ id: randomId(), ...row })));
+    } else {
+      fetchPastGames()
+    }
+  }, [selectedTeam, pastGames]);
 
   const columns = [
     { field: 'date', 
@@ -8,7 +8,7 @@ import {
   randomId,
 } from '@mui/x-data-grid-generator';
 
-export default function TeamRoster({selectedTeam}) {
+export default function TeamRoster({selectedTeam, roster}) {
   const [rows, setRows] = useState([]);
 
   // Function to fetch team roster from API
@@ -33,8 +33,13 @@ export default function TeamRoster({selectedTeam}) {
   };
 
   useEffect(() => {
-    fetchTeamRoster()
-  }, [selectedTeam]);
+    // Rows passed in by the report page come from the team dashboard
+    if (roster) {
+      setRows(roster.map((row) => ({ id: randomId(), ...row })));
+    } else {
+      fetchTeamRoster()
+    }
+  }, [selectedTeam, roster]);
 
   const columns = [
     { field: 'player_name', 
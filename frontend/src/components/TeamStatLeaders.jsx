@@ -8,7 +8,7 @@ import {
   randomId,
 } from '@mui/x-data-grid-generator';
 
-export default function TeamStatLeaders({selectedTeam}) {
+export default function TeamStatLeaders({selectedTeam, leaders}) {
   const [rows, setRows] = useState([]);
 
   // Function to fetch team stats leaders from API
@@ -33,8 +33,13 @@ export default function TeamStatLeaders({selectedTeam}) {
   };
 
   useEffect(() => {
-    fetchStatsLeaders()
-  }, [selectedTeam]);
+    // Rows passed in by the report page come from the team dashboard
+    if (leaders) {
+      setRows(leaders.map((row) => ({ id: randomId(), ...row })));
+    } else {
+      fetchStatsLeaders()
+    }
+  }, [selectedTeam, leaders]);
 
   const columns = [
     { field: 'stat_category', 
@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import axios from 'axios';
 
-export default function WinLossRecord({selectedTeam}) {
+export default function WinLossRecord({selectedTeam, record: dashboardRecord}) {
   const [record, setRecord] = useState({ wins: 0, losses: 0 });
 
   // Function to fetch win loss record from API
@@ -19,8 +19,13 @@ export default function WinLossRecord({selectedTeam}) {
   };
 
   useEffect(() => {
-    fetchWinLossRecord()
-  }, [selectedTeam]);
+    // A record passed in by the report page comes from the team dashboard
+    if (dashboardRecord) {
+      setRecord(dashboardRecord);
+    } else {
+      fetchWinLossRecord()
+    }
+  }, [selectedTeam, dashboardRecord]);
 
   return (
     <p><b>Win-Loss Record:</b> {record.wins}-{record.losses}</p>
@@ -1,4 +1,5 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect } from 'react';
+import axios from 'axios';
 import TeamDropdown from '../components/TeamDropdown';
 import WinLossRecord from '../components/WinLossRecord';
 import TeamPastGames from '../components/TeamPastGames';
@@ -7,28 +8,53 @@ import TeamStatLeaders from '../components/TeamStatLeaders';
 
 export default function Report() {
   const [selectedTeam, setSelectedTeam] = useState(1);
+  const [dashboard, setDashboard] = useState(null);
+
+  // Function to fetch all four reports of a team in one request
+  const fetchDashboard = async () => {
+    try {
+      const response = await axios.get('/report/team_dashboard', {
+        params: {
+          team_id: String(selectedTeam)
+        }
+      });
+      setDashboard(response.data);
+    } catch (error) {
+      console.error("Error fetching team dashboard: ", error);
+      // Without a dashboard each component fetches its own report
+      setDashboard({});
+    }
+  };
+
+  useEffect(() => {
+    setDashboard(null);
+    fetchDashboard()
+  }, [selectedTeam]);
+
+  // Components are rendered once the dashboard request has finished
+  const waiting = dashboard === null;
 
   return (
     <div>
       <h2>Report</h2>
       <h3>Select Team</h3>
       <TeamDropdown selectedTeam={selectedTeam} setSelectedTeam={setSelectedTeam} />
-      <WinLossRecord selectedTeam={selectedTeam} />
+      {!waiting && <WinLossRecord selectedTeam={selectedTeam} record={dashboard.record} />}
 
       <div style={{ display: 'flex', justifyContent: 'flex-start' }}>
         <div style={{ marginRight: '10px' }}>
           <h3>Roster</h3>
-          <TeamRoster selectedTeam={selectedTeam} />
+          {!waiting && <TeamRoster selectedTeam={selectedTeam} roster={dashboard.roster} />}
         </div>
 
         <div style={{ marginRight: '10px' }}>
           <h3>Leaders</h3>
-          <TeamStatLeaders selectedTeam={selectedTeam} />
+          {!waiting && <TeamStatLeaders selectedTeam={selectedTeam} leaders={dashboard.leaders} />}
         </div>
 
         <div>
           <h3>Past Games</h3>
-          <TeamPastGames selectedTeam={selectedTeam} />
+          {!waiting && <TeamPastGames selectedTeam={selectedTeam} pastGames={dashboard.past_games} />}
         </div>
       </div>
 